@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+
+from app.instrumentation import get_logger
+from app.utils import get_redis_client, get_supabase_client
+
+log = get_logger(__name__)
+
+# Per-process cache of rows from the 'agents' table, so summarization doesn't
+# query Supabase on every run. Entries expire after AGENT_CONFIG_TTL seconds
+# and are dropped immediately when invalidate_agent_config() is called from
+# anywhere (the message goes out over Redis pub/sub to every worker process).
+AGENT_CONFIG_CACHE_ENABLED = os.getenv("AGENT_CONFIG_CACHE_ENABLED", "true").lower() == "true"
+AGENT_CONFIG_TTL = float(os.getenv("AGENT_CONFIG_TTL", "300"))
+
+INVALIDATE_CHANNEL = "tia:agents:invalidate"
+CONTENT_PLACEHOLDER = "{content_to_summarize}"
+AGENT_COLUMNS = "id, summarization_prompt, role, content"
+
+_cache = {} # agent_id -> (expires_at, config)
+_cache_lock = threading.Lock()
+_listener_pid = None
+_generation = 0 # bumped on every invalidation; fetches that raced one aren't cached
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def _compile(row: dict) -> dict:
+    """Split the summarization template once, so rendering is a join rather than a rescan."""
+    template = row.get("summarization_prompt", "Default summarization prompt if not found")
+    return {
+        "role": row.get("role", "system"),
+        "content": row.get("content", "You are a helpful assistant that summarizes and extracts options."),
+        "summarization_prompt": template,
+        "prompt_parts": tuple(template.split(CONTENT_PLACEHOLDER)),
+    }
+
+
+def render_summarization_prompt(config: dict, content_to_summarize: str) -> str:
+    return content_to_summarize.join(config["prompt_parts"])
+
+
+def _listen_for_invalidations():
+    global _generation
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                agent_id = message["data"].decode("utf-8")
+                with _cache_lock:
+                    _generation += 1
+                    if agent_id == "*":
+                        _cache.clear()
+                    else:
+                        _cache.pop(agent_id, None)
+                    _stats["invalidations"] += 1
+        except Exception as e:
+            log.warning(f"Agent config invalidation listener error, reconnecting: {e}")
+            time.sleep(5)
+
+
+def _ensure_listener():
+    # One subscriber thread per process; threads don't survive fork, so check the PID.
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _cache_lock:
+        if _listener_pid == os.getpid():
+            return
+        _cache.clear() # anything inherited from the parent may have missed invalidations
+        threading.Thread(target=_listen_for_invalidations, daemon=True, name="agent-config-invalidation").start()
+        _listener_pid = os.getpid()
+
+
+def _store(rows: list[dict], generation: int) -> dict:
+    expires_at = time.monotonic() + AGENT_CONFIG_TTL
+    configs = {str(row["id"]): _compile(row) for row in rows}
+    with _cache_lock:
+        if generation != _generation:
+            return configs
+        for agent_id, config in configs.items():
+            _cache[agent_id] = (expires_at, config)
+    return configs
+
+
+def get_agent_config(agent_id) -> dict:
+    """
+    Agent config as {role, content, summarization_prompt, prompt_parts}.
+    Raises if the agent does not exist.
+    """
+    key = str(agent_id)
+    if AGENT_CONFIG_CACHE_ENABLED:
+        _ensure_listener()
+        entry = _cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            _stats["hits"] += 1
+            return entry[1]
+        _stats["misses"] += 1
+
+    generation = _generation
+    response = get_supabase_client().table("agents").select(AGENT_COLUMNS).eq("id", agent_id).maybe_single().execute()
+    if response is None or response.data is None:
+        raise Exception(f"Agent configuration not found for agent_id: {agent_id}")
+    if not AGENT_CONFIG_CACHE_ENABLED:
+        return _compile(response.data)
+    return _store([response.data], generation)[key]
+
+
+def warm_agent_configs() -> int:
+    """Load every agent into this process's cache (called at worker process start)."""
+    if not AGENT_CONFIG_CACHE_ENABLED:
+        return 0
+    _ensure_listener()
+    generation = _generation
+    response = get_supabase_client().table("agents").select(AGENT_COLUMNS).execute()
+    return len(_store(response.data or [], generation))
+
+
+def invalidate_agent_config(agent_id=None):
+    """Drop an agent (or, with no id, all agents) from every worker's cache. Call after editing 'agents'."""
+    try:
+        get_redis_client().publish(INVALIDATE_CHANNEL, "*" if agent_id is None else str(agent_id))
+    except Exception as e:
+        log.warning(f"Failed to publish agent config invalidation: {e}")
+
+
+def get_agent_config_stats() -> dict:
+    """This process's cache hits, misses, invalidations received and cached agent count."""
+    return {**_stats, "cached_agents": len(_cache)}
@@ -0,0 +1,75 @@
+import asyncio
+import os
+import threading
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.instrumentation import current_context, with_current_context
+
+# Execution mode for the I/O-bound tasks:
+#   prefork - (default) each task body runs synchronously; one prompt per worker process.
+#   asyncio - task bodies run as coroutines on one event loop per worker process
+#             (app/async_stages.py), with async OpenAI, HTTP and Supabase clients.
+#             Start the worker with a thread pool, whose threads only wait on the
+#             loop, e.g. `celery -A app.celery_app worker --pool=threads --concurrency=256`
+#             (entrypoint.sh does this when TASK_EXECUTION_MODE=asyncio).
+TASK_EXECUTION_MODE = os.getenv("TASK_EXECUTION_MODE", "prefork").lower()
+ASYNC_MODE = TASK_EXECUTION_MODE == "asyncio"
+ASYNC_WORKER_CONCURRENCY = int(os.getenv("ASYNC_WORKER_CONCURRENCY", "256"))
+# Upper bound on one stage coroutine; a hung stage must not hold its thread forever.
+ASYNC_STAGE_TIMEOUT = float(os.getenv("ASYNC_STAGE_TIMEOUT", "900"))
+ASYNC_OPENAI_MAX_CONNECTIONS = int(os.getenv("ASYNC_OPENAI_MAX_CONNECTIONS", "200"))
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_pid: int | None = None
+_loop_lock = threading.Lock()
+_async_openai: AsyncOpenAI | None = None
+
+
+class RetryStage(Exception):
+    """Raised by a stage coroutine to have the calling Celery task retry after `countdown` seconds."""
+
+    def __init__(self, error: Exception, countdown: float):
+        super().__init__(str(error))
+        self.error = error
+        self.countdown = countdown
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """This process's event loop, running in a daemon thread (started on first use, again after fork)."""
+    global _loop, _loop_pid, _async_openai
+    pid = os.getpid()
+    if _loop is not None and _loop_pid == pid:
+        return _loop
+    with _loop_lock:
+        if _loop is None or _loop_pid != pid:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True, name="stage-event-loop").start()
+            _loop, _loop_pid = loop, pid
+            _async_openai = None # clients are bound to the loop they were created on
+        return _loop
+
+
+def run(coro, timeout: float = ASYNC_STAGE_TIMEOUT):
+    """Run a coroutine on the process event loop and wait for its result (called from task threads)."""
+    # The loop thread has its own context; carry the calling task's stage tags over to the coroutine.
+    future = asyncio.run_coroutine_threadsafe(with_current_context(coro, current_context()), get_loop())
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+def get_async_openai(api_key: str) -> AsyncOpenAI:
+    """Process-wide AsyncOpenAI client; call from coroutines on the process loop."""
+    global _async_openai
+    if _async_openai is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_OPENAI_MAX_CONNECTIONS,
+                                max_keepalive_connections=ASYNC_OPENAI_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(600, connect=10),
+        )
+        _async_openai = AsyncOpenAI(api_key=api_key, http_client=http_client)
+    return _async_openai
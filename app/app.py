@@ -1,12 +1,23 @@
 import reflex as rx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
 from .models import Prompt, Result # Assuming models.py might be used for Pydantic types if needed by Reflex state
-from .utils import get_supabase_client
-from .tasks import information_retrieval_task, process_and_summarize_task # Import Celery tasks
+from .utils import authenticated_user_id, get_supabase_client
+from .progress import get_cached_status, subscribe_progress, is_finished
+from .streaming import LLM_STREAMING, subscribe_tokens
+from .pipeline import DEFAULT_AGENT_ID, start_pipeline
+from .batches import BATCH_MAX_IN_FLIGHT, BATCH_UI_MAX_PROMPTS, get_batch_progress, parse_prompt_lines, submit_batch
+from .instrumentation import get_logger, render_metrics
 from datetime import datetime
+import asyncio
 import json # For parsing processed_options
 
+log = get_logger(__name__)
+
 class State(rx.State):
     prompt: str = ""
+    urls: str = "" # Optional source URLs, one per line, summarized by the MCP stage
     current_prompt_id: int | None = None
     is_loading: bool = False
     
@@ -14,7 +25,17 @@ class State(rx.State):
     result: str = "Output will appear here." # General status messages
     processed_options: list[str] = []
     summary: str = ""
+    mcp_summary: str = ""
     error_message: str = ""
+    _watching_prompt_id: int | None = None # backend-only: prompt with a live progress subscription
+
+    # Bulk submission (app/batches.py)
+    bulk_prompts: str = "" # one prompt per line, or JSONL with "prompt" and optional "urls"
+    batch_id: str = ""
+    batch_status: str = ""
+    batch_finished: int = 0 # completed + failed
+    batch_total: int = 0
+    is_submitting_batch: bool = False
 
     def handle_submit(self):
         if not self.prompt.strip():
@@ -25,6 +46,7 @@ class State(rx.State):
         self.result = "Submitting prompt..."
         self.error_message = ""
         self.summary = ""
+        self.mcp_summary = ""
         self.processed_options = []
         self.current_prompt_id = None # Reset from previous submission
 
@@ -43,12 +65,18 @@ class State(rx.State):
                 self.current_prompt_id = response.data[0]['id']
                 self.result = f"Prompt submitted (ID: {self.current_prompt_id}). Processing..."
                 
-                # Call the first Celery task
-                information_retrieval_task.delay(prompt_id=self.current_prompt_id, user_prompt=self.prompt)
-                # Optionally, chain the next task if retrieval is synchronous or handle it purely by status
-                # For now, let's assume information_retrieval_task will trigger process_and_summarize_task
-                # or we'll rely on status checks. The original plan has them separate.
-                # process_and_summarize_task.delay(prompt_id=self.current_prompt_id) # This might be premature
+                # Dispatch the whole stage graph (retrieval -> summary, and MCP when URLs
+                # are given); each stage starts as soon as the previous one finishes.
+                urls = [u.strip() for u in self.urls.splitlines() if u.strip()]
+                # The UI has no sign-in, so fair-share scheduling (app/fair_share.py) counts
+                # its prompts as the anonymous user's (and its batches as a separate anonymous
+                # batch user's); nothing the browser sends picks the quota.
+                start_pipeline(self.current_prompt_id, self.prompt, DEFAULT_AGENT_ID, urls)
+                # Progress (and streamed text, if enabled) is pushed from the tasks;
+                # no need to click "Refresh Results".
+                if LLM_STREAMING:
+                    return [State.watch_progress, State.watch_stream]
+                return State.watch_progress
 
             else:
                 self.error_message = f"Failed to submit prompt. Supabase response: {response.error.message if response.error else 'No data returned'}"
@@ -70,6 +98,16 @@ class State(rx.State):
         self.summary = "" # Clear previous summary
         self.processed_options = [] # Clear previous options
 
+        # Reconnecting clients are served from the progress status cache when it has
+        # everything needed, instead of two Supabase round trips.
+        cached = get_cached_status(self.current_prompt_id)
+        if cached and (cached.get("status") != "completed" or "summary" in cached):
+            self._apply_progress(cached)
+            self.is_loading = False
+            if not is_finished(cached) and self._watching_prompt_id != self.current_prompt_id:
+                return State.watch_progress
+            return
+
         try:
             supabase = get_supabase_client()
             
@@ -100,10 +138,8 @@ class State(rx.State):
                         self.error_message = f"Results not found for prompt ID {self.current_prompt_id}, though status is 'completed'."
                         self.result = ""
                 elif current_status == "retrieval_complete":
-                     self.result = f"Status: {current_status}. Summary generation is pending. Click Refresh again shortly."
-                     # Trigger the next task if it hasn't been triggered automatically
-                     # This is a good place to ensure the summarization task is called
-                     process_and_summarize_task.delay(prompt_id=self.current_prompt_id)                
+                     # The pipeline starts summarization on its own; nothing to trigger from here.
+                     self.result = f"Status: {current_status}. Summary generation is pending."
                 elif current_status == "retrieval_error":
                     self.error_message = "An error occurred while fetching information. Please try submitting again or contact support if the issue persists."
                     self.result = "" # Clear general result message
@@ -128,6 +164,137 @@ class State(rx.State):
         finally:
             self.is_loading = False
 
+    def _apply_progress(self, event: dict):
+        """Update the displayed state from a progress event published by the tasks."""
+        # Pipeline stages run in parallel, so outputs are applied whenever an event carries them.
+        status = event.get("status", "")
+        if event.get("mcp_data") is not None:
+            self.mcp_summary = event["mcp_data"]
+        if status == "completed":
+            self.summary = event.get("summary") or "Summary not available."
+            try:
+                self.processed_options = json.loads(event.get("processed_options") or "[]")
+                if not isinstance(self.processed_options, list):
+                    self.processed_options = [str(self.processed_options)] # Ensure it's a list
+            except json.JSONDecodeError:
+                self.processed_options = ["Error: Could not parse options."]
+            self.error_message = ""
+            self.result = "Results loaded." if is_finished(event) else "Results loaded. Summarizing sources..."
+        elif status == "mcp_complete":
+            self.result = "Source summary loaded."
+        elif not status and event.get("mcp_status"):
+            pass # MCP progress inside a pipeline; the main status is unchanged
+        elif status == "retrieval_error":
+            self.error_message = "An error occurred while fetching information. Please try submitting again or contact support if the issue persists."
+            self.result = ""
+        elif status in ["summary_error_config", "summary_error"]:
+            self.error_message = "An error occurred while processing the results. Please try again or contact support."
+            self.result = ""
+        else:
+            self.result = f"Processing... Current status: {status}"
+
+    @rx.event(background=True)
+    async def watch_progress(self):
+        async with self:
+            prompt_id = self.current_prompt_id
+            if prompt_id is None or self._watching_prompt_id == prompt_id:
+                return
+            self._watching_prompt_id = prompt_id
+
+        try:
+            async for event in subscribe_progress(prompt_id):
+                async with self:
+                    if self.current_prompt_id != prompt_id:
+                        return # A newer prompt was submitted
+                    self._apply_progress(event)
+        except Exception as e:
+            log.info(f"Progress subscription for prompt_id {prompt_id} ended: {e}")
+        finally:
+            async with self:
+                if self._watching_prompt_id == prompt_id:
+                    self._watching_prompt_id = None
+
+    @rx.event(background=True)
+    async def handle_bulk_submit(self):
+        """Submit the bulk prompts as one batch and follow its progress."""
+        async with self:
+            items = parse_prompt_lines(self.bulk_prompts.splitlines())
+            if not items or self.is_submitting_batch:
+                self.batch_status = "" if items else "Enter at least one prompt for the batch."
+                return
+            self.is_submitting_batch = True
+            self.batch_status = f"Submitting {len(items)} prompts..."
+
+        try:
+            # Without sign-in, UI batches get a much lower size limit than POST /batches.
+            batch = await asyncio.to_thread(submit_batch, items, max_prompts=BATCH_UI_MAX_PROMPTS)
+        except Exception as e:
+            async with self:
+                self.batch_status = f"Batch submission failed: {e}"
+                self.is_submitting_batch = False
+            return
+        async with self:
+            self.batch_id = batch["batch_id"]
+            self.is_submitting_batch = False
+
+        batch_id = batch["batch_id"]
+        while True:
+            progress = await asyncio.to_thread(get_batch_progress, batch_id)
+            async with self:
+                if self.batch_id != batch_id:
+                    return # A newer batch was submitted
+                if progress is None:
+                    self.batch_status = f"Batch {batch_id} is no longer available."
+                    return
+                self.batch_total = progress["total"]
+                self.batch_finished = progress["completed"] + progress["failed"]
+                self.batch_status = (f"Batch {batch_id}: {progress['completed']} completed, {progress['failed']} failed, "
+                                     f"{progress['running']} running, {progress['queued']} queued")
+            if progress["done"]:
+                return
+            await asyncio.sleep(2)
+
+    @rx.event(background=True)
+    async def watch_stream(self):
+        """Render LLM output from the prompt's token stream as it is generated."""
+        async with self:
+            prompt_id = self.current_prompt_id
+            # The summary stage streams, and so does the MCP stage when URLs are given.
+            stages = {"summary", "mcp"} if self.urls.strip() else {"summary"}
+        if prompt_id is None:
+            return
+
+        tokens = subscribe_tokens(prompt_id)
+        next_event = asyncio.ensure_future(anext(tokens))
+        try:
+            while stages:
+                ready, _ = await asyncio.wait({next_event}, timeout=2)
+                if not ready:
+                    # A stage that fails before streaming never sends done; stop once the pipeline has finished.
+                    state = await asyncio.to_thread(get_cached_status, prompt_id)
+                    if state and is_finished(state):
+                        return
+                    continue
+                stage, text, done = next_event.result()
+                async with self:
+                    if self.current_prompt_id != prompt_id:
+                        return # A newer prompt was submitted
+                    if stage == "mcp":
+                        self.mcp_summary = text
+                    elif not self.processed_options: # Final parsed result not loaded yet
+                        self.summary = text
+                if done:
+                    stages.discard(stage)
+                next_event = asyncio.ensure_future(anext(tokens))
+        except StopAsyncIteration:
+            pass
+        except Exception as e:
+            log.info(f"Token stream for prompt_id {prompt_id} ended: {e}")
+        finally:
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+            await tokens.aclose()
+
 
 def index():
     return rx.container(
@@ -141,6 +308,13 @@ def index():
                 style={"margin_bottom": "0.5em", "width": "100%"},
                 is_disabled=State.is_loading,
             ),
+
+            rx.text_area(
+                placeholder="Optional: source URLs to summarize, one per line",
+                on_blur=State.set_urls,
+                style={"margin_bottom": "0.5em", "width": "100%"},
+                is_disabled=State.is_loading,
+            ),
             
             rx.hstack(
                 rx.button(
@@ -159,6 +333,30 @@ def index():
                 style={"margin_bottom": "1em"}
             ),
             
+            rx.text_area(
+                placeholder="Bulk: many prompts, one per line (or JSONL with \"prompt\" and \"urls\")",
+                on_blur=State.set_bulk_prompts,
+                style={"margin_bottom": "0.5em", "width": "100%"},
+                is_disabled=State.is_submitting_batch,
+            ),
+            rx.hstack(
+                rx.button(
+                    "Submit Batch",
+                    on_click=State.handle_bulk_submit,
+                    is_loading=State.is_submitting_batch,
+                    is_disabled=State.is_submitting_batch,
+                ),
+                rx.cond(
+                    State.batch_total > 0,
+                    rx.progress(value=State.batch_finished, max=State.batch_total, width="200px"),
+                    rx.fragment()
+                ),
+                rx.text(State.batch_status, font_style="italic"),
+                spacing="2",
+                align_items="center",
+                style={"margin_bottom": "1em"}
+            ),
+
             # Display area
             rx.vstack(
                 rx.cond(
@@ -188,6 +386,18 @@ def index():
                     rx.fragment()
                 ),
 
+                rx.cond(
+                    State.mcp_summary != "",
+                    rx.hstack(
+                        rx.heading("Sources Summary:", size="6", margin_top="1em"),
+                        rx.text(State.mcp_summary, white_space="pre-wrap"),
+                        align_items="flex-start",
+                        width="100%",
+                        margin_bottom="1em"
+                    ),
+                    rx.fragment()
+                ),
+
                 rx.cond(
                     State.processed_options.length() > 0, # Check if list is not empty
                     rx.hstack(
@@ -216,6 +426,64 @@ def index():
         margin="auto" # Center the container
     )
 
+async def metrics_endpoint(request):
+    # Cluster-wide stage, span and token metrics (see app/instrumentation.py).
+    try:
+        body = await asyncio.to_thread(render_metrics)
+    except Exception as e:
+        return PlainTextResponse(f"Metrics unavailable: {e}", status_code=503)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+async def submit_batch_endpoint(request):
+    # Bulk submission: a JSON body {"prompts": [...], "priority": ..., "max_in_flight": ...},
+    # or JSONL / plain text with one prompt per line. Needs a Supabase Auth access token
+    # (Authorization: Bearer ...); the batch runs as that user.
+    try:
+        user_id = await asyncio.to_thread(authenticated_user_id, request.headers.get("authorization"))
+    except ValueError as e:
+        return JSONResponse({"error": f"Batch submission failed: {e}"}, status_code=503)
+    if user_id is None:
+        return JSONResponse({"error": "A valid access token is required"}, status_code=401,
+                            headers={"WWW-Authenticate": "Bearer"})
+    body = await request.body()
+    options = {"user_id": user_id}
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            payload = json.loads(body)
+            items = payload.get("prompts") or []
+            options.update(agent_id=int(payload.get("agent_id", DEFAULT_AGENT_ID)),
+                           priority=payload.get("priority", "bulk"),
+                           max_in_flight=int(payload.get("max_in_flight", BATCH_MAX_IN_FLIGHT)))
+            # Interactive priority is kept for prompts typed into the UI.
+            if options["priority"] == "interactive":
+                return JSONResponse({"error": "Batches cannot use 'interactive' priority"}, status_code=403)
+        else:
+            items = parse_prompt_lines(body.decode("utf-8").splitlines())
+        batch = await asyncio.to_thread(submit_batch, items, **options)
+    except (ValueError, AttributeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except Exception as e:
+        log.error(f"Batch submission failed: {e}")
+        return JSONResponse({"error": f"Batch submission failed: {e}"}, status_code=503)
+    return JSONResponse({"batch_id": batch["batch_id"], "total": len(batch["prompt_ids"]),
+                         "progress": f"/batches/{batch['batch_id']}"}, status_code=202)
+
+
+async def batch_progress_endpoint(request):
+    progress = await asyncio.to_thread(get_batch_progress, request.path_params["batch_id"])
+    if progress is None:
+        return JSONResponse({"error": "Batch not found"}, status_code=404)
+    return JSONResponse(progress)
+
+
+# Backend routes served next to Reflex's own, e.g. http://localhost:8000/metrics.
+backend_routes = Starlette(routes=[
+    Route("/metrics", metrics_endpoint),
+    Route("/batches", submit_batch_endpoint, methods=["POST"]),
+    Route("/batches/{batch_id}", batch_progress_endpoint),
+])
+
 # Add state and page to the app.
-app = rx.App()
+app = rx.App(api_transformer=backend_routes)
 app.add_page(index)
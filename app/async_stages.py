@@ -0,0 +1,300 @@
+import asyncio
+import json
+import time
+
+from app.agent_config import get_agent_config, render_summarization_prompt
+from app.aio import RetryStage, get_async_openai, run
+from app.dedup import dedup_sources
+from app.extractors import StreamingExtractor
+from app.fetcher import afetch_urls
+from app.instrumentation import get_logger
+from app.llm_cache import acached_chat_completion, agent_cache_enabled
+from app.page_cache import lookup_pages, conditional_headers, record_bypass
+from app.pipeline import STAGE_RETRY_POLICIES, retry_countdown
+from app.progress import publish_status, publish_stage
+from app.streaming import LLM_STREAMING, astreamed_chat_completion
+from app.summarizer import asummarize_sources
+from app.tasks import (OPENAI_API_KEY_FROM_ENV, RAW_DATA_SELECT, add_dedup_notes, content_to_summarize, dedup_summary,
+                       fetch_notes, mcp_result_columns, parse_summary_output, raw_data_columns, retrieval_messages,
+                       reused_raw_data, source_text, stored_raw_data)
+from app.utils import StageConflict, acommit_stage, get_async_supabase_client
+from app.vector_index import augment_text, hit_refs, index_retrieval, index_sources, lookup_context
+
+log = get_logger(__name__)
+
+# Coroutine implementations of the stage tasks for TASK_EXECUTION_MODE=asyncio
+# (see app/aio.py). Same statuses, events, return values and retry policy as
+# the synchronous bodies in app/tasks.py; only the I/O is non-blocking. Quick
+# Redis helpers (status publish, caches) and CPU work (text extraction) run via
+# asyncio.to_thread so they never stall the loop.
+
+
+async def _set_prompt_status(prompt_id: int, status: str, **fields) -> bool:
+    outcome = await acommit_stage(prompt_id, status)
+    if not outcome["applied"]:
+        log.info(f"Not moving prompt_id {prompt_id} to '{status}': it is '{outcome['status']}'")
+        return False
+    await asyncio.to_thread(publish_status, prompt_id, status, **fields)
+    return True
+
+
+async def _advance_prompt(prompt_id: int, status: str, result: dict | None = None, new_result: bool = False,
+                          result_id: int | None = None, **fields) -> dict:
+    outcome = await acommit_stage(prompt_id, status, result=result, new_result=new_result, result_id=result_id)
+    if not outcome["applied"]:
+        raise StageConflict(prompt_id, status, outcome["status"])
+    await asyncio.to_thread(publish_status, prompt_id, status, **fields)
+    return outcome
+
+
+def _retry_or_none(stage: str, retries: int, error: Exception):
+    countdown = retry_countdown(stage, retries, error)
+    if countdown is not None:
+        raise RetryStage(error, countdown)
+
+
+async def retrieval(prompt_id: int, user_prompt: str, user_id: str | None = None, retries: int = 0) -> dict:
+    await get_async_supabase_client() # This will raise ValueError if keys are default
+    started = time.monotonic()
+    try:
+        await _advance_prompt(prompt_id, "processing_retrieval")
+
+        raw_data_content = {}
+        found = await asyncio.to_thread(lookup_context, user_prompt, user_id)
+        if "reuse" in found:
+            raw_data_content = reused_raw_data(found)
+        elif OPENAI_API_KEY_FROM_ENV:
+            try:
+                response = await acached_chat_completion(
+                    get_async_openai(OPENAI_API_KEY_FROM_ENV), model="gpt-3.5-turbo",
+                    messages=retrieval_messages(user_prompt, augment_text(found.get("augment", []))), max_tokens=500
+                )
+                raw_data_content["llm_response"] = response.choices[0].message.content.strip()
+                if found.get("augment"):
+                    raw_data_content["context_from"] = hit_refs(found["augment"])
+                await asyncio.to_thread(index_retrieval, prompt_id, user_prompt, raw_data_content["llm_response"], user_id)
+            except Exception as e:
+                log.warning(f"OpenAI call failed for prompt_id {prompt_id}: {e}")
+                raw_data_content["error"] = f"OpenAI call failed: {str(e)}"
+                raw_data_content["placeholder_data"] = f"Simulated search data for '{user_prompt}'. Actual web search would go here."
+        else:
+            log.warning(f"OpenAI API key not configured. Using placeholder data for prompt_id {prompt_id}.")
+            raw_data_content["placeholder_data"] = f"Simulated search data for '{user_prompt}' (OpenAI API key not configured). Actual web search would go here."
+
+        result_columns = await asyncio.to_thread(raw_data_columns, json.dumps(raw_data_content))
+        outcome = await _advance_prompt(prompt_id, "retrieval_complete", result=result_columns, new_result=True)
+        result_id = outcome["result_id"]
+        return {
+            "prompt_id": prompt_id,
+            "status": "retrieval_complete",
+            "result_id": result_id,
+            "raw_data": raw_data_content,
+            "user_id": user_id,
+            "timings_ms": {"retrieval": round((time.monotonic() - started) * 1000, 1)},
+        }
+
+    except Exception as e:
+        _retry_or_none("retrieval", retries, e)
+        log.error(f"Error in information_retrieval_task for prompt_id {prompt_id}: {e}")
+        try:
+            await _set_prompt_status(prompt_id, "retrieval_error")
+        except Exception as db_error:
+            log.error(f"Failed to update prompt status to retrieval_error for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "retrieval_error", "error": str(e)}
+
+
+async def summarize(prompt_id, agent_id: int, retries: int = 0) -> dict:
+    retrieval_output = prompt_id if isinstance(prompt_id, dict) else None
+    if retrieval_output is not None:
+        prompt_id = retrieval_output["prompt_id"]
+        if retrieval_output.get("error"):
+            return retrieval_output
+    started = time.monotonic()
+
+    db = await get_async_supabase_client()
+    agent_config = await asyncio.to_thread(get_agent_config, agent_id)
+
+    if not OPENAI_API_KEY_FROM_ENV:
+        log.warning("OPENAI_API_KEY not found. Summarization features will be limited.")
+        await _set_prompt_status(prompt_id, "summary_error_config")
+        return {"prompt_id": prompt_id, "status": "summary_error_config", "error": "OpenAI API key not configured"}
+
+    try:
+        await _advance_prompt(prompt_id, "processing_summary")
+
+        if retrieval_output is not None and retrieval_output.get("result_id") is not None:
+            result_id = retrieval_output["result_id"]
+            raw_data_json = json.dumps(retrieval_output["raw_data"])
+        else:
+            result_response = await db.table("results").select(RAW_DATA_SELECT).eq("prompt_id", prompt_id).order("created_at", desc=True).limit(1).execute()
+            if not result_response.data:
+                raise Exception(f"No raw data found in 'results' table for prompt_id: {prompt_id}")
+            result_id = result_response.data[0]["id"]
+            raw_data_json = await asyncio.to_thread(stored_raw_data, result_response.data[0])
+        text_to_summarize = content_to_summarize(raw_data_json)
+
+        try:
+            summary_messages = [
+                {"role": agent_config["role"], "content": agent_config["content"]},
+                {"role": "user", "content": render_summarization_prompt(agent_config, text_to_summarize)}
+            ]
+            aclient = get_async_openai(OPENAI_API_KEY_FROM_ENV)
+            if LLM_STREAMING:
+                response = await astreamed_chat_completion(aclient, prompt_id, "summary", model="gpt-3.5-turbo",
+                                                           messages=summary_messages, max_tokens=700,
+                                                           use_cache=agent_cache_enabled(agent_id))
+            else:
+                response = await acached_chat_completion(aclient, model="gpt-3.5-turbo", messages=summary_messages,
+                                                         max_tokens=700, use_cache=agent_cache_enabled(agent_id))
+            summary_text, processed_options_str = parse_summary_output(prompt_id, response.choices[0].message.content.strip())
+        except Exception as e:
+            log.warning(f"OpenAI call for summarization failed for prompt_id {prompt_id}: {e}")
+            summary_text = f"Error during AI summarization: {str(e)}"
+            processed_options_str = json.dumps([f"Error during AI summarization: {str(e)}"])
+
+        await _advance_prompt(prompt_id, "completed", result={"processed_options": processed_options_str, "summary": summary_text},
+                              result_id=result_id, summary=summary_text, processed_options=processed_options_str)
+
+        timings = dict(retrieval_output.get("timings_ms", {})) if retrieval_output else {}
+        timings["summary"] = round((time.monotonic() - started) * 1000, 1)
+        return {
+            "prompt_id": prompt_id,
+            "status": "completed",
+            "result_id": result_id,
+            "summary": summary_text,
+            "processed_options": processed_options_str,
+            "timings_ms": timings,
+        }
+
+    except Exception as e:
+        _retry_or_none("summary", retries, e)
+        log.error(f"Error in process_and_summarize_task for prompt_id {prompt_id}: {e}")
+        try:
+            await _set_prompt_status(prompt_id, "summary_error")
+        except Exception as db_error:
+            log.error(f"Failed to update prompt status to summary_error for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "summary_error", "error": str(e)}
+
+
+async def mcp(prompt_id, urls: list[str], bypass_cache: bool = False, retries: int = 0) -> dict:
+    retrieval_output = prompt_id if isinstance(prompt_id, dict) else None
+    in_pipeline = retrieval_output is not None
+    if in_pipeline:
+        prompt_id = retrieval_output["prompt_id"]
+        if retrieval_output.get("error"):
+            return retrieval_output
+    started = time.monotonic()
+
+    await get_async_supabase_client()
+
+    async def set_mcp_status(status: str, **fields):
+        if in_pipeline:
+            await asyncio.to_thread(publish_stage, prompt_id, "mcp", status, **fields)
+        else:
+            await _set_prompt_status(prompt_id, status, **fields)
+
+    if not OPENAI_API_KEY_FROM_ENV:
+        log.warning(f"OPENAI_API_KEY not found. MCP task for prompt_id {prompt_id} will be limited.")
+        try:
+            await set_mcp_status("mcp_error_config")
+        except Exception as db_error:
+            log.error(f"Failed to update prompt status to mcp_error_config for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "mcp_error_config", "error": "OpenAI API key not configured"}
+
+    try:
+        await set_mcp_status("processing_mcp")
+    except Exception as db_error:
+        log.error(f"Failed to update prompt status to processing_mcp for prompt_id {prompt_id}: {db_error}")
+
+    try:
+        fetchable_urls = [url for url in urls if not ("youtube.com/" in url or "youtu.be/" in url)]
+        if bypass_cache:
+            cached_pages = {}
+            await asyncio.to_thread(record_bypass, len(fetchable_urls))
+        else:
+            cached_pages = await asyncio.to_thread(lookup_pages, fetchable_urls)
+        urls_to_fetch = [url for url in fetchable_urls if not (url in cached_pages and cached_pages[url]["fresh"])]
+        revalidation_headers = {url: conditional_headers(cached_pages[url]) for url in urls_to_fetch if url in cached_pages}
+        fetched = dict(zip(urls_to_fetch, await afetch_urls(urls_to_fetch, request_headers=revalidation_headers,
+                                                            parser_factory=StreamingExtractor)))
+        notes = fetch_notes(fetched)
+        if notes:
+            log.info(f"Sources truncated or skipped for prompt_id {prompt_id}: {notes}")
+
+        all_extracted_text = await asyncio.gather(*(
+            asyncio.to_thread(source_text, url, cached_pages.get(url), fetched.get(url), bypass_cache) for url in urls
+        ))
+        texts_to_summarize, dedup_stats = await asyncio.to_thread(dedup_sources, urls, list(all_extracted_text))
+        notes = add_dedup_notes(notes, dedup_stats)
+        combined_text = "\n\n--- Next Source ---\n\n".join(texts_to_summarize)
+        await asyncio.to_thread(index_sources, prompt_id, urls, list(all_extracted_text),
+                                retrieval_output.get("user_id") if in_pipeline else None)
+        log.info(f"Combined text length: {len(combined_text)}")
+
+        if not combined_text.strip():
+            mcp_summary_text = "No content was extracted from the provided URLs to summarize."
+        else:
+            try:
+                mcp_summary_text, summary_stats = await asummarize_sources(
+                    get_async_openai(OPENAI_API_KEY_FROM_ENV), combined_text,
+                    stream_prompt_id=prompt_id if LLM_STREAMING else None
+                )
+                log.info(f"MCP summarization stats for prompt_id {prompt_id}: {summary_stats}")
+            except Exception as e:
+                log.warning(f"OpenAI call for MCP summarization failed for prompt_id {prompt_id}: {e}")
+                mcp_summary_text = f"Error during AI summarization for MCP task: {str(e)}"
+
+        try:
+            result_columns = await asyncio.to_thread(mcp_result_columns, mcp_summary_text, urls, list(all_extracted_text), notes)
+            outcome = await acommit_stage(prompt_id, None if in_pipeline else "mcp_complete", result=result_columns,
+                                          result_id=retrieval_output.get("result_id") if in_pipeline else None)
+            if not outcome["applied"]:
+                raise StageConflict(prompt_id, "mcp_complete", outcome["status"])
+            result_id_to_update = outcome["result_id"]
+            log.info(f"MCP results stored successfully for result_id: {result_id_to_update}")
+        except StageConflict:
+            raise
+        except Exception as e:
+            log.error(f"Error storing MCP results for prompt_id {prompt_id}: {e}")
+            await set_mcp_status("mcp_error_storage")
+            raise
+
+        if in_pipeline:
+            await asyncio.to_thread(publish_stage, prompt_id, "mcp", "mcp_complete", mcp_data=mcp_summary_text)
+        else:
+            await asyncio.to_thread(publish_status, prompt_id, "mcp_complete", mcp_data=mcp_summary_text)
+        timings = dict(retrieval_output.get("timings_ms", {})) if in_pipeline else {}
+        timings["mcp"] = round((time.monotonic() - started) * 1000, 1)
+        return {
+            "prompt_id": prompt_id,
+            "status": "mcp_complete",
+            "result_id": result_id_to_update,
+            "mcp_data": mcp_summary_text,
+            "source_notes": notes,
+            "dedup": dedup_summary(prompt_id, dedup_stats),
+            "timings_ms": timings,
+        }
+
+    except Exception as e:
+        _retry_or_none("mcp", retries, e)
+        log.error(f"Error in mcp_task for prompt_id {prompt_id}: {e}")
+        if in_pipeline:
+            await set_mcp_status("mcp_error", error=str(e))
+        else:
+            try:
+                await set_mcp_status("mcp_error") # only from 'processing_mcp', so storage/config errors are kept
+            except Exception as db_error:
+                log.error(f"Failed to update prompt status to mcp_error for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "mcp_error", "error": str(e)}
+
+
+STAGES = {"retrieval": retrieval, "summary": summarize, "mcp": mcp}
+
+
+def run_stage(task, stage: str, *args, **kwargs) -> dict:
+    """Run a stage coroutine on the process loop from a Celery task thread, retrying via the task."""
+    try:
+        return run(STAGES[stage](*args, retries=task.request.retries, **kwargs))
+    except RetryStage as r:
+        log.warning(f"Retrying {task.name} in {r.countdown}s: {r.error}")
+        raise task.retry(exc=r.error, countdown=r.countdown, max_retries=STAGE_RETRY_POLICIES[stage]["max_retries"])
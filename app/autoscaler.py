@@ -0,0 +1,36 @@
+import time
+
+from celery.worker.autoscale import Autoscaler
+
+from app.instrumentation import get_logger
+from app.queues import AUTOSCALE_CHECK_INTERVAL, WORKER_QUEUES, desired_concurrency
+
+log = get_logger(__name__)
+
+# Kept apart from app/queues.py, which the web tier imports for routing and
+# priorities, so that only workers load celery.worker.
+
+
+class QueueDepthAutoscaler(Autoscaler):
+    """
+    Celery autoscaler that also counts messages still waiting in the broker,
+    not just those this worker has reserved. Enabled with --autoscale=max,min
+    (see worker_autoscaler in app/celery_app.py).
+    """
+
+    _checked_at = 0.0
+    _desired = 0
+
+    @property
+    def qty(self):
+        reserved = super().qty
+        now = time.monotonic()
+        if now - self._checked_at >= AUTOSCALE_CHECK_INTERVAL:
+            self._checked_at = now
+            try:
+                queues = list(self.worker.app.amqp.queues.consume_from) if self.worker else WORKER_QUEUES
+                self._desired = desired_concurrency(queues, self.processes, self.min_concurrency, self.max_concurrency)
+            except Exception as e:
+                log.warning(f"Queue depth check failed; scaling on reserved tasks only: {e}")
+                self._desired = 0
+        return max(reserved, self._desired)
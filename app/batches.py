@@ -0,0 +1,345 @@
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from celery import group
+
+from app import fair_share
+from app.dispatch import send
+from app.fair_share import FAIR_SHARE_ENABLED
+from app.idempotency import DISPATCH_PREFIX, claim_dispatch
+from app.instrumentation import get_logger, inc
+from app.pipeline import DEFAULT_AGENT_ID, build_pipeline
+from app.progress import publish_status
+from app.queues import PRIORITIES, queue_depth
+from app.utils import get_redis_client, get_supabase_client
+
+log = get_logger(__name__)
+
+# Bulk submission: many prompts under one batch id. Prompts are inserted in
+# multi-row writes of BATCH_INSERT_SIZE and queued in Redis; at most
+# max_in_flight of a batch's pipelines are dispatched at a time, each refill
+# as one Celery group. Every finished pipeline frees its slot and dispatches
+# the next prompts (pipeline_complete_task -> finish_batch_prompt), so a batch
+# of thousands never floods the broker and interactive prompts keep going
+# ahead of it (batches run at 'bulk' priority by default). With fair-share
+# scheduling, refills go to the submitting user's queue (app.fair_share)
+# rather than straight to Celery.
+BATCH_INSERT_SIZE = int(os.getenv("BATCH_INSERT_SIZE", "100"))
+BATCH_MAX_IN_FLIGHT = int(os.getenv("BATCH_MAX_IN_FLIGHT", "20"))
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "5000"))
+# The web UI has no sign-in, so its batches are capped much lower than
+# authenticated ones (POST /batches with an access token, or the CLI).
+BATCH_UI_MAX_PROMPTS = int(os.getenv("BATCH_UI_MAX_PROMPTS", "50"))
+# Refills wait while this many messages are already queued for retrieval.
+BATCH_MAX_QUEUE_DEPTH = int(os.getenv("BATCH_MAX_QUEUE_DEPTH", "200"))
+BATCH_RETRY_DELAY = float(os.getenv("BATCH_RETRY_DELAY", "10"))
+# A dispatched prompt with no outcome after this long counts as failed and frees its slot.
+BATCH_SLOT_TIMEOUT = int(os.getenv("BATCH_SLOT_TIMEOUT", "1800"))
+BATCH_TTL = int(os.getenv("BATCH_TTL", str(7 * 86400)))
+
+BATCH_PREFIX = "tia:batch:"
+
+# Atomically move up to (limit - running) queued prompts into the running set.
+_TAKE_SCRIPT = """
+local free = tonumber(ARGV[1]) - redis.call('hlen', KEYS[2])
+local taken = {}
+while free > 0 do
+    local item = redis.call('lpop', KEYS[1])
+    if not item then break end
+    redis.call('hset', KEYS[2], cjson.decode(item)['prompt_id'], ARGV[2])
+    table.insert(taken, item)
+    free = free - 1
+end
+return taken
+"""
+
+
+def _keys(batch_id: str) -> dict:
+    base = BATCH_PREFIX + batch_id
+    # meta: counters and settings; queued: prompts not yet dispatched (JSON, FIFO);
+    # running: prompt_id -> dispatch time; outcomes: prompt_id -> final status
+    return {"meta": base, "queued": base + ":queued", "running": base + ":running", "outcomes": base + ":outcomes"}
+
+
+def parse_prompt_lines(lines) -> list[dict]:
+    """
+    Prompts for a batch from text lines: JSONL objects ({"prompt": ..., "urls": [...]}),
+    JSON strings, or plain text (one prompt per line). Blank lines are skipped.
+    """
+    items = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] in "{\"":
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                entry = line
+        else:
+            entry = line
+        if isinstance(entry, str):
+            entry = {"prompt": entry}
+        items.append(entry)
+    return items
+
+
+def _normalize(items: list) -> list[dict]:
+    prompts = []
+    for i, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"prompt": item}
+        text = (item.get("prompt") or item.get("prompt_text") or "").strip()
+        if not text:
+            raise ValueError(f"Prompt {i + 1} of the batch is empty")
+        urls = item.get("urls") or []
+        if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+            raise ValueError(f"Prompt {i + 1} of the batch: 'urls' must be a list of strings")
+        prompts.append({"prompt": text, "urls": [u.strip() for u in urls if u.strip()]})
+    return prompts
+
+
+def submit_batch(items: list, agent_id: int = DEFAULT_AGENT_ID, priority: str = "bulk",
+                 max_in_flight: int = BATCH_MAX_IN_FLIGHT, user_id: str | None = None,
+                 max_prompts: int = BATCH_MAX_PROMPTS) -> dict:
+    """
+    Insert prompts ({"prompt", "urls"} dicts or strings) and start running them
+    as one batch. Dispatch starts after the first insert chunk, while the rest
+    are still being written. Returns {"batch_id", "prompt_ids"}.
+    """
+    prompts = _normalize(items)
+    if not prompts:
+        raise ValueError("The batch has no prompts")
+    if len(prompts) > max_prompts:
+        raise ValueError(f"The batch has {len(prompts)} prompts; the limit is {max_prompts}")
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{priority}'; expected one of {', '.join(PRIORITIES)}")
+
+    batch_id = uuid.uuid4().hex[:12]
+    keys = _keys(batch_id)
+    r = get_redis_client()
+    r.hset(keys["meta"], mapping={
+        "total": len(prompts), "inserted": 0, "completed": 0, "failed": 0, "agent_id": agent_id,
+        "priority": priority, "max_in_flight": max(1, max_in_flight), "created_at": time.time(),
+        "user_id": user_id or "",
+    })
+    r.expire(keys["meta"], BATCH_TTL)
+
+    supabase = get_supabase_client()
+    prompt_ids = []
+    try:
+        for start in range(0, len(prompts), BATCH_INSERT_SIZE):
+            chunk = prompts[start:start + BATCH_INSERT_SIZE]
+            created_at = datetime.now().isoformat()
+            response = supabase.table("prompts").insert([
+                {"prompt_text": p["prompt"], "status": "pending_retrieval", "created_at": created_at, "user_id": user_id}
+                for p in chunk
+            ]).execute()
+            ids = [row["id"] for row in response.data or []]
+            if len(ids) != len(chunk):
+                raise RuntimeError(f"Batch {batch_id}: inserted {len(ids)} of {len(chunk)} prompts")
+            prompt_ids.extend(ids)
+
+            pipe = r.pipeline(transaction=False)
+            pipe.rpush(keys["queued"], *[json.dumps({"prompt_id": pid, **p}) for pid, p in zip(ids, chunk)])
+            pipe.hincrby(keys["meta"], "inserted", len(ids))
+            for key in keys.values():
+                pipe.expire(key, BATCH_TTL)
+            pipe.execute()
+            dispatch_batch(batch_id)
+    except Exception:
+        # The prompts inserted so far still run; the batch is done when they are.
+        r.hset(keys["meta"], "total", len(prompt_ids))
+        raise
+
+    log.info(f"Batch {batch_id}: {len(prompt_ids)} prompts submitted (priority {priority}, up to {max_in_flight} in flight)")
+    return {"batch_id": batch_id, "prompt_ids": prompt_ids}
+
+
+def _reclaim_lost(batch_id: str) -> int:
+    """Count prompts dispatched more than BATCH_SLOT_TIMEOUT ago with no outcome as failed, freeing their slots."""
+    keys = _keys(batch_id)
+    r = get_redis_client()
+    cutoff = time.time() - BATCH_SLOT_TIMEOUT
+    lost = 0
+    for prompt_id, dispatched_at in r.hgetall(keys["running"]).items():
+        if float(dispatched_at) < cutoff and r.hdel(keys["running"], prompt_id):
+            r.hset(keys["outcomes"], prompt_id, "lost")
+            r.hincrby(keys["meta"], "failed", 1)
+            inc("tia_batch_prompts_total", outcome="lost")
+            lost += 1
+    if lost:
+        log.warning(f"Batch {batch_id}: {lost} prompts got no outcome within {BATCH_SLOT_TIMEOUT}s; counted as failed")
+    return lost
+
+
+def _retry_later(batch_id: str):
+    send("batch_dispatch", {"batch_id": batch_id}, countdown=BATCH_RETRY_DELAY)
+
+
+def dispatch_batch(batch_id: str) -> int:
+    """
+    Dispatch queued prompts of the batch into free in-flight slots, as one
+    Celery group. Safe to call from several processes at once. Returns the
+    number of pipelines dispatched.
+    """
+    keys = _keys(batch_id)
+    r = get_redis_client()
+    meta = {k.decode("utf-8"): v.decode("utf-8") for k, v in r.hgetall(keys["meta"]).items()}
+    if not meta:
+        log.warning(f"Batch {batch_id} not found (expired or never submitted)")
+        return 0
+    _reclaim_lost(batch_id)
+
+    # Backpressure: leave the queue alone while it is already deep. Running
+    # prompts trigger the next refill when they finish; without any, check back later.
+    if queue_depth("retrieval")["depth"] >= BATCH_MAX_QUEUE_DEPTH:
+        if not r.hlen(keys["running"]) and r.llen(keys["queued"]):
+            _retry_later(batch_id)
+        return 0
+
+    taken = [json.loads(item) for item in r.eval(_TAKE_SCRIPT, 2, keys["queued"], keys["running"], meta["max_in_flight"], time.time())]
+    if not taken:
+        return 0
+
+    dispatched = []
+    for item in taken:
+        if not claim_dispatch(item["prompt_id"], "pipeline"):
+            r.hdel(keys["running"], item["prompt_id"]) # already running outside this batch
+            continue
+        publish_status(item["prompt_id"], "pending_retrieval", pipeline=True, batch_id=batch_id)
+        dispatched.append(item)
+    if not dispatched:
+        return 0
+    if FAIR_SHARE_ENABLED:
+        fair_share.enqueue([
+            {"prompt_id": item["prompt_id"], "prompt": item["prompt"], "agent_id": int(meta["agent_id"]), "urls": item["urls"],
+             "priority": meta["priority"], "task_id": str(uuid.uuid4()), "user": meta.get("user_id"), "batch_id": batch_id}
+            for item in dispatched
+        ])
+        inc("tia_batch_prompts_total", len(dispatched), outcome="dispatched")
+        log.info(f"Batch {batch_id}: queued {len(dispatched)} prompts for fair-share dispatch")
+        fair_share.dispatch()
+        return len(dispatched)
+    pipelines = [build_pipeline(item["prompt_id"], item["prompt"], int(meta["agent_id"]), item["urls"],
+                                meta["priority"], batch_id=batch_id, user_id=meta.get("user_id") or None)
+                 for item in dispatched]
+    try:
+        group(pipelines).apply_async()
+    except Exception as e:
+        # Put them back at the front of the queue; a later refill picks them up again.
+        log.warning(f"Batch {batch_id}: dispatching {len(pipelines)} prompts failed, will retry: {e}")
+        pipe = r.pipeline(transaction=False)
+        for item in reversed(dispatched):
+            pipe.lpush(keys["queued"], json.dumps(item))
+            pipe.hdel(keys["running"], item["prompt_id"])
+            pipe.delete(f"{DISPATCH_PREFIX}{item['prompt_id']}:pipeline")
+        pipe.execute()
+        _retry_later(batch_id)
+        return 0
+    inc("tia_batch_prompts_total", len(pipelines), outcome="dispatched")
+    log.info(f"Batch {batch_id}: dispatched {len(pipelines)} prompts")
+    return len(pipelines)
+
+
+def finish_batch_prompt(batch_id: str, prompt_id: int, status: str):
+    """Record a batch prompt's final status, free its slot and dispatch the next queued prompts."""
+    keys = _keys(batch_id)
+    try:
+        r = get_redis_client()
+        if r.hdel(keys["running"], prompt_id): # 0 if already counted (duplicate or reclaimed)
+            outcome = "completed" if status == "completed" else "failed"
+            pipe = r.pipeline(transaction=False)
+            pipe.hset(keys["outcomes"], prompt_id, status)
+            pipe.hincrby(keys["meta"], outcome, 1)
+            pipe.execute()
+            inc("tia_batch_prompts_total", outcome=outcome)
+        dispatch_batch(batch_id)
+    except Exception as e:
+        log.warning(f"Batch {batch_id}: failed to record the outcome of prompt_id {prompt_id}: {e}")
+
+
+def get_batch_progress(batch_id: str) -> dict | None:
+    """Counts of queued, running, completed and failed prompts of a batch, and the failed prompt ids; None if unknown."""
+    keys = _keys(batch_id)
+    r = get_redis_client()
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(keys["meta"])
+    pipe.llen(keys["queued"])
+    pipe.hlen(keys["running"])
+    pipe.hgetall(keys["outcomes"])
+    meta, queued, running, outcomes = pipe.execute()
+    if not meta:
+        return None
+    meta = {k.decode("utf-8"): v.decode("utf-8") for k, v in meta.items()}
+    total, completed, failed = int(meta["total"]), int(meta["completed"]), int(meta["failed"])
+    return {
+        "batch_id": batch_id,
+        "total": total,
+        "inserted": int(meta["inserted"]),
+        "queued": queued,
+        "running": running,
+        "completed": completed,
+        "failed": failed,
+        "done": completed + failed >= total,
+        "priority": meta["priority"],
+        "max_in_flight": int(meta["max_in_flight"]),
+        "user_id": meta.get("user_id") or None,
+        "elapsed_s": round(time.time() - float(meta["created_at"]), 1),
+        "failed_prompts": {int(k): v.decode("utf-8") for k, v in outcomes.items() if v.decode("utf-8") != "completed"},
+    }
+
+
+def _print_progress(progress: dict):
+    print(f"batch {progress['batch_id']}: {progress['completed']} completed, {progress['failed']} failed, "
+          f"{progress['running']} running, {progress['queued']} queued of {progress['total']} ({progress['elapsed_s']}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.batches", description="Submit and follow prompt batches.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    submit = commands.add_parser("submit", help="submit prompts from a file (JSONL or one prompt per line; '-' for stdin)")
+    submit.add_argument("file")
+    submit.add_argument("--agent-id", type=int, default=DEFAULT_AGENT_ID)
+    submit.add_argument("--priority", choices=list(PRIORITIES), default="bulk")
+    submit.add_argument("--max-in-flight", type=int, default=BATCH_MAX_IN_FLIGHT)
+    submit.add_argument("--user-id", help="Supabase Auth user id the batch runs as: stored on its prompts, and its fair-share quota")
+    submit.add_argument("--wait", action="store_true", help="follow progress until the batch is done")
+    status = commands.add_parser("status", help="show a batch's progress")
+    status.add_argument("batch_id")
+    status.add_argument("--wait", action="store_true", help="follow progress until the batch is done")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        if args.file == "-":
+            items = parse_prompt_lines(sys.stdin)
+        else:
+            with open(args.file) as f:
+                items = parse_prompt_lines(f)
+        batch_id = submit_batch(items, args.agent_id, args.priority, args.max_in_flight, args.user_id)["batch_id"]
+        print(batch_id)
+    else:
+        batch_id = args.batch_id
+
+    progress = get_batch_progress(batch_id)
+    if progress is None:
+        raise SystemExit(f"Batch {batch_id} not found")
+    if not args.wait:
+        if args.command == "status":
+            json.dump(progress, sys.stdout, indent=2)
+            print()
+        return
+    _print_progress(progress)
+    while not progress["done"]:
+        time.sleep(2)
+        progress = get_batch_progress(batch_id) or progress
+        _print_progress(progress)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import base64
+import hashlib
+import os
+import threading
+import zlib
+
+from app.instrumentation import get_logger
+from app.utils import get_redis_client, get_supabase_client
+
+try:
+    import zstandard
+except ImportError: # Optional: fall back to zlib
+    zstandard = None
+
+log = get_logger(__name__)
+
+# Content-addressed storage for large payloads: retrieval raw_data and the
+# extracted text of MCP sources. Each body is stored once under the SHA-256 of
+# its uncompressed bytes, and results rows keep only the reference
+# ("sha256:<hex>"), so identical content across prompts is stored and uploaded
+# once.
+#   supabase - 'blobs' table (supabase/migrations/*_blob_store.sql), shared by all workers
+#   local    - files under BLOB_DIR (single host, or a shared volume)
+#   off      - keep payloads inline in 'results' as before
+BLOB_STORE = os.getenv("BLOB_STORE", "supabase").lower()
+BLOB_DIR = os.getenv("BLOB_DIR", "/app/blobs")
+# Bodies at least this large are compressed (zstd if installed, else zlib);
+# smaller ones gain little and cost a decompression on every read.
+BLOB_COMPRESS_MIN_BYTES = int(os.getenv("BLOB_COMPRESS_MIN_BYTES", "512"))
+BLOB_ZSTD_LEVEL = int(os.getenv("BLOB_ZSTD_LEVEL", "10"))
+BLOB_KNOWN_CACHE_SIZE = int(os.getenv("BLOB_KNOWN_CACHE_SIZE", "10000"))
+
+STATS_KEY = "tia:blob:stats"
+_CODEC_SUFFIX = {"zstd": ".zst", "zlib": ".zz", "none": ".raw"}
+
+# Hashes this process has already seen stored, so repeat content skips even the existence check.
+_known: dict[str, None] = {}
+_known_lock = threading.Lock()
+
+
+def blob_ref(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def compress(data: bytes) -> tuple[str, bytes]:
+    """(codec, stored bytes) for a body; small or incompressible bodies are stored as-is."""
+    if len(data) < BLOB_COMPRESS_MIN_BYTES:
+        return "none", data
+    if zstandard is not None:
+        codec, packed = "zstd", zstandard.ZstdCompressor(level=BLOB_ZSTD_LEVEL).compress(data)
+    else:
+        codec, packed = "zlib", zlib.compress(data, 6)
+    return (codec, packed) if len(packed) < len(data) else ("none", data)
+
+
+def decompress(codec: str, payload: bytes) -> bytes:
+    if codec == "none":
+        return payload
+    if codec == "zlib":
+        return zlib.decompress(payload)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Blob is zstd-compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown blob codec: {codec}")
+
+
+class StoredBlob:
+    """A fetched blob, still compressed; decompressed on first access to .data or .text()."""
+
+    def __init__(self, ref: str, codec: str, payload: bytes):
+        self.ref = ref
+        self.codec = codec
+        self.payload = payload
+        self._data: bytes | None = None
+
+    @property
+    def data(self) -> bytes:
+        if self._data is None:
+            self._data = decompress(self.codec, self.payload)
+        return self._data
+
+    def text(self) -> str:
+        return self.data.decode("utf-8")
+
+
+def _remember(refs):
+    with _known_lock:
+        for ref in refs:
+            _known[ref] = None
+        while len(_known) > BLOB_KNOWN_CACHE_SIZE:
+            _known.pop(next(iter(_known)))
+
+
+def _local_path(ref: str, codec: str) -> str:
+    digest = ref.split(":", 1)[1]
+    return os.path.join(BLOB_DIR, digest[:2], digest + _CODEC_SUFFIX[codec])
+
+
+def _existing(refs: list[str]) -> set[str]:
+    if BLOB_STORE == "local":
+        return {ref for ref in refs if any(os.path.exists(_local_path(ref, codec)) for codec in _CODEC_SUFFIX)}
+    response = get_supabase_client().table("blobs").select("hash").in_("hash", refs).execute()
+    return {row["hash"] for row in response.data or []}
+
+
+def _write(rows: list[dict]):
+    if BLOB_STORE == "local":
+        for row in rows:
+            path = _local_path(row["hash"], row["codec"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(row["payload"])
+            os.replace(tmp, path) # atomic, so readers never see a partial blob
+        return
+    get_supabase_client().table("blobs").upsert([
+        {"hash": row["hash"], "codec": row["codec"], "size": row["size"], "stored_size": len(row["payload"]),
+         "data": base64.b64encode(row["payload"]).decode("ascii")}
+        for row in rows
+    ], on_conflict="hash", ignore_duplicates=True).execute()
+
+
+def put_blobs(bodies: list[bytes | str]) -> list[str]:
+    """
+    Store bodies (deduplicated by content hash, compressed above
+    BLOB_COMPRESS_MIN_BYTES) and return their refs, in input order. Content
+    already in the store is neither compressed nor uploaded again.
+    """
+    datas = [b.encode("utf-8") if isinstance(b, str) else b for b in bodies]
+    refs = [blob_ref(d) for d in datas]
+    unique = dict(zip(refs, datas))
+    with _known_lock:
+        candidates = [ref for ref in unique if ref not in _known]
+    missing = set(candidates) - _existing(candidates) if candidates else set()
+
+    rows = []
+    for ref in missing:
+        codec, payload = compress(unique[ref])
+        rows.append({"hash": ref, "codec": codec, "size": len(unique[ref]), "payload": payload})
+    if rows:
+        _write(rows)
+    _remember(unique)
+
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, "puts", len(datas))
+        pipe.hincrby(STATS_KEY, "dedup_hits", len(datas) - len(rows))
+        pipe.hincrby(STATS_KEY, "bytes_in", sum(len(d) for d in datas))
+        pipe.hincrby(STATS_KEY, "bytes_new", sum(row["size"] for row in rows))
+        pipe.hincrby(STATS_KEY, "bytes_stored", sum(len(row["payload"]) for row in rows))
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Blob store stats update failed: {e}")
+    return refs
+
+
+def put_blob(body: bytes | str) -> str:
+    return put_blobs([body])[0]
+
+
+def get_blobs(refs: list[str]) -> dict[str, StoredBlob]:
+    """Fetch blobs by ref in one round trip; bodies are decompressed lazily. Missing refs are left out."""
+    refs = list(dict.fromkeys(refs))
+    if not refs:
+        return {}
+    found = {}
+    if BLOB_STORE == "local":
+        for ref in refs:
+            for codec in _CODEC_SUFFIX:
+                path = _local_path(ref, codec)
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        found[ref] = StoredBlob(ref, codec, f.read())
+                    break
+    else:
+        response = get_supabase_client().table("blobs").select("hash, codec, data").in_("hash", refs).execute()
+        for row in response.data or []:
+            found[row["hash"]] = StoredBlob(row["hash"], row["codec"], base64.b64decode(row["data"]))
+    _remember(found)
+    return found
+
+
+def get_blob(ref: str) -> StoredBlob:
+    blob = get_blobs([ref]).get(ref)
+    if blob is None:
+        raise KeyError(f"Blob {ref} not found in the {BLOB_STORE} blob store")
+    return blob
+
+
+def store_payload(body: str) -> str | None:
+    """Store a payload for a results row; None when the blob store is off or unavailable (keep it inline)."""
+    if BLOB_STORE == "off":
+        return None
+    try:
+        return put_blob(body)
+    except Exception as e:
+        log.warning(f"Blob store unavailable, keeping payload inline: {e}")
+        return None
+
+
+def store_sources(urls: list[str], texts: list[str], notes: dict[str, dict] | None = None) -> list[dict] | None:
+    """
+    Store each source's extracted text; returns [{url, ref, chars}] for
+    results.source_refs, or None. Fetch notes for a URL (truncated/skipped,
+    see app.tasks.fetch_notes) are added to its entry.
+    """
+    if BLOB_STORE == "off" or not urls:
+        return None
+    try:
+        refs = put_blobs(texts)
+    except Exception as e:
+        log.warning(f"Blob store unavailable, not keeping source text: {e}")
+        return None
+    notes = notes or {}
+    return [{"url": url, "ref": ref, "chars": len(text), **notes.get(url, {})} for url, ref, text in zip(urls, refs, texts)]
+
+
+def get_blob_stats() -> dict:
+    """Dedup hits, bytes offered/stored, compression ratio and bytes saved since the counters were reset."""
+    try:
+        stats = {k.decode("utf-8"): int(v) for k, v in get_redis_client().hgetall(STATS_KEY).items()}
+    except Exception as e:
+        log.warning(f"Blob store stats unavailable: {e}")
+        return {}
+    bytes_new, bytes_stored = stats.get("bytes_new", 0), stats.get("bytes_stored", 0)
+    stats["compression_ratio"] = round(bytes_new / bytes_stored, 2) if bytes_stored else None
+    stats["bytes_saved_dedup"] = stats.get("bytes_in", 0) - bytes_new
+    stats["bytes_saved_compression"] = bytes_new - bytes_stored
+    stats["bytes_saved"] = stats.get("bytes_in", 0) - bytes_stored
+    return stats
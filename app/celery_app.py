@@ -1,12 +1,20 @@
 from celery import Celery
+from celery.signals import (before_task_publish, task_postrun, task_prerun, worker_process_init,
+                            worker_process_shutdown, worker_ready)
 from dotenv import load_dotenv
+from kombu import Queue
 load_dotenv()
 import os
+from app.instrumentation import begin_stage, end_stage, flush, get_logger, start_metrics_server
+from app.queues import (DEFAULT_QUEUE, ENQUEUED_AT_HEADER, PRIORITIES, PRIORITY_STEPS, QUEUES, TASK_ROUTES,
+                        TASK_STAGES, WORKER_QUEUES, record_queue_wait, stamp_enqueued_at, worker_settings)
+
+log = get_logger(__name__)
 
 # It's better to read from rxconfig if possible, but for worker context,
 # environment variables are robust.
 REDIS_URL_FROM_ENV = os.getenv("REDIS_", "redis://redis:6379/0")
-print(f"Using Redis URL: {REDIS_URL_FROM_ENV}")
+log.info(f"Using Redis URL: {REDIS_URL_FROM_ENV}")
 
 celery_app = Celery(
     "worker", # Naming the celery application
@@ -23,3 +31,72 @@ celery_app.conf.update(
     timezone="UTC",
     enable_utc=True,
 )
+
+# Queues, routing and priorities (see app/queues.py). Concurrency and prefetch
+# follow the queues this worker consumes; command-line flags still override them.
+_worker_concurrency, _worker_prefetch = worker_settings(WORKER_QUEUES)
+celery_app.conf.update(
+    task_queues=[Queue(name) for name in QUEUES], # a worker without -Q consumes all of them
+    task_routes=TASK_ROUTES,
+    task_default_queue=DEFAULT_QUEUE,
+    task_default_priority=PRIORITIES["default"],
+    broker_transport_options={"priority_steps": PRIORITY_STEPS},
+    worker_concurrency=_worker_concurrency,
+    worker_prefetch_multiplier=_worker_prefetch,
+    worker_autoscaler="app.autoscaler:QueueDepthAutoscaler",
+)
+
+
+@before_task_publish.connect
+def stamp_message(headers=None, **kwargs):
+    if headers is not None:
+        stamp_enqueued_at(headers)
+
+
+@task_prerun.connect
+def record_wait(task=None, **kwargs):
+    request = task.request
+    if request.retries: # a retry's wait includes its countdown
+        return
+    record_queue_wait((request.delivery_info or {}).get("routing_key"), request.get(ENQUEUED_AT_HEADER))
+
+
+@task_prerun.connect
+def start_stage_span(task_id=None, task=None, args=None, kwargs=None, **extra):
+    stage = TASK_STAGES.get(task.name)
+    if stage is not None:
+        begin_stage(task_id, task.name, stage, args, kwargs)
+
+
+@task_postrun.connect
+def finish_stage_span(task_id=None, retval=None, state=None, **kwargs):
+    end_stage(task_id, retval, state) # also flushes this process's metrics to Redis
+
+
+@worker_ready.connect
+def serve_metrics(**kwargs):
+    # Metrics are cluster-wide (aggregated in Redis), so the main worker process serves them all.
+    start_metrics_server()
+
+
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    flush()
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # Open the pooled Supabase client once per prefork child so the first task
+    # doesn't pay for the TLS handshake.
+    from app.agent_config import warm_agent_configs # worker-only; the web tier imports this module too
+    from app.utils import supabase_health_check
+    try:
+        supabase_health_check()
+    except Exception as e:
+        log.warning(f"Supabase client warm-up skipped: {e}")
+        return
+    # Load agent configs so the first summarization in this process skips Supabase too.
+    try:
+        log.info(f"Agent config cache warmed with {warm_agent_configs()} agents")
+    except Exception as e:
+        log.warning(f"Agent config warm-up skipped: {e}")
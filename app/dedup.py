@@ -0,0 +1,157 @@
+import os
+import re
+
+try:
+    import numpy as np
+except ImportError: # Optional: without it only exact duplicates are removed
+    np = None
+
+from app.instrumentation import get_logger, inc, span
+from app.summarizer import count_tokens
+
+log = get_logger(__name__)
+
+# Duplicate paragraph removal across an MCP job's sources, between extraction
+# and summarization. Mirrors, syndicated copies and pages from one site
+# repeat paragraphs and boilerplate that would otherwise cost tokens.
+# Paragraphs are the extracted lines. The first copy of each is kept (so
+# earlier URLs win); later copies are dropped when they are identical after
+# normalization (case, punctuation, whitespace) or, for paragraphs of at
+# least DEDUP_NEAR_MIN_WORDS words, when their estimated Jaccard similarity
+# over DEDUP_SHINGLE_WORDS-word shingles reaches DEDUP_THRESHOLD (MinHash
+# signatures, with LSH banding so each paragraph is compared only with
+# likely matches: linear in the input size).
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+DEDUP_SHINGLE_WORDS = int(os.getenv("DEDUP_SHINGLE_WORDS", "5"))
+# Shorter paragraphs (headings, "Read more") are kept even if repeated.
+DEDUP_MIN_WORDS = int(os.getenv("DEDUP_MIN_WORDS", "4"))
+DEDUP_NEAR_MIN_WORDS = int(os.getenv("DEDUP_NEAR_MIN_WORDS", "12"))
+# Signature length and LSH bands; rows per band = DEDUP_NUM_PERM / DEDUP_BANDS.
+# 128/16 finds pairs above a Jaccard similarity of about 0.7 as candidates.
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "16"))
+# Candidates checked per paragraph (bounds the work on degenerate input).
+DEDUP_MAX_CANDIDATES = int(os.getenv("DEDUP_MAX_CANDIDATES", "32"))
+
+_WORD = re.compile(r"\w+")
+
+if np is not None:
+    # Multiply-shift hash functions h(x) = (a*x + b) mod 2**64 >> 32, one per signature slot.
+    _rng = np.random.default_rng(0x5EED)
+    _A = (_rng.integers(0, 2**63, size=(DEDUP_NUM_PERM, 1), dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+    _B = _rng.integers(0, 2**63, size=(DEDUP_NUM_PERM, 1), dtype=np.uint64)
+
+
+def _signature(words: list[str]):
+    shingles = {" ".join(words[i:i + DEDUP_SHINGLE_WORDS]) for i in range(len(words) - DEDUP_SHINGLE_WORDS + 1)}
+    x = np.fromiter((hash(s) & 0xFFFFFFFF for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((_A * x + _B) >> np.uint64(32)).min(axis=1)
+
+
+class _Index:
+    """Kept paragraphs by exact key and by LSH band, with the source each came from."""
+
+    def __init__(self):
+        self.exact = {}
+        self.bands = [{} for _ in range(DEDUP_BANDS)]
+        self.signatures = []
+        self.sources = []
+        self.rows = DEDUP_NUM_PERM // DEDUP_BANDS
+
+    def find(self, key: str, words: list[str]) -> tuple[int | None, str | None, object]:
+        """(source index of a kept copy, "exact" | "near", signature) for a paragraph."""
+        if key in self.exact:
+            return self.exact[key], "exact", None
+        if np is None or len(words) < max(DEDUP_NEAR_MIN_WORDS, DEDUP_SHINGLE_WORDS):
+            return None, None, None
+        signature = _signature(words)
+        checked = set()
+        for band, buckets in enumerate(self.bands):
+            for candidate in buckets.get(signature[band * self.rows:(band + 1) * self.rows].tobytes(), ()):
+                if candidate in checked:
+                    continue
+                if len(checked) >= DEDUP_MAX_CANDIDATES:
+                    return None, None, signature
+                checked.add(candidate)
+                if np.count_nonzero(self.signatures[candidate] == signature) >= DEDUP_THRESHOLD * DEDUP_NUM_PERM:
+                    return self.sources[candidate], "near", signature
+        return None, None, signature
+
+    def add(self, key: str, source: int, signature):
+        self.exact[key] = source
+        if signature is None:
+            return
+        paragraph = len(self.signatures)
+        self.signatures.append(signature)
+        self.sources.append(source)
+        for band, buckets in enumerate(self.bands):
+            buckets.setdefault(signature[band * self.rows:(band + 1) * self.rows].tobytes(), []).append(paragraph)
+
+
+def _omitted(count: int, urls: list[str]) -> str:
+    return f"[{count} duplicate paragraph{'s' if count > 1 else ''} omitted; see {', '.join(urls)}]"
+
+
+def dedup_sources(urls: list[str], texts: list[str]) -> tuple[list[str], dict]:
+    """
+    Remove repeated paragraphs across sources (in order; urls[i] is texts[i]'s source).
+
+    Returns the texts to summarize and stats: paragraphs seen and removed
+    (exact / near), characters and tokens removed, and per-URL notes
+    {"duplicate_paragraphs": n, "duplicate_of": [urls]} for sources that lost
+    paragraphs. Each run of removed paragraphs is replaced by a one-line
+    marker naming the URL(s) that kept them, so attribution survives.
+    """
+    stats = {"paragraphs": 0, "exact_removed": 0, "near_removed": 0, "chars_removed": 0, "tokens_removed": 0, "sources": {}}
+    if not DEDUP_ENABLED or len(texts) == 0:
+        return list(texts), stats
+
+    with span("parse", "dedup", sources=len(texts)) as fields:
+        index = _Index()
+        removed_lines = []
+        output = []
+        for source, text in enumerate(texts):
+            kept_lines = []
+            run_count, run_urls = 0, []
+            removed_here, duplicate_of = 0, []
+            for line in text.split("\n"):
+                words = _WORD.findall(line.lower())
+                if len(words) < DEDUP_MIN_WORDS:
+                    match = None
+                else:
+                    stats["paragraphs"] += 1
+                    key = " ".join(words)
+                    match, kind, signature = index.find(key, words)
+                    if match is None:
+                        index.add(key, source, signature)
+                if match is None:
+                    if run_count:
+                        kept_lines.append(_omitted(run_count, run_urls))
+                        run_count, run_urls = 0, []
+                    kept_lines.append(line)
+                    continue
+                stats[f"{kind}_removed"] += 1
+                removed_lines.append(line)
+                removed_here += 1
+                run_count += 1
+                if urls[match] not in run_urls:
+                    run_urls.append(urls[match])
+                if urls[match] not in duplicate_of:
+                    duplicate_of.append(urls[match])
+            if run_count:
+                kept_lines.append(_omitted(run_count, run_urls))
+            output.append("\n".join(kept_lines))
+            if removed_here:
+                note = stats["sources"].setdefault(urls[source], {"duplicate_paragraphs": 0, "duplicate_of": []})
+                note["duplicate_paragraphs"] += removed_here
+                note["duplicate_of"] += [url for url in duplicate_of if url not in note["duplicate_of"]]
+
+        if removed_lines:
+            stats["chars_removed"] = sum(len(line) for line in removed_lines)
+            stats["tokens_removed"] = count_tokens("\n".join(removed_lines))
+        fields.update(paragraphs=stats["paragraphs"], removed=len(removed_lines), tokens_removed=stats["tokens_removed"])
+    inc("tia_dedup_paragraphs_total", stats["exact_removed"], kind="exact")
+    inc("tia_dedup_paragraphs_total", stats["near_removed"], kind="near")
+    inc("tia_dedup_tokens_removed_total", stats["tokens_removed"])
+    return output, stats
@@ -0,0 +1,91 @@
+import typing
+from typing import NotRequired, TypedDict
+
+from app.celery_app import celery_app
+
+# Tasks are sent by name with typed payloads, so the web tier (and anything
+# else that only dispatches) never imports app.tasks and, with it, openai,
+# bs4, lxml, requests and the worker's clients. Payloads are checked against
+# these schemas before a message is published; a missing or misspelled field
+# fails in the caller instead of in a worker.
+
+
+class RetrievalPayload(TypedDict):
+    prompt_id: int
+    user_prompt: str
+    user_id: NotRequired[str] # Supabase Auth user; scopes the vector index lookups (app/vector_index.py)
+
+
+class SummaryPayload(TypedDict):
+    agent_id: int
+    prompt_id: NotRequired[int] # in a pipeline, the retrieval output is passed instead
+
+
+class McpPayload(TypedDict):
+    urls: list[str]
+    prompt_id: NotRequired[int] # in a pipeline, the retrieval output is passed instead
+    bypass_cache: NotRequired[bool]
+
+
+class CompletePayload(TypedDict):
+    prompt_id: int
+    started_at: float
+    batch_id: NotRequired[str]
+
+
+class BatchDispatchPayload(TypedDict):
+    batch_id: str
+
+
+class FairShareDispatchPayload(TypedDict):
+    pass
+
+
+# Short name -> (registered task name, payload schema).
+TASKS = {
+    "retrieval": ("app.tasks.information_retrieval_task", RetrievalPayload),
+    "summary": ("app.tasks.process_and_summarize_task", SummaryPayload),
+    "mcp": ("app.tasks.mcp_task", McpPayload),
+    "complete": ("app.tasks.pipeline_complete_task", CompletePayload),
+    "batch_dispatch": ("app.tasks.batch_dispatch_task", BatchDispatchPayload),
+    "fair_share_dispatch": ("app.tasks.fair_share_dispatch_task", FairShareDispatchPayload),
+}
+
+_hints = {task: typing.get_type_hints(schema) for task, (_, schema) in TASKS.items()}
+
+
+def _matches(value, expected) -> bool:
+    origin = typing.get_origin(expected) or expected
+    if expected is float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if origin is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    if origin is list:
+        (item_type,) = typing.get_args(expected) or (object,)
+        return isinstance(value, list) and all(_matches(item, item_type) for item in value)
+    return isinstance(value, origin)
+
+
+def task_name(task: str, payload: dict) -> str:
+    """Registered name of `task` ('retrieval', 'summary', ...), after checking `payload` against its schema."""
+    if task not in TASKS:
+        raise ValueError(f"Unknown task '{task}'; expected one of {', '.join(TASKS)}")
+    name, schema = TASKS[task]
+    missing = schema.__required_keys__ - payload.keys()
+    unknown = payload.keys() - schema.__required_keys__ - schema.__optional_keys__
+    if missing or unknown:
+        raise TypeError(f"{schema.__name__}: missing {sorted(missing)}, unknown {sorted(unknown)}")
+    for key, value in payload.items():
+        if not _matches(value, _hints[task][key]):
+            raise TypeError(f"{schema.__name__}.{key} should be {_hints[task][key]}, got {type(value).__name__}")
+    return name
+
+
+def signature(task: str, payload: dict, **options):
+    """Celery signature for a task by short name, e.g. to build a canvas; options as for apply_async."""
+    return celery_app.signature(task_name(task, payload), kwargs=dict(payload), **options)
+
+
+def send(task: str, payload: dict, **options):
+    """Publish one task by short name; returns its AsyncResult."""
+    return celery_app.send_task(task_name(task, payload), kwargs=dict(payload), **options)
@@ -0,0 +1,209 @@
+import os
+import re
+import time
+
+from bs4 import BeautifulSoup
+
+from app.instrumentation import get_logger, record_span, span
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError: # Optional fast backend
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError: # Optional fast backend
+    LexborHTMLParser = None
+
+# Text extraction backend for mcp_task: "lxml", "selectolax" or "bs4".
+# Unavailable backends fall back to BeautifulSoup, the original implementation.
+HTML_EXTRACTOR = os.getenv("HTML_EXTRACTOR", "lxml")
+# When true, navigation, headers, footers and other boilerplate are dropped and
+# only the main article/content block is passed on to the LLM.
+HTML_MAIN_CONTENT = os.getenv("HTML_MAIN_CONTENT", "false").lower() == "true"
+
+ALWAYS_REMOVED_TAGS = ["script", "style", "noscript", "template", "svg"]
+BOILERPLATE_TAGS = ["nav", "header", "footer", "aside", "form", "iframe", "button"]
+MAIN_CONTENT_SELECTORS = ["article", "main", "[role=main]"]
+BOILERPLATE_PATTERN = re.compile(
+    r"(^|[\s_-])(nav|navbar|menu|footer|header|sidebar|cookie|banner|breadcrumb|share|social|related|comment|advert|ads|promo|subscribe|popup|modal)([\s_-]|$)",
+    re.IGNORECASE,
+)
+BLOCK_TAGS = ["div", "section", "td"]
+# Never removed by the class/id boilerplate heuristic (e.g. <body class="has-sidebar">).
+PROTECTED_TAGS = {"html", "body", "main", "article"}
+
+log = get_logger(__name__)
+
+
+def _clean_lines(text: str) -> str:
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def _extract_bs4(content: bytes, main_content: bool) -> str:
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # Remove script and style elements
+    for element in soup(ALWAYS_REMOVED_TAGS):
+        element.decompose()
+
+    if main_content:
+        for element in soup(BOILERPLATE_TAGS):
+            element.decompose()
+        for element in soup.find_all(attrs={"class": BOILERPLATE_PATTERN}) + soup.find_all(attrs={"id": BOILERPLATE_PATTERN}):
+            if not element.decomposed and element.name not in PROTECTED_TAGS:
+                element.decompose()
+        candidates = [c for selector in MAIN_CONTENT_SELECTORS for c in soup.select(selector)]
+        if candidates:
+            main = max(candidates, key=lambda c: len(c.get_text(strip=True)))
+            return main.get_text(separator='\n', strip=True)
+
+    return soup.get_text(separator='\n', strip=True)
+
+
+def _lxml_block_score(element) -> int:
+    # Paragraph text directly under the block, minus link text: favours article
+    # bodies over link-heavy menus and footers.
+    paragraph_text = sum(len(p.text_content()) for p in element.findall("p"))
+    link_text = sum(len(a.text_content()) for a in element.iter("a"))
+    return paragraph_text - link_text
+
+
+def _extract_lxml(content: bytes | str, main_content: bool) -> str:
+    return _lxml_document_text(lxml.html.document_fromstring(content), main_content)
+
+
+def _lxml_document_text(document, main_content: bool) -> str:
+    etree.strip_elements(document, *ALWAYS_REMOVED_TAGS, etree.Comment, with_tail=False)
+
+    root = document
+    if main_content:
+        etree.strip_elements(document, *BOILERPLATE_TAGS, with_tail=False)
+        for element in document.xpath("//*[@class or @id]"):
+            marker = f"{element.get('class', '')} {element.get('id', '')}"
+            if element.tag not in PROTECTED_TAGS and BOILERPLATE_PATTERN.search(marker) and element.getparent() is not None:
+                element.drop_tree()
+        candidates = document.xpath("//article | //main | //*[@role='main']")
+        if not candidates:
+            candidates = [b for b in document.iter(*BLOCK_TAGS) if _lxml_block_score(b) > 0]
+            candidates = [max(candidates, key=_lxml_block_score)] if candidates else []
+        if candidates:
+            root = max(candidates, key=lambda c: len(c.text_content()))
+
+    return _clean_lines("\n".join(root.itertext()))
+
+
+def _extract_selectolax(content: bytes, main_content: bool) -> str:
+    tree = LexborHTMLParser(content)
+    tree.strip_tags(ALWAYS_REMOVED_TAGS)
+
+    root = tree.body or tree.root
+    if main_content:
+        tree.strip_tags(BOILERPLATE_TAGS)
+        for node in tree.css("[class], [id]"):
+            marker = f"{node.attributes.get('class') or ''} {node.attributes.get('id') or ''}"
+            if node.tag not in PROTECTED_TAGS and BOILERPLATE_PATTERN.search(marker):
+                node.decompose()
+        candidates = [c for selector in MAIN_CONTENT_SELECTORS for c in tree.css(selector)]
+        if candidates:
+            root = max(candidates, key=lambda c: len(c.text(strip=True)))
+
+    if root is None:
+        return ""
+    return _clean_lines(root.text(separator="\n", strip=True))
+
+
+EXTRACTORS = {
+    "bs4": _extract_bs4,
+    "lxml": _extract_lxml,
+    "selectolax": _extract_selectolax,
+}
+
+AVAILABLE_EXTRACTORS = {
+    "bs4": True,
+    "lxml": lxml is not None,
+    "selectolax": LexborHTMLParser is not None,
+}
+
+
+def register_extractor(name: str, extractor):
+    """Register an extractor: a callable (content: bytes | str, main_content: bool) -> str."""
+    EXTRACTORS[name] = extractor
+    AVAILABLE_EXTRACTORS[name] = True
+
+
+def extract_text(content: bytes | str, engine: str | None = None, main_content: bool | None = None) -> str:
+    """
+    Extract readable text from an HTML document (raw bytes or decoded text).
+
+    engine defaults to HTML_EXTRACTOR and main_content to HTML_MAIN_CONTENT.
+    If the selected engine is unavailable or fails, the BeautifulSoup
+    extractor is used instead.
+    """
+    engine = engine or HTML_EXTRACTOR
+    main_content = HTML_MAIN_CONTENT if main_content is None else main_content
+
+    if engine != "bs4" and AVAILABLE_EXTRACTORS.get(engine):
+        try:
+            with span("parse", engine, bytes=len(content)) as fields:
+                text = EXTRACTORS[engine](content, main_content)
+                fields["chars"] = len(text)
+            return text
+        except Exception as e:
+            log.warning(f"{engine} extraction failed, falling back to BeautifulSoup: {e}")
+    elif engine != "bs4":
+        log.warning(f"HTML extractor '{engine}' is not available, falling back to BeautifulSoup.")
+    with span("parse", "bs4", bytes=len(content)) as fields:
+        text = _extract_bs4(content, main_content)
+        fields["chars"] = len(text)
+    return text
+
+
+class StreamingExtractor:
+    """
+    Text extraction fed with decoded HTML as it is downloaded (app/fetcher.py).
+    With lxml, chunks go straight into its incremental parser as they arrive;
+    other engines collect the chunks and run extract_text() on close(). The
+    chunks are kept in either case (the body is capped at FETCH_MAX_BYTES), so
+    a page lxml fails on is extracted with BeautifulSoup instead.
+    """
+
+    def __init__(self, engine: str | None = None, main_content: bool | None = None):
+        self.engine = engine or HTML_EXTRACTOR
+        self.main_content = HTML_MAIN_CONTENT if main_content is None else main_content
+        self.chars = 0
+        self._seconds = 0.0
+        self._chunks: list[str] = []
+        self._parser = None
+        if self.engine == "lxml" and lxml is not None:
+            self._parser = lxml.html.HTMLParser()
+
+    def feed(self, chunk: str):
+        self.chars += len(chunk)
+        self._chunks.append(chunk)
+        if self._parser is None:
+            return
+        started = time.perf_counter()
+        try:
+            self._parser.feed(chunk)
+        except Exception as e:
+            log.warning(f"lxml failed while parsing a streamed page, falling back to BeautifulSoup: {e}")
+            self._parser = None
+            self.engine = "bs4"
+        self._seconds += time.perf_counter() - started
+
+    def close(self) -> str:
+        if self._parser is None:
+            return extract_text("".join(self._chunks), self.engine, self.main_content)
+        started = time.perf_counter()
+        try:
+            document = self._parser.close() if self.chars else None
+            text = _lxml_document_text(document, self.main_content) if document is not None else ""
+        except Exception as e:
+            record_span("parse", "lxml", self._seconds + time.perf_counter() - started, e, bytes=self.chars)
+            log.warning(f"lxml failed to parse a streamed page, falling back to BeautifulSoup: {e}")
+            return extract_text("".join(self._chunks), "bs4", self.main_content)
+        record_span("parse", "lxml", self._seconds + time.perf_counter() - started, bytes=self.chars, chars=len(text))
+        return text
@@ -0,0 +1,320 @@
+import json
+import os
+import sys
+import time
+
+from celery import group
+
+from app.dispatch import send
+from app.instrumentation import current_context, get_logger, inc, on_llm_usage
+from app.queues import PRIORITIES
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Fair-share dispatch: pipelines wait in per-user queues in Redis and are
+# released to Celery by deficit round-robin (DRR) across users, so one user's
+# batch or long URL lists can't fill the broker ahead of everyone else. At most
+# FAIR_SHARE_MAX_IN_FLIGHT pipelines run at once (all users), and at most
+# FAIR_SHARE_USER_CONCURRENCY per user. Each round a user's deficit grows by
+# FAIR_SHARE_QUANTUM times their weight, and a pipeline costs 1 plus
+# FAIR_SHARE_URL_COST per MCP URL, so users get equal work rather than equal
+# prompt counts. Within a user's queue, interactive prompts go before bulk ones.
+# Every finished pipeline frees its slot and releases the next ones
+# (pipeline_complete_task -> finish_prompt). Off by default: turning it on caps
+# how many pipelines run at once, which a deployment should size deliberately.
+FAIR_SHARE_ENABLED = os.getenv("FAIR_SHARE_ENABLED", "false").lower() == "true"
+FAIR_SHARE_MAX_IN_FLIGHT = int(os.getenv("FAIR_SHARE_MAX_IN_FLIGHT", "64"))
+FAIR_SHARE_USER_CONCURRENCY = int(os.getenv("FAIR_SHARE_USER_CONCURRENCY", "8"))
+FAIR_SHARE_QUANTUM = float(os.getenv("FAIR_SHARE_QUANTUM", "1"))
+FAIR_SHARE_URL_COST = float(os.getenv("FAIR_SHARE_URL_COST", "0.5"))
+# Comma-separated user=weight pairs; other users have weight 1.
+FAIR_SHARE_WEIGHTS = {
+    user.strip(): float(weight) for user, _, weight in
+    (pair.partition("=") for pair in os.getenv("FAIR_SHARE_WEIGHTS", "").split(",") if "=" in pair)
+}
+# LLM tokens a user may use per FAIR_SHARE_TOKEN_WINDOW seconds (0: no limit).
+# Their queued pipelines wait for the next window once it is used up; running ones finish.
+FAIR_SHARE_USER_TOKENS = int(os.getenv("FAIR_SHARE_USER_TOKENS", "0"))
+FAIR_SHARE_TOKEN_WINDOW = int(os.getenv("FAIR_SHARE_TOKEN_WINDOW", "3600"))
+FAIR_SHARE_RETRY_DELAY = float(os.getenv("FAIR_SHARE_RETRY_DELAY", "10"))
+# A released pipeline with no outcome after this long is counted as finished and frees its slot.
+FAIR_SHARE_SLOT_TIMEOUT = int(os.getenv("FAIR_SHARE_SLOT_TIMEOUT", "1800"))
+
+# Pipelines without a user (the web UI has no sign-in) share one quota; batches
+# without a user get their own, so a UI batch can't take the slots of UI prompts.
+ANONYMOUS_USER = "anonymous"
+ANONYMOUS_BATCH_USER = "anonymous-batch"
+
+PREFIX = "tia:fair:"
+# queued:<user>:<priority>: pipelines not yet released (JSON, FIFO)
+# active: users with queued pipelines, in round-robin order
+# deficit: user -> DRR deficit; user_running: user -> pipelines in flight
+# running: prompt_id -> {"user", "at"}; owners: prompt_id -> user (queued or running)
+# tokens:<user>:<window>: LLM tokens used in a token window
+# Scripts only touch the keys passed in KEYS: release() snapshots the active
+# users first and passes their queue and token keys.
+ACTIVE_KEY = PREFIX + "active"
+RUNNING_KEY = PREFIX + "running"
+USER_RUNNING_KEY = PREFIX + "user_running"
+OWNERS_KEY = PREFIX + "owners"
+DEFICIT_KEY = PREFIX + "deficit"
+
+# KEYS: active, owners, then the queue of each pipeline. ARGV[1] is 'rpush' (to
+# the back of each queue) or 'lpush' (to the front), then user, prompt_id, item per pipeline.
+_ENQUEUE_SCRIPT = """
+for i = 3, #KEYS do
+    local arg = 2 + (i - 3) * 3
+    redis.call(ARGV[1], KEYS[i], ARGV[arg + 2])
+    redis.call('hset', KEYS[2], ARGV[arg + 1], ARGV[arg])
+    if not redis.call('lpos', KEYS[1], ARGV[arg]) then
+        redis.call('rpush', KEYS[1], ARGV[arg])
+    end
+end
+"""
+
+# One DRR pass over the active users: release pipelines into free slots.
+# KEYS: running, user_running, active, deficit, then for each user in ARGV[8]
+# (in order) its queues, highest priority first, and its token counter.
+_RELEASE_SCRIPT = """
+local now = ARGV[1]
+local free = tonumber(ARGV[2]) - redis.call('hlen', KEYS[1])
+local limit, quantum = tonumber(ARGV[3]), tonumber(ARGV[4])
+local token_limit, weights = tonumber(ARGV[5]), cjson.decode(ARGV[6])
+local url_cost, per_user = tonumber(ARGV[7]), tonumber(ARGV[9])
+local active, deficits = KEYS[3], KEYS[4]
+local base = {}
+for i, user in ipairs(cjson.decode(ARGV[8])) do base[user] = 4 + (i - 1) * per_user end
+local taken = {}
+
+local function head(user)
+    for i = 1, per_user - 1 do
+        local queue = KEYS[base[user] + i]
+        local item = redis.call('lindex', queue, 0)
+        if item then return item, queue end
+    end
+end
+
+local function eligible(user)
+    if tonumber(redis.call('hget', KEYS[2], user) or '0') >= limit then return false end
+    return token_limit <= 0 or tonumber(redis.call('get', KEYS[base[user] + per_user]) or '0') < token_limit
+end
+
+-- Stop once every active user in a row is blocked (at its limits), or after a bounded number of visits.
+-- Users that became active after the snapshot count as blocked; the dispatch after their enqueue serves them.
+local blocked, visits = 0, 0
+while free > 0 and visits < 10000 do
+    local users = redis.call('llen', active)
+    if users == 0 or blocked >= users then break end
+    visits = visits + 1
+    local user = redis.call('lpop', active)
+    local known, item, queue = base[user] ~= nil
+    if known then item, queue = head(user) end
+    if known and not item then
+        redis.call('hdel', deficits, user)
+    elseif not known or not eligible(user) then
+        blocked = blocked + 1
+        redis.call('rpush', active, user)
+    else
+        blocked = 0
+        local deficit = tonumber(redis.call('hget', deficits, user) or '0') + quantum * (weights[user] or 1)
+        while item and free > 0 and eligible(user) do
+            local entry = cjson.decode(item)
+            local cost = 1 + url_cost * #entry['urls']
+            if cost > deficit then break end
+            redis.call('lpop', queue)
+            redis.call('hset', KEYS[1], entry['prompt_id'], cjson.encode({user = user, at = tonumber(now)}))
+            redis.call('hincrby', KEYS[2], user, 1)
+            table.insert(taken, item)
+            deficit = deficit - cost
+            free = free - 1
+            item, queue = head(user)
+        end
+        if item then
+            redis.call('hset', deficits, user, deficit)
+            redis.call('rpush', active, user)
+        else
+            redis.call('hdel', deficits, user)
+        end
+    end
+end
+return taken
+"""
+
+# Free a pipeline's slot; returns its user, or false if it wasn't running (already freed).
+_FINISH_SCRIPT = """
+local entry = redis.call('hget', KEYS[1], ARGV[1])
+redis.call('hdel', KEYS[3], ARGV[1])
+if not entry then return false end
+redis.call('hdel', KEYS[1], ARGV[1])
+local user = cjson.decode(entry)['user']
+if redis.call('hincrby', KEYS[2], user, -1) <= 0 then redis.call('hdel', KEYS[2], user) end
+return user
+"""
+
+
+
+def _queue_key(user: str, priority: str) -> str:
+    return f"{PREFIX}queued:{user}:{priority}"
+
+
+def _token_key(user: str, window: int) -> str:
+    return f"{PREFIX}tokens:{user}:{window}"
+
+
+def _window(now: float | None = None) -> int:
+    return int((now if now is not None else time.time()) // FAIR_SHARE_TOKEN_WINDOW)
+
+
+def enqueue(items: list[dict], front: bool = False):
+    """
+    Queue pipelines for release by user: dicts with prompt_id, prompt, agent_id,
+    urls, priority, task_id (of the final task) and optionally user and batch_id.
+    With front=True they go back to the head of their queues, in order.
+    """
+    queues, args = [], []
+    for item in reversed(items) if front else items:
+        user = str(item.get("user") or (ANONYMOUS_BATCH_USER if item.get("batch_id") else ANONYMOUS_USER))
+        queues.append(_queue_key(user, item["priority"]))
+        args += [user, item["prompt_id"], json.dumps({**item, "user": user})]
+    if queues:
+        get_redis_client().eval(_ENQUEUE_SCRIPT, 2 + len(queues), ACTIVE_KEY, OWNERS_KEY, *queues,
+                                "lpush" if front else "rpush", *args)
+
+
+def _reclaim_lost(r) -> int:
+    """Free the slots of pipelines released more than FAIR_SHARE_SLOT_TIMEOUT ago with no outcome."""
+    cutoff = time.time() - FAIR_SHARE_SLOT_TIMEOUT
+    lost = [int(pid) for pid, entry in r.hgetall(RUNNING_KEY).items() if json.loads(entry)["at"] < cutoff]
+    for prompt_id in lost:
+        r.eval(_FINISH_SCRIPT, 3, RUNNING_KEY, USER_RUNNING_KEY, OWNERS_KEY, prompt_id)
+    if lost:
+        log.warning(f"Fair share: {len(lost)} pipelines got no outcome within {FAIR_SHARE_SLOT_TIMEOUT}s; freed their slots")
+    return len(lost)
+
+
+def _retry_later():
+    send("fair_share_dispatch", {}, countdown=FAIR_SHARE_RETRY_DELAY)
+
+
+def release() -> list[dict]:
+    """Take the pipelines to run next (DRR across users) and mark them running."""
+    r = get_redis_client()
+    _reclaim_lost(r)
+    users = [u.decode("utf-8") for u in r.lrange(ACTIVE_KEY, 0, -1)]
+    if not users:
+        return []
+    priorities = sorted(PRIORITIES, key=PRIORITIES.get)
+    window = _window()
+    keys = [RUNNING_KEY, USER_RUNNING_KEY, ACTIVE_KEY, DEFICIT_KEY]
+    for user in users:
+        keys += [_queue_key(user, priority) for priority in priorities] + [_token_key(user, window)]
+    taken = r.eval(_RELEASE_SCRIPT, len(keys), *keys, time.time(), FAIR_SHARE_MAX_IN_FLIGHT,
+                   FAIR_SHARE_USER_CONCURRENCY, FAIR_SHARE_QUANTUM, FAIR_SHARE_USER_TOKENS,
+                   json.dumps(FAIR_SHARE_WEIGHTS), FAIR_SHARE_URL_COST, json.dumps(users), len(priorities) + 1)
+    return [json.loads(item) for item in taken]
+
+
+def dispatch() -> int:
+    """
+    Release queued pipelines into free slots and send them to Celery as one
+    group. Safe to call from several processes at once. Returns the number of
+    pipelines dispatched.
+    """
+    from app.pipeline import build_pipeline # app.pipeline routes new prompts here
+
+    r = get_redis_client()
+    taken = release()
+    if taken:
+        pipelines = [build_pipeline(item["prompt_id"], item["prompt"], item["agent_id"], item["urls"], item["priority"],
+                                    batch_id=item.get("batch_id"), final_task_id=item["task_id"],
+                                    user_id=None if item["user"] in (ANONYMOUS_USER, ANONYMOUS_BATCH_USER) else item["user"])
+                     for item in taken]
+        try:
+            group(pipelines).apply_async()
+        except Exception as e:
+            # Back to the front of their users' queues; a later dispatch picks them up again.
+            log.warning(f"Fair share: dispatching {len(taken)} pipelines failed, will retry: {e}")
+            for item in reversed(taken):
+                r.eval(_FINISH_SCRIPT, 3, RUNNING_KEY, USER_RUNNING_KEY, OWNERS_KEY, item["prompt_id"])
+            enqueue(taken, front=True)
+            _retry_later()
+            return 0
+        for item in taken:
+            inc("tia_fair_share_pipelines_total", outcome="dispatched", priority=item["priority"])
+        log.info(f"Fair share: dispatched {len(taken)} pipelines")
+    # Finishing pipelines trigger the next release; with none running (all users at
+    # their token quota), check back later.
+    if not r.hlen(RUNNING_KEY) and r.llen(ACTIVE_KEY):
+        _retry_later()
+    return len(taken)
+
+
+def submit(prompt_id: int, user_prompt: str, agent_id: int, urls: list[str], priority: str,
+           task_id: str, user_id: str | None = None, batch_id: str | None = None):
+    """Queue one pipeline for its user and release whatever fits now."""
+    item = {"prompt_id": prompt_id, "prompt": user_prompt, "agent_id": agent_id, "urls": urls or [],
+            "priority": priority, "task_id": task_id, "user": user_id}
+    if batch_id is not None:
+        item["batch_id"] = batch_id
+    enqueue([item])
+    inc("tia_fair_share_pipelines_total", outcome="queued", priority=priority)
+    dispatch()
+
+
+def finish_prompt(prompt_id: int):
+    """Free a finished pipeline's slot and release the next queued pipelines."""
+    try:
+        r = get_redis_client()
+        r.eval(_FINISH_SCRIPT, 3, RUNNING_KEY, USER_RUNNING_KEY, OWNERS_KEY, prompt_id)
+        dispatch()
+    except Exception as e:
+        log.warning(f"Fair share: failed to free the slot of prompt_id {prompt_id}: {e}")
+
+
+def charge_tokens(model: str, tokens: int):
+    """Count LLM tokens used by the running stage against its prompt's user (app.instrumentation usage hook)."""
+    prompt_id = current_context().get("prompt_id")
+    if prompt_id is None or not tokens:
+        return
+    try:
+        r = get_redis_client()
+        user = r.hget(OWNERS_KEY, prompt_id)
+        if user is None:
+            return
+        key = _token_key(user.decode("utf-8"), _window())
+        pipe = r.pipeline(transaction=False)
+        pipe.incrby(key, tokens)
+        pipe.expire(key, FAIR_SHARE_TOKEN_WINDOW * 2)
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Fair share: failed to charge {tokens} tokens for prompt_id {prompt_id}: {e}")
+
+
+if FAIR_SHARE_ENABLED and FAIR_SHARE_USER_TOKENS > 0:
+    on_llm_usage(charge_tokens)
+
+
+def get_fair_share_stats() -> dict:
+    """Per-user queued and running pipelines and tokens used this window, plus totals."""
+    r = get_redis_client()
+    window = _window()
+    users = {u.decode("utf-8") for u in r.lrange(ACTIVE_KEY, 0, -1)}
+    users |= {u.decode("utf-8") for u in r.hkeys(USER_RUNNING_KEY)}
+    stats = {"running": r.hlen(RUNNING_KEY), "max_in_flight": FAIR_SHARE_MAX_IN_FLIGHT, "users": {}}
+    for user in sorted(users):
+        pipe = r.pipeline(transaction=False)
+        for priority in PRIORITIES:
+            pipe.llen(_queue_key(user, priority))
+        pipe.hget(USER_RUNNING_KEY, user)
+        pipe.get(_token_key(user, window))
+        *queued, running, tokens = pipe.execute()
+        stats["users"][user] = {"queued": sum(queued), "running": int(running or 0), "tokens": int(tokens or 0)}
+    stats["queued"] = sum(u["queued"] for u in stats["users"].values())
+    return stats
+
+
+if __name__ == "__main__":
+    # `python -m app.fair_share` prints per-user queue state.
+    json.dump(get_fair_share_stats(), sys.stdout, indent=2)
+    print()
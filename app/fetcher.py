@@ -0,0 +1,419 @@
+import asyncio
+import codecs
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.instrumentation import get_logger, in_current_context, inc, record_fetch
+
+log = get_logger(__name__)
+
+# Concurrency and deadline settings for URL fetching in mcp_task.
+FETCH_MAX_CONCURRENCY = int(os.getenv("FETCH_MAX_CONCURRENCY", "16"))
+FETCH_PER_HOST_CONCURRENCY = int(os.getenv("FETCH_PER_HOST_CONCURRENCY", "4"))
+FETCH_BATCH_DEADLINE = float(os.getenv("FETCH_BATCH_DEADLINE", "20"))
+FETCH_CONNECT_TIMEOUT = float(os.getenv("FETCH_CONNECT_TIMEOUT", "5"))
+FETCH_POOL_MAXSIZE = int(os.getenv("FETCH_POOL_MAXSIZE", str(FETCH_PER_HOST_CONCURRENCY)))
+# Bodies stop being read at the batch deadline; this long after it, fetches
+# still finishing the part they read (parsing it) are given up on as well.
+FETCH_DEADLINE_GRACE = float(os.getenv("FETCH_DEADLINE_GRACE", "1"))
+
+# Response bodies are streamed: at most FETCH_MAX_BYTES (decoded) are read per
+# URL and the rest is cut off, and responses that aren't text (by Content-Type,
+# or by sniffing the first bytes when the type is missing, generic or wrong)
+# are dropped after the first chunk. So a pasted PDF, video or multi-GB file
+# costs one chunk, and memory per mcp_task stays bounded by
+# FETCH_MAX_CONCURRENCY * FETCH_MAX_BYTES.
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", str(2 * 1024 * 1024)))
+FETCH_CHUNK_SIZE = int(os.getenv("FETCH_CHUNK_SIZE", "65536"))
+FETCH_TEXT_TYPES = {t.strip() for t in os.getenv(
+    "FETCH_TEXT_TYPES", "text/html,application/xhtml+xml,text/plain,application/xml,text/xml"
+).split(",") if t.strip()}
+# Types that say nothing about the body; these are sniffed instead.
+GENERIC_TYPES = {"", "application/octet-stream", "binary/octet-stream", "application/unknown"}
+# Leading bytes of common non-text downloads.
+BINARY_SIGNATURES = {
+    b"%PDF": "PDF", b"PK\x03\x04": "ZIP", b"\x89PNG": "PNG", b"GIF8": "GIF", b"\xff\xd8\xff": "JPEG",
+    b"\x1f\x8b": "gzip", b"RIFF": "RIFF", b"\x00\x00\x00": "MP4/binary", b"ID3": "MP3", b"\x7fELF": "ELF",
+    b"OggS": "Ogg", b"\x1a\x45\xdf\xa3": "WebM/MKV", b"\xd0\xcf\x11\xe0": "MS Office",
+}
+SNIFF_BYTES = 4096 # looked at for a <meta charset> declaration
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+
+_session: requests.Session | None = None
+_session_pid: int | None = None
+_executor: ThreadPoolExecutor | None = None
+# Per-host [semaphore, fetches holding or waiting for it]; a host's entry is
+# dropped when its last fetch finishes, so only hosts being fetched are kept.
+_host_semaphores: dict[str, list] = {}
+_lock = threading.Lock()
+# Async counterparts for TASK_EXECUTION_MODE=asyncio, bound to the process event loop.
+_async_client: httpx.AsyncClient | None = None
+_async_client_pid: int | None = None
+_async_host_semaphores: dict[str, list] = {}
+
+
+def _reset_after_fork():
+    global _session, _session_pid, _executor, _async_client, _async_client_pid
+    _session = None
+    _session_pid = None
+    _executor = None
+    _host_semaphores.clear()
+    _async_client = None
+    _async_client_pid = None
+    _async_host_semaphores.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_session() -> requests.Session:
+    """Process-wide session so keep-alive connections are reused across URLs and tasks."""
+    global _session, _session_pid, _executor
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _lock:
+        if _session is None or _session_pid != pid:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=FETCH_MAX_CONCURRENCY, pool_maxsize=FETCH_POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(DEFAULT_HEADERS)
+            _session = session
+            _executor = ThreadPoolExecutor(max_workers=FETCH_MAX_CONCURRENCY, thread_name_prefix="fetch")
+            _session_pid = pid
+        return _session
+
+
+@contextmanager
+def _host_slot(url: str, timeout: float):
+    """Hold one of the URL's host's FETCH_PER_HOST_CONCURRENCY slots; yields False if none frees up in time."""
+    host = urlsplit(url).netloc.lower()
+    with _lock:
+        entry = _host_semaphores.get(host)
+        if entry is None:
+            entry = _host_semaphores[host] = [threading.BoundedSemaphore(FETCH_PER_HOST_CONCURRENCY), 0]
+        entry[1] += 1
+    acquired = entry[0].acquire(timeout=timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            entry[0].release()
+        with _lock:
+            entry[1] -= 1
+            if not entry[1] and _host_semaphores.get(host) is entry:
+                del _host_semaphores[host]
+
+
+@asynccontextmanager
+async def _async_host_slot(url: str):
+    """_host_slot for coroutines on the process event loop (no timeout: the batch deadline cancels waiters)."""
+    host = urlsplit(url).netloc.lower()
+    entry = _async_host_semaphores.get(host)
+    if entry is None:
+        entry = _async_host_semaphores[host] = [asyncio.Semaphore(FETCH_PER_HOST_CONCURRENCY), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1] and _async_host_semaphores.get(host) is entry:
+            del _async_host_semaphores[host]
+
+
+def _empty_result(url: str, error: str | None = None) -> dict:
+    return {"url": url, "content": None, "text": None, "status_code": None, "headers": {}, "error": error,
+            "bytes": 0, "truncated": False, "skipped": None}
+
+
+def _media_type(headers) -> tuple[str, str | None]:
+    """(media type, charset) from a Content-Type header."""
+    value = headers.get("content-type") or headers.get("Content-Type") or ""
+    media_type, _, params = value.partition(";")
+    charset = None
+    for param in params.split(";"):
+        name, _, val = param.partition("=")
+        if name.strip().lower() == "charset" and val.strip():
+            charset = val.strip().strip("\"'")
+    return media_type.strip().lower(), charset
+
+
+def _sniff_binary(head: bytes) -> str | None:
+    """Name of the binary format `head` starts with, or None if it looks like text."""
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return None
+    for signature, name in BINARY_SIGNATURES.items():
+        if head.startswith(signature):
+            return name
+    if b"\x00" in head[:1024]:
+        return "binary"
+    return None
+
+
+class _BodyReader:
+    """
+    Consumes a response body chunk by chunk, up to FETCH_MAX_BYTES. Without a
+    parser the raw bytes are kept (result["content"]); with one, chunks are
+    decoded incrementally and fed to it, and result["text"] is its output.
+    """
+
+    def __init__(self, result: dict, max_bytes: int, parser=None):
+        self.result = result
+        self.max_bytes = max_bytes
+        self.parser = parser
+        self.media_type, self.charset = _media_type(result["headers"])
+        self._buffer = bytearray() if parser is None else None
+        self._head = bytearray()
+        self._decoder = None
+        self._deadline_hit = False
+
+    def skip_reason(self) -> str | None:
+        """Skip a response by its Content-Type alone, before reading the body."""
+        if self.media_type not in GENERIC_TYPES and self.media_type not in FETCH_TEXT_TYPES:
+            return f"content type {self.media_type}"
+        return None
+
+    def feed(self, chunk: bytes) -> bool:
+        """Take the next chunk; False when no more should be read (skipped or capped)."""
+        result = self.result
+        if not result["bytes"]:
+            binary = _sniff_binary(chunk)
+            if binary is not None:
+                result["skipped"] = f"{binary} content" + (f" served as {self.media_type}" if self.media_type else "")
+                return False
+        room = self.max_bytes - result["bytes"]
+        if len(chunk) > room:
+            chunk = chunk[:room]
+            result["truncated"] = True
+        result["bytes"] += len(chunk)
+        if self._buffer is not None:
+            self._buffer += chunk
+        elif self._decoder is None:
+            # Hold the first bytes until there are enough to find a <meta charset>.
+            self._head += chunk
+            if len(self._head) >= SNIFF_BYTES:
+                self._start_decoding()
+        elif chunk:
+            self.parser.feed(self._decoder.decode(chunk))
+        return not result["truncated"]
+
+    def deadline_exceeded(self):
+        """The batch deadline passed with body still coming: keep what was read, flagged as truncated."""
+        self.result["truncated"] = True
+        self._deadline_hit = True
+        if not self.result["bytes"]:
+            self.result["error"] = "batch deadline exceeded before the body arrived"
+
+    def _start_decoding(self):
+        self._decoder = self._make_decoder(bytes(self._head))
+        self.parser.feed(self._decoder.decode(bytes(self._head)))
+        self._head = None
+
+    def _make_decoder(self, head: bytes):
+        # Charset from the header, else a BOM or <meta charset> in the first chunk, else UTF-8.
+        charset = self.charset
+        if head.startswith(codecs.BOM_UTF8):
+            charset = "utf-8-sig"
+        elif head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            charset = "utf-16"
+        elif charset is None:
+            match = _META_CHARSET.search(head[:SNIFF_BYTES])
+            charset = match.group(1).decode("ascii") if match else "utf-8"
+        try:
+            return codecs.getincrementaldecoder(charset)(errors="replace")
+        except LookupError:
+            return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def finish(self):
+        result = self.result
+        if result["skipped"]:
+            inc("tia_fetch_limited_total", reason="skipped")
+            log.info(f"Skipped {result['url']}: {result['skipped']}")
+            return
+        if self._deadline_hit:
+            inc("tia_fetch_limited_total", reason="deadline")
+            log.info(f"Truncated {result['url']} at {result['bytes']} bytes by the batch deadline")
+        elif result["truncated"]:
+            inc("tia_fetch_limited_total", reason="truncated")
+            log.info(f"Truncated {result['url']} at {self.max_bytes} bytes")
+        if self._buffer is not None:
+            result["content"] = bytes(self._buffer)
+            return
+        if self._decoder is None and self._head:
+            self._start_decoding()
+        if self._decoder is not None:
+            self.parser.feed(self._decoder.decode(b"", final=True))
+        result["text"] = self.parser.close()
+
+
+def _fetch_one(session: requests.Session, url: str, deadline: float, headers: dict | None = None,
+               parser_factory=None, max_bytes: int = FETCH_MAX_BYTES) -> dict:
+    result = _empty_result(url)
+    started = None
+    with _host_slot(url, max(0.0, deadline - time.monotonic())) as acquired:
+        if not acquired:
+            result["error"] = "batch deadline exceeded while waiting for a connection slot"
+            return result
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                result["error"] = "batch deadline exceeded"
+                return result
+            started = time.perf_counter()
+            with session.get(url, headers=headers, timeout=(min(FETCH_CONNECT_TIMEOUT, remaining), remaining), stream=True) as response:
+                result["status_code"] = response.status_code
+                result["headers"] = dict(response.headers)
+                response.raise_for_status() # Raises an HTTPError for bad responses (4XX or 5XX)
+                reader = _BodyReader(result, max_bytes, parser_factory() if parser_factory and response.status_code != 304 else None)
+                result["skipped"] = reader.skip_reason()
+                if result["skipped"] is None:
+                    for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+                        if time.monotonic() > deadline:
+                            reader.deadline_exceeded()
+                            break
+                        if not reader.feed(chunk):
+                            break
+                reader.finish()
+        except requests.exceptions.RequestException as e:
+            result["error"] = str(e)
+        except Exception as e: # e.g. the parser failed on the body
+            result["error"] = f"{type(e).__name__}: {e}"
+    if started is not None: # a request went out
+        record_fetch(time.perf_counter() - started, result["status_code"], result["bytes"], result["error"], url=url)
+    return result
+
+
+def fetch_urls(urls: list[str], deadline: float | None = None, request_headers: dict[str, dict] | None = None,
+               parser_factory=None, max_bytes: int = FETCH_MAX_BYTES) -> list[dict]:
+    """
+    Fetch URLs concurrently and return one result dict per URL, in input order.
+
+    Each result has 'url', 'content' (bytes or None), 'status_code', 'headers'
+    and 'error' (None on success), plus 'bytes' read, 'truncated' (cut off at
+    max_bytes) and 'skipped' (why a non-text body was not read, or None). The
+    whole batch shares a single deadline (seconds, default
+    FETCH_BATCH_DEADLINE); URLs still pending when it expires are reported as
+    errors instead of holding the task open. request_headers optionally maps a
+    URL to extra headers (e.g. conditional If-None-Match/If-Modified-Since
+    headers for a cached copy).
+
+    parser_factory, e.g. app.extractors.StreamingExtractor, makes an object
+    with feed(str)/close(); each body is then decoded and fed to a new one as
+    it arrives, and its close() value is returned as 'text' instead of
+    'content'. A body still arriving when the deadline passes is cut off
+    there and marked 'truncated', like one cut off at max_bytes.
+    """
+    if not urls:
+        return []
+    session = _get_session()
+    batch_deadline = time.monotonic() + (FETCH_BATCH_DEADLINE if deadline is None else deadline)
+    request_headers = request_headers or {}
+    fetch_one = in_current_context(_fetch_one) # spans are tagged with the calling stage
+    futures = [_executor.submit(fetch_one, session, url, batch_deadline, request_headers.get(url), parser_factory, max_bytes)
+               for url in urls]
+    wait(futures, timeout=max(0.0, batch_deadline + FETCH_DEADLINE_GRACE - time.monotonic()))
+
+    results = []
+    for url, future in zip(urls, futures):
+        if future.done():
+            results.append(future.result())
+        else:
+            future.cancel()
+            results.append(_empty_result(url, "batch deadline exceeded"))
+    return results
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    global _async_client, _async_client_pid
+    if _async_client is None or _async_client_pid != os.getpid():
+        _async_client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            limits=httpx.Limits(max_connections=FETCH_MAX_CONCURRENCY, max_keepalive_connections=FETCH_MAX_CONCURRENCY),
+            follow_redirects=True,
+        )
+        _async_client_pid = os.getpid()
+    return _async_client
+
+
+async def _call_now(fn, *args):
+    return fn(*args)
+
+
+async def _afetch_one(client: httpx.AsyncClient, url: str, deadline: float, headers: dict | None, parser_factory=None,
+                      max_bytes: int = FETCH_MAX_BYTES) -> dict:
+    result = _empty_result(url)
+    async with _async_host_slot(url):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            result["error"] = "batch deadline exceeded"
+            return result
+        started = time.perf_counter()
+        try:
+            timeout = httpx.Timeout(remaining, connect=min(FETCH_CONNECT_TIMEOUT, remaining))
+            async with client.stream("GET", url, headers=headers, timeout=timeout) as response:
+                result["status_code"] = response.status_code
+                result["headers"] = dict(response.headers)
+                if response.status_code >= 400:
+                    result["error"] = f"{response.status_code} Error for url: {url}"
+                else:
+                    reader = _BodyReader(result, max_bytes, parser_factory() if parser_factory and response.status_code != 304 else None)
+                    result["skipped"] = reader.skip_reason()
+                    # Parsing is CPU work, so with a parser each chunk is fed from a thread, off the event loop.
+                    call = asyncio.to_thread if reader.parser is not None else _call_now
+                    if result["skipped"] is None:
+                        # Only the wait for the next chunk is bounded by the deadline, never a feed in progress.
+                        chunks = response.aiter_bytes(FETCH_CHUNK_SIZE)
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(anext(chunks), deadline - time.monotonic())
+                            except StopAsyncIteration:
+                                break
+                            except TimeoutError:
+                                reader.deadline_exceeded()
+                                break
+                            if not await call(reader.feed, chunk):
+                                break
+                    await call(reader.finish)
+        except httpx.HTTPError as e:
+            result["error"] = str(e) or type(e).__name__
+        except Exception as e: # e.g. the parser failed on the body
+            result["error"] = f"{type(e).__name__}: {e}"
+        record_fetch(time.perf_counter() - started, result["status_code"], result["bytes"], result["error"], url=url)
+    return result
+
+
+async def afetch_urls(urls: list[str], deadline: float | None = None, request_headers: dict[str, dict] | None = None,
+                      parser_factory=None, max_bytes: int = FETCH_MAX_BYTES) -> list[dict]:
+    """fetch_urls for coroutines: same arguments, results and batch deadline, without threads."""
+    if not urls:
+        return []
+    client = _get_async_client()
+    timeout = FETCH_BATCH_DEADLINE if deadline is None else deadline
+    batch_deadline = time.monotonic() + timeout
+    request_headers = request_headers or {}
+    tasks = [asyncio.ensure_future(_afetch_one(client, url, batch_deadline, request_headers.get(url), parser_factory, max_bytes))
+             for url in urls]
+    await asyncio.wait(tasks, timeout=timeout + FETCH_DEADLINE_GRACE)
+
+    results = []
+    for url, task in zip(urls, tasks):
+        if task.done():
+            results.append(task.result())
+        else:
+            task.cancel()
+            results.append(_empty_result(url, "batch deadline exceeded"))
+    return results
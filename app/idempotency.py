@@ -0,0 +1,187 @@
+import functools
+import json
+import os
+import threading
+import uuid
+
+from app.instrumentation import get_logger
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Each (prompt_id, stage) runs at most once at a time and, once it has
+# succeeded, is not run again: redelivered, retried-after-success or
+# re-enqueued messages for the same stage exit before any LLM or database work.
+STAGE_LEASE_TTL = int(os.getenv("STAGE_LEASE_TTL", "60"))
+# How long a finished stage's output is kept to answer late duplicates.
+STAGE_RESULT_TTL = int(os.getenv("STAGE_RESULT_TTL", "86400"))
+# Window during which a second dispatch of the same prompt is dropped.
+DISPATCH_DEDUPE_TTL = int(os.getenv("DISPATCH_DEDUPE_TTL", "3600"))
+
+LEASE_PREFIX = "tia:lease:"
+DONE_PREFIX = "tia:stage_done:"
+DISPATCH_PREFIX = "tia:dispatched:"
+STATS_KEY = "tia:idempotency:stats"
+
+# Statuses whose output is final and can be handed to late duplicates.
+SUCCESS_STATUSES = {"retrieval_complete", "completed", "mcp_complete", "pipeline_complete"}
+SUPPRESSED_STATUS = "duplicate_suppressed"
+
+# Only the holder (matching token) may extend or release a lease.
+_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _stage_key(prompt_id: int, stage: str) -> str:
+    return f"{prompt_id}:{stage}"
+
+
+def _count(counter: str):
+    try:
+        get_redis_client().hincrby(STATS_KEY, counter, 1)
+    except Exception as e:
+        log.warning(f"Idempotency stats update failed: {e}")
+
+
+class StageLease:
+    """
+    Redis lease on one (prompt_id, stage). A heartbeat thread extends it every
+    ttl/3 seconds while the stage runs, so a crashed worker's lease expires
+    after at most ttl seconds and a slow stage never loses it.
+    """
+
+    def __init__(self, prompt_id: int, stage: str, ttl: int = STAGE_LEASE_TTL):
+        self.key = LEASE_PREFIX + _stage_key(prompt_id, stage)
+        self.ttl_ms = ttl * 1000
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self) -> bool:
+        r = get_redis_client()
+        if not r.set(self.key, self.token, nx=True, px=self.ttl_ms):
+            return False
+        self._heartbeat = threading.Thread(target=self._extend_until_released, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _extend_until_released(self):
+        r = get_redis_client()
+        while not self._stop.wait(self.ttl_ms / 3000):
+            try:
+                if not r.eval(_EXTEND_SCRIPT, 1, self.key, self.token, self.ttl_ms):
+                    log.warning(f"Lease {self.key} was lost before the stage finished")
+                    return
+            except Exception as e:
+                log.warning(f"Lease heartbeat for {self.key} failed: {e}")
+
+    def release(self):
+        self._stop.set()
+        try:
+            get_redis_client().eval(_RELEASE_SCRIPT, 1, self.key, self.token)
+        except Exception as e:
+            log.warning(f"Lease release for {self.key} failed (it will expire): {e}")
+
+
+def _prompt_id_from(args, kwargs):
+    if "prompt_id" in kwargs:
+        return kwargs["prompt_id"]
+    first = args[0] if args else None
+    if isinstance(first, dict):
+        return first.get("prompt_id")
+    return first
+
+
+def _is_suppressed(value) -> bool:
+    if isinstance(value, list):
+        return bool(value) and all(_is_suppressed(v) for v in value)
+    return isinstance(value, dict) and value.get("status") == SUPPRESSED_STATUS
+
+
+def idempotent_stage(stage: str):
+    """
+    Decorator for a bound stage task: runs the body under a StageLease and
+    stores successful output. A duplicate that finds the stage finished gets
+    the stored output back; one that finds it running gets a
+    'duplicate_suppressed' result, which later stages pass straight through.
+    Redis errors never block a stage; it then runs unguarded.
+    """
+    def decorator(fn):
+        @functools.wraps(fn) # also exposes fn's signature, which Celery checks calls against
+        def wrapper(task, *args, **kwargs):
+            if args and _is_suppressed(args[0]):
+                return args[0] if isinstance(args[0], dict) else args[0][0]
+            prompt_id = _prompt_id_from(args, kwargs)
+            if isinstance(prompt_id, dict):
+                prompt_id = prompt_id.get("prompt_id")
+            done_key = DONE_PREFIX + _stage_key(prompt_id, stage)
+
+            try:
+                stored = get_redis_client().get(done_key)
+            except Exception as e:
+                log.warning(f"Idempotency check unavailable for prompt_id {prompt_id} stage {stage}: {e}")
+                return fn(task, *args, **kwargs)
+            if stored is not None:
+                log.info(f"Stage {stage} for prompt_id {prompt_id} already finished; returning stored output")
+                _count(f"{stage}:suppressed_completed")
+                return json.loads(stored)
+
+            lease = StageLease(prompt_id, stage)
+            try:
+                acquired = lease.acquire()
+            except Exception as e:
+                log.warning(f"Stage lease unavailable for prompt_id {prompt_id} stage {stage}: {e}")
+                return fn(task, *args, **kwargs)
+            if not acquired:
+                log.info(f"Stage {stage} for prompt_id {prompt_id} is already running; suppressing duplicate")
+                _count(f"{stage}:suppressed_running")
+                return {"prompt_id": prompt_id, "status": SUPPRESSED_STATUS, "stage": stage}
+
+            try:
+                result = fn(task, *args, **kwargs)
+                if isinstance(result, dict) and result.get("status") in SUCCESS_STATUSES:
+                    try:
+                        get_redis_client().set(done_key, json.dumps(result), ex=STAGE_RESULT_TTL)
+                    except Exception as e:
+                        log.warning(f"Failed to record completion of stage {stage} for prompt_id {prompt_id}: {e}")
+                return result
+            finally:
+                lease.release()
+        return wrapper
+    return decorator
+
+
+def claim_dispatch(prompt_id: int, name: str = "pipeline", ttl: int = DISPATCH_DEDUPE_TTL) -> bool:
+    """
+    True if this caller is the first to dispatch `name` for the prompt within
+    ttl seconds. Repeated submissions/clicks get False and should not enqueue.
+    """
+    try:
+        claimed = get_redis_client().set(DISPATCH_PREFIX + _stage_key(prompt_id, name), 1, nx=True, ex=ttl)
+    except Exception as e:
+        log.warning(f"Dispatch dedupe unavailable for prompt_id {prompt_id}: {e}")
+        return True
+    if not claimed:
+        _count(f"{name}:suppressed_dispatch")
+    return bool(claimed)
+
+
+def get_idempotency_stats() -> dict:
+    """Suppressed-duplicate counters, keyed '<stage>:suppressed_{dispatch,running,completed}'."""
+    try:
+        stats = {k.decode("utf-8"): int(v) for k, v in get_redis_client().hgetall(STATS_KEY).items()}
+    except Exception as e:
+        log.warning(f"Idempotency stats unavailable: {e}")
+        return {}
+    stats["total_suppressed"] = sum(stats.values())
+    return stats
@@ -0,0 +1,441 @@
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Structured logs and Prometheus-style metrics for the stages.
+#
+# Spans time every Supabase request (httpx event hooks in app/utils.py), LLM
+# request (app/rate_limit.py), URL fetch (app/fetcher.py) and HTML parse
+# (app/extractors.py). Each is tagged with the task, stage and prompt_id of the
+# stage it runs in (set by the Celery task_prerun signal, see app/celery_app.py)
+# and logged at DEBUG; durations, tokens and bytes feed the metrics.
+#
+# Metrics are aggregated per process and flushed to one Redis hash after each
+# task (and every METRICS_FLUSH_INTERVAL seconds), so any worker or the Reflex
+# backend can serve cluster-wide totals at /metrics. prompt_id is only a log
+# field, never a metric label.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower() # json | text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# Port for the worker's /metrics endpoint (0 disables it); the Reflex backend serves it on its own port.
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9808"))
+
+METRICS_KEY = "tia:metrics"
+# Histogram buckets (seconds): spans range from sub-millisecond parses to multi-minute MCP stages.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICS = {
+    "tia_stage_duration_seconds": ("histogram", "Stage task run time, by stage and outcome."),
+    "tia_queue_wait_seconds": ("histogram", "Time a stage message waited in its queue before a worker started it."),
+    "tia_span_duration_seconds": ("histogram", "Database, LLM, fetch, parse and vector index call durations, by kind, operation and stage."),
+    "tia_span_errors_total": ("counter", "Spans that failed, by kind, operation and stage."),
+    "tia_llm_tokens_total": ("counter", "LLM tokens reported by the API, by model, stage and type (prompt/completion)."),
+    "tia_llm_hedges_total": ("counter", "Hedged LLM calls, by model, stage and winning request (primary/hedge/fallback/none)."),
+    "tia_llm_deadlines_total": ("counter", "LLM calls that passed their stage deadline, by model and stage."),
+    "tia_llm_breaker_total": ("counter", "LLM circuit breaker events (opened/closed/fallback/rejected), by model."),
+    "tia_fetch_bytes_total": ("counter", "Response body bytes downloaded by URL fetches, by stage."),
+    "tia_fetch_responses_total": ("counter", "URL fetch outcomes, by HTTP status (or 'error')."),
+    "tia_fetch_limited_total": ("counter", "URL fetches cut off at FETCH_MAX_BYTES (truncated) or the batch deadline (deadline), or dropped as non-text (skipped)."),
+    "tia_dedup_paragraphs_total": ("counter", "Source paragraphs dropped before MCP summarization as exact or near duplicates, by kind."),
+    "tia_dedup_tokens_removed_total": ("counter", "Tokens of duplicate source paragraphs not sent to MCP summarization."),
+    "tia_retrieval_reuse_total": ("counter", "Retrieval lookups in the vector index, by outcome (reused/augmented/miss)."),
+    "tia_fair_share_pipelines_total": ("counter", "Pipelines queued and dispatched by the fair-share scheduler, by priority."),
+    "tia_batch_prompts_total": ("counter", "Batch prompts dispatched, completed, failed or lost (no outcome in time)."),
+}
+
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar("tia_stage_context", default={})
+_pending: dict[str, float] = {}
+_pending_lock = threading.Lock()
+_flushed_at = time.monotonic()
+
+
+def _reset_after_fork():
+    # Counts inherited from the parent were (or will be) flushed by the parent.
+    global _pending_lock
+    _pending.clear()
+    _pending_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# --- Context -----------------------------------------------------------------
+
+def current_context() -> dict:
+    """task / stage / prompt_id of the stage running in this thread or coroutine ({} outside a stage)."""
+    return _context.get()
+
+
+def set_context(**fields) -> contextvars.Token:
+    return _context.set({k: v for k, v in fields.items() if v is not None})
+
+
+def reset_context(token: contextvars.Token):
+    _context.reset(token)
+
+
+def in_current_context(fn):
+    """Wrap fn to run with the caller's stage context, e.g. when handing it to a thread pool."""
+    fields = _context.get()
+
+    def bound(*args, **kwargs):
+        token = _context.set(fields)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _context.reset(token)
+    return bound
+
+
+async def with_current_context(coro, fields: dict):
+    """Await coro with `fields` as its stage context (coroutines started on another thread's loop)."""
+    token = _context.set(fields)
+    try:
+        return await coro
+    finally:
+        _context.reset(token)
+
+
+# --- Logging -----------------------------------------------------------------
+
+# LogRecord attributes; anything else on a record came from `extra=` and is logged as a field.
+_RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(_context.get())
+        entry.update({k: v for k, v in record.__dict__.items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        context = " ".join(f"{k}={v}" for k, v in _context.get().items())
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}" + (f" [{context}]" if context else "")
+        line += f" {record.getMessage()}"
+        fields = {k: v for k, v in record.__dict__.items() if k not in _RECORD_ATTRS}
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def _configure_logging():
+    # One handler on the "app" logger; propagate=False keeps Celery's root handler from printing it twice.
+    root = logging.getLogger("app")
+    if root.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for an app module (pass __name__); records carry the current stage context."""
+    _configure_logging()
+    return logging.getLogger(name if name.startswith("app") else f"app.{name}")
+
+
+log = get_logger(__name__)
+
+
+# --- Metrics -----------------------------------------------------------------
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{body}}}"
+
+
+def _add(series: str, amount: float):
+    with _pending_lock:
+        _pending[series] = _pending.get(series, 0.0) + amount
+
+
+def inc(name: str, amount: float = 1, **labels):
+    if METRICS_ENABLED:
+        _add(_series(name, labels), amount)
+        _maybe_flush()
+
+
+_histogram_keys: dict[tuple, tuple[list[str], str, str, str]] = {}
+
+
+def _histogram_series(name: str, labels: dict) -> tuple[list[str], str, str, str]:
+    """(bucket series, +Inf bucket, _sum, _count) for a histogram label set, built once per label set."""
+    cache_key = (name, tuple(sorted(labels.items())))
+    keys = _histogram_keys.get(cache_key)
+    if keys is None:
+        keys = ([_series(f"{name}_bucket", {**labels, "le": str(le)}) for le in BUCKETS],
+                _series(f"{name}_bucket", {**labels, "le": "+Inf"}),
+                _series(f"{name}_sum", labels), _series(f"{name}_count", labels))
+        _histogram_keys[cache_key] = keys
+    return keys
+
+
+def observe(name: str, seconds: float, **labels):
+    """Add one observation to histogram `name` (cumulative buckets, _sum and _count)."""
+    if not METRICS_ENABLED:
+        return
+    buckets, inf_bucket, sum_key, count_key = _histogram_series(name, labels)
+    with _pending_lock:
+        for le, key in zip(BUCKETS, buckets): # every bucket is written, so each series has the full set
+            _pending[key] = _pending.get(key, 0.0) + (1 if seconds <= le else 0)
+        for key, amount in ((inf_bucket, 1), (sum_key, seconds), (count_key, 1)):
+            _pending[key] = _pending.get(key, 0.0) + amount
+    _maybe_flush()
+
+
+def flush():
+    """Write this process's pending metric increments to Redis."""
+    global _flushed_at
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _flushed_at = time.monotonic()
+    if not pending:
+        return
+    try:
+        from app.utils import get_redis_client # app.utils logs through this module
+        pipe = get_redis_client().pipeline(transaction=False)
+        for series, amount in pending.items():
+            pipe.hincrbyfloat(METRICS_KEY, series, amount)
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Metrics flush failed; dropped {len(pending)} series updates: {e}")
+
+
+def _maybe_flush():
+    if time.monotonic() - _flushed_at >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+atexit.register(flush)
+
+
+# --- Spans -------------------------------------------------------------------
+
+def record_span(kind: str, operation: str, seconds: float, error=None, **fields):
+    """Record a finished span: duration histogram, error count and a DEBUG log line."""
+    stage = _context.get().get("stage", "none")
+    observe("tia_span_duration_seconds", seconds, kind=kind, operation=operation, stage=stage)
+    if error is not None:
+        inc("tia_span_errors_total", kind=kind, operation=operation, stage=stage)
+        fields["error"] = str(error)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"{kind} {operation}", extra={"span": kind, "operation": operation,
+                                                 "duration_ms": round(seconds * 1000, 2), **fields})
+
+
+@contextmanager
+def span(kind: str, operation: str, **fields):
+    """
+    Time a block as one `kind` call (db, llm, fetch, parse, index). The yielded dict
+    can be filled with attributes (status, bytes, tokens...) for the log line;
+    an "error" entry, or an exception, counts the span as failed.
+    """
+    started = time.perf_counter()
+    error = None
+    try:
+        yield fields
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        record_span(kind, operation, time.perf_counter() - started, error if error is not None else fields.pop("error", None),
+                    **fields)
+
+
+_usage_listeners = []
+
+
+def on_llm_usage(listener):
+    """Call listener(model, total_tokens) for every LLM usage report, in the calling stage's context."""
+    _usage_listeners.append(listener)
+
+
+def record_llm_usage(model: str, usage, fields: dict | None = None):
+    """Count prompt/completion tokens from an OpenAI usage object (and add them to a span's fields)."""
+    if usage is None:
+        return
+    stage = _context.get().get("stage", "none")
+    inc("tia_llm_tokens_total", usage.prompt_tokens, model=model, stage=stage, type="prompt")
+    inc("tia_llm_tokens_total", usage.completion_tokens, model=model, stage=stage, type="completion")
+    for listener in _usage_listeners:
+        listener(model, usage.prompt_tokens + usage.completion_tokens)
+    if fields is not None:
+        fields.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+
+def metered_stream(stream, model: str):
+    """Pass a streamed completion through, counting the usage reported in its last chunk."""
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            record_llm_usage(model, chunk.usage)
+        yield chunk
+
+
+async def ametered_stream(stream, model: str):
+    async for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            record_llm_usage(model, chunk.usage)
+        yield chunk
+
+
+def record_fetch(seconds: float, status_code: int | None, size: int, error=None, **fields):
+    stage = _context.get().get("stage", "none")
+    inc("tia_fetch_bytes_total", size, stage=stage)
+    inc("tia_fetch_responses_total", status=str(status_code) if status_code is not None else "error")
+    record_span("fetch", "http_get", seconds, error, status=status_code, bytes=size, **fields)
+
+
+# --- Stages ------------------------------------------------------------------
+
+_running: dict[str, tuple[float, str, contextvars.Token]] = {}
+
+
+def _prompt_id_from(args, kwargs):
+    if "prompt_id" in kwargs:
+        return kwargs["prompt_id"]
+    first = args[0] if args else None
+    if isinstance(first, list) and first: # chord callbacks get the group's results first
+        first = first[0]
+    if isinstance(first, dict):
+        return first.get("prompt_id")
+    return first if isinstance(first, int) else None
+
+
+def begin_stage(task_id: str, task_name: str, stage: str, args, kwargs):
+    """Start timing a stage task and set the context its spans and logs are tagged with."""
+    token = set_context(task=task_name.rsplit(".", 1)[-1], stage=stage, prompt_id=_prompt_id_from(args or (), kwargs or {}))
+    _running[task_id] = (time.perf_counter(), stage, token)
+
+
+def end_stage(task_id: str, retval, state: str | None):
+    entry = _running.pop(task_id, None)
+    if entry is None:
+        return
+    started, stage, token = entry
+    if state and state != "SUCCESS":
+        outcome = state.lower()
+    elif isinstance(retval, dict) and (retval.get("error") or str(retval.get("status", "")).endswith(("error", "error_config", "error_storage"))):
+        outcome = "error"
+    elif isinstance(retval, dict) and retval.get("status") == "duplicate_suppressed":
+        outcome = "suppressed"
+    else:
+        outcome = "ok"
+    observe("tia_stage_duration_seconds", time.perf_counter() - started, stage=stage, outcome=outcome)
+    try:
+        _context.reset(token)
+    except ValueError: # finished in a different context than it started (shouldn't happen with Celery's pools)
+        _context.set({})
+    flush()
+
+
+# --- Exposition --------------------------------------------------------------
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def _family(series: str) -> str:
+    name = series.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _sort_key(series: str):
+    # Group each family's series by label set, with buckets in ascending le then _sum and _count.
+    name, _, labels = series.partition("{")
+    family = _family(series)
+    le = [float(p[4:-1]) for p in labels.rstrip("}").split(",") if p.startswith('le="')]
+    other = ",".join(p for p in labels.rstrip("}").split(",") if not p.startswith('le="'))
+    return family, other, ("", "_bucket", "_sum", "_count").index(name[len(family):]), le[0] if le else 0.0
+
+
+def render_metrics() -> str:
+    """Cluster-wide metrics in the Prometheus text exposition format."""
+    flush()
+    from app.utils import get_redis_client # app.utils logs through this module
+    values = {k.decode("utf-8"): float(v) for k, v in get_redis_client().hgetall(METRICS_KEY).items()}
+    lines, current = [], None
+    for series in sorted(values, key=_sort_key):
+        family = _family(series)
+        if family != current:
+            kind, description = METRICS.get(family, ("untyped", ""))
+            lines.append(f"# HELP {family} {description}")
+            lines.append(f"# TYPE {family} {kind}")
+            current = family
+        lines.append(f"{series} {_format_value(values[series])}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics().encode("utf-8")
+        except Exception as e:
+            self.send_error(503, f"Metrics unavailable: {e}")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes every few seconds would drown the worker log
+
+
+def start_metrics_server(port: int = WORKER_METRICS_PORT) -> ThreadingHTTPServer | None:
+    """Serve /metrics on `port` from a daemon thread (None if disabled or the port is taken)."""
+    if not port or not METRICS_ENABLED:
+        return None
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    except OSError as e:
+        log.warning(f"Metrics endpoint not started on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    log.info(f"Serving metrics on :{port}/metrics")
+    return server
+
+
+if __name__ == "__main__":
+    # `python -m app.instrumentation` prints the current metrics.
+    sys.stdout.write(render_metrics())
@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from openai.types.chat import ChatCompletion
+
+from app.instrumentation import get_logger
+from app.resilience import FALLBACK_MODELS, aguarded_chat_completion, guarded_chat_completion
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Content-addressed cache of chat completions, stored in the broker's Redis.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 86400)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+# Comma-separated agent ids whose summaries must always be generated fresh.
+LLM_CACHE_AGENT_OPT_OUT = {a.strip() for a in os.getenv("LLM_CACHE_AGENT_OPT_OUT", "").split(",") if a.strip()}
+# Single-flight: concurrent identical requests wait for the first one's answer.
+LLM_CACHE_LOCK_TTL = int(os.getenv("LLM_CACHE_LOCK_TTL", "120"))
+LLM_CACHE_WAIT_SECONDS = float(os.getenv("LLM_CACHE_WAIT_SECONDS", "60"))
+
+KEY_PREFIX = "tia:llm:"
+LOCK_PREFIX = "tia:llm_lock:"
+LRU_KEY = "tia:llm_cache:lru"
+STATS_KEY = "tia:llm_cache:stats"
+
+# Only the holder (matching token) may release a single-flight lock: one that
+# expired mid-request and was taken by another worker is left alone.
+_UNLOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Request parameters that change the completion and therefore belong in the key.
+KEYED_PARAMS = ("max_tokens", "temperature", "top_p", "n", "stop", "presence_penalty",
+                "frequency_penalty", "seed", "response_format", "logit_bias")
+
+
+def _normalize_content(content) -> str:
+    if not isinstance(content, str):
+        return json.dumps(content, sort_keys=True)
+    return " ".join(content.split())
+
+
+def cache_key(model: str, messages: list[dict], **params) -> str:
+    """Hash of the model, whitespace-normalized messages and sampling parameters."""
+    payload = {
+        "model": model,
+        "messages": [{"role": m.get("role"), "content": _normalize_content(m.get("content"))} for m in messages],
+        "params": {k: params[k] for k in KEYED_PARAMS if params.get(k) is not None},
+    }
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+    return KEY_PREFIX + digest
+
+
+def agent_cache_enabled(agent_id) -> bool:
+    return str(agent_id) not in LLM_CACHE_AGENT_OPT_OUT
+
+
+def _record(r, key: str, counter: str, tokens_saved: int = 0):
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.hincrby(STATS_KEY, counter, 1)
+        if tokens_saved:
+            pipe.hincrby(STATS_KEY, "tokens_saved", tokens_saved)
+        if counter == "hits":
+            pipe.zadd(LRU_KEY, {key: time.time()})
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"LLM cache stats update failed: {e}")
+
+
+def _load(r, key: str) -> ChatCompletion | None:
+    data = r.get(key)
+    if data is None:
+        return None
+    response = ChatCompletion.model_validate_json(data)
+    _record(r, key, "hits", response.usage.total_tokens if response.usage else 0)
+    return response
+
+
+def _store(r, key: str, response: ChatCompletion):
+    pipe = r.pipeline(transaction=False)
+    pipe.set(key, response.model_dump_json(), ex=LLM_CACHE_TTL)
+    pipe.zadd(LRU_KEY, {key: time.time()})
+    pipe.zcard(LRU_KEY)
+    _set, _zadd, entries = pipe.execute()
+    if entries > LLM_CACHE_MAX_ENTRIES:
+        # Evict least recently used entries (expired keys are dropped from the index too).
+        for evicted_key, _score in r.zpopmin(LRU_KEY, entries - LLM_CACHE_MAX_ENTRIES):
+            r.delete(evicted_key)
+        r.hincrby(STATS_KEY, "evictions", entries - LLM_CACHE_MAX_ENTRIES)
+
+
+def _store_key(key: str, model: str, messages: list[dict], response: ChatCompletion, params: dict) -> str | None:
+    """
+    Key to cache `response` under: `key` when `model` answered, the fallback
+    model's own key when the call went there (app/resilience.py), None when
+    the answering model is neither. Names match by prefix, since the API
+    reports dated snapshots (gpt-4o-mini -> gpt-4o-mini-2024-07-18).
+    """
+    answered = response.model or model
+    candidates = [m for m in (model, FALLBACK_MODELS.get(model)) if m and (answered == m or answered.startswith(m + "-"))]
+    if not candidates:
+        log.info(f"Not caching a {answered} response to a {model} request")
+        return None
+    answering = max(candidates, key=len)
+    return key if answering == model else cache_key(answering, messages, **params)
+
+
+def cached_chat_completion(client, model: str, messages: list[dict], use_cache: bool = True, **params) -> ChatCompletion:
+    """
+    Drop-in for client.chat.completions.create(model=..., messages=..., **params).
+
+    Identical requests (after normalization) are answered from Redis. While one
+    worker is calling upstream for a key, other workers asking for the same key
+    wait for its result instead of sending a duplicate request. Redis errors
+    never fail the call; the request just goes upstream uncached.
+    """
+    if not (LLM_CACHE_ENABLED and use_cache):
+        return guarded_chat_completion(client, model, messages, **params)
+
+    key = cache_key(model, messages, **params)
+    lock_key = LOCK_PREFIX + key[len(KEY_PREFIX):]
+    lock_token = uuid.uuid4().hex
+    try:
+        r = get_redis_client()
+        cached = _load(r, key)
+        if cached is not None:
+            return cached
+
+        lock_acquired = r.set(lock_key, lock_token, nx=True, ex=LLM_CACHE_LOCK_TTL)
+        if not lock_acquired:
+            _record(r, key, "single_flight_waits")
+            deadline = time.monotonic() + LLM_CACHE_WAIT_SECONDS
+            delay = 0.05
+            while time.monotonic() < deadline and r.exists(lock_key):
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+            cached = _load(r, key)
+            if cached is not None:
+                return cached
+    except Exception as e:
+        log.warning(f"LLM cache unavailable, calling upstream directly: {e}")
+        return guarded_chat_completion(client, model, messages, **params)
+
+    try:
+        _record(r, key, "misses")
+        response = guarded_chat_completion(client, model, messages, **params)
+        try:
+            store_key = _store_key(key, model, messages, response, params)
+            if store_key is not None:
+                _store(r, store_key, response)
+        except Exception as e:
+            log.warning(f"LLM cache store failed: {e}")
+        return response
+    finally:
+        if lock_acquired:
+            try:
+                r.eval(_UNLOCK_SCRIPT, 1, lock_key, lock_token)
+            except Exception as e:
+                log.warning(f"LLM cache lock release failed: {e}")
+
+
+async def acached_chat_completion(aclient, model: str, messages: list[dict], use_cache: bool = True, **params) -> ChatCompletion:
+    """
+    cached_chat_completion for an AsyncOpenAI client. Same keys, single-flight
+    and fallbacks; Redis round trips run in a thread and waits use asyncio.sleep.
+    """
+    if not (LLM_CACHE_ENABLED and use_cache):
+        return await aguarded_chat_completion(aclient, model, messages, **params)
+
+    key = cache_key(model, messages, **params)
+    lock_key = LOCK_PREFIX + key[len(KEY_PREFIX):]
+    lock_token = uuid.uuid4().hex
+    try:
+        r = get_redis_client()
+        cached = await asyncio.to_thread(_load, r, key)
+        if cached is not None:
+            return cached
+
+        lock_acquired = await asyncio.to_thread(r.set, lock_key, lock_token, nx=True, ex=LLM_CACHE_LOCK_TTL)
+        if not lock_acquired:
+            await asyncio.to_thread(_record, r, key, "single_flight_waits")
+            deadline = time.monotonic() + LLM_CACHE_WAIT_SECONDS
+            delay = 0.05
+            while time.monotonic() < deadline and await asyncio.to_thread(r.exists, lock_key):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+            cached = await asyncio.to_thread(_load, r, key)
+            if cached is not None:
+                return cached
+    except Exception as e:
+        log.warning(f"LLM cache unavailable, calling upstream directly: {e}")
+        return await aguarded_chat_completion(aclient, model, messages, **params)
+
+    try:
+        await asyncio.to_thread(_record, r, key, "misses")
+        response = await aguarded_chat_completion(aclient, model, messages, **params)
+        try:
+            store_key = _store_key(key, model, messages, response, params)
+            if store_key is not None:
+                await asyncio.to_thread(_store, r, store_key, response)
+        except Exception as e:
+            log.warning(f"LLM cache store failed: {e}")
+        return response
+    finally:
+        if lock_acquired:
+            try:
+                await asyncio.to_thread(r.eval, _UNLOCK_SCRIPT, 1, lock_key, lock_token)
+            except Exception as e:
+                log.warning(f"LLM cache lock release failed: {e}")
+
+
+def lookup_completion(model: str, messages: list[dict], **params) -> ChatCompletion | None:
+    """Cached response for the request, or None (also when caching is disabled or Redis fails)."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    try:
+        r = get_redis_client()
+        key = cache_key(model, messages, **params)
+        cached = _load(r, key)
+        if cached is None:
+            _record(r, key, "misses")
+        return cached
+    except Exception as e:
+        log.warning(f"LLM cache lookup failed: {e}")
+        return None
+
+
+def store_completion(model: str, messages: list[dict], response: ChatCompletion, **params):
+    """Store a response produced outside cached_chat_completion (e.g. assembled from a stream)."""
+    if not LLM_CACHE_ENABLED:
+        return
+    try:
+        store_key = _store_key(cache_key(model, messages, **params), model, messages, response, params)
+        if store_key is not None:
+            _store(get_redis_client(), store_key, response)
+    except Exception as e:
+        log.warning(f"LLM cache store failed: {e}")
+
+
+def get_llm_cache_stats() -> dict:
+    """Return hits, misses, single-flight waits, evictions, tokens saved and hit rate."""
+    try:
+        r = get_redis_client()
+        stats = {k.decode("utf-8"): int(v) for k, v in r.hgetall(STATS_KEY).items()}
+        stats["entries"] = r.zcard(LRU_KEY)
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        stats["hit_rate"] = stats.get("hits", 0) / lookups if lookups else 0.0
+        return stats
+    except Exception as e:
+        log.warning(f"LLM cache stats unavailable: {e}")
+        return {}
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from app.extractors import HTML_EXTRACTOR, HTML_MAIN_CONTENT
+from app.instrumentation import get_logger
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Shared cache of extracted page text for mcp_task, stored in the broker's Redis.
+# Entries younger than PAGE_CACHE_FRESH_SECONDS are served without any network
+# access; older ones are revalidated with a conditional GET until PAGE_CACHE_TTL.
+PAGE_CACHE_ENABLED = os.getenv("PAGE_CACHE_ENABLED", "true").lower() == "true"
+PAGE_CACHE_TTL = int(os.getenv("PAGE_CACHE_TTL", "86400"))
+PAGE_CACHE_FRESH_SECONDS = int(os.getenv("PAGE_CACHE_FRESH_SECONDS", "900"))
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+KEY_PREFIX = "tia:page:"
+LRU_KEY = "tia:page_cache:lru" # sorted set: entry key -> last access time
+SIZES_KEY = "tia:page_cache:sizes" # hash: entry key -> stored text bytes
+TOTAL_BYTES_KEY = "tia:page_cache:bytes"
+STATS_KEY = "tia:page_cache:stats"
+
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+
+def canonical_url(url: str) -> str:
+    """Normalize a URL so trivially different spellings share one cache entry."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    port = parts.port
+    if port and not ((scheme == "http" and port == 80) or (scheme == "https" and port == 443)):
+        host = f"{host}:{port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith(TRACKING_PARAMS)
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+# Text extracted with a different backend or mode is a different entry.
+EXTRACTION_VARIANT = f"{HTML_EXTRACTOR}:{int(HTML_MAIN_CONTENT)}"
+
+
+def _entry_key(url: str) -> str:
+    digest = hashlib.sha256(f"{EXTRACTION_VARIANT} {canonical_url(url)}".encode("utf-8")).hexdigest()
+    return KEY_PREFIX + digest
+
+
+def _incr(counter: str, amount: int = 1):
+    try:
+        get_redis_client().hincrby(STATS_KEY, counter, amount)
+    except Exception as e:
+        log.warning(f"Page cache stats update failed: {e}")
+
+
+def lookup_pages(urls: list[str]) -> dict[str, dict]:
+    """
+    Return cached entries for the given URLs as {url: entry}.
+
+    Each entry has 'text', 'etag', 'last_modified', 'fetched_at' and 'fresh'
+    (True when it can be used without revalidation). Misses are omitted.
+    """
+    if not PAGE_CACHE_ENABLED or not urls:
+        return {}
+    try:
+        r = get_redis_client()
+        keys = [_entry_key(url) for url in urls]
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        rows = pipe.execute()
+
+        now = time.time()
+        found = {}
+        pipe = r.pipeline(transaction=False)
+        for url, key, row in zip(urls, keys, rows):
+            if not row:
+                continue
+            fetched_at = float(row.get(b"fetched_at", b"0"))
+            found[url] = {
+                "text": row.get(b"text", b"").decode("utf-8"),
+                "etag": row.get(b"etag", b"").decode("utf-8") or None,
+                "last_modified": row.get(b"last_modified", b"").decode("utf-8") or None,
+                "fetched_at": fetched_at,
+                "fresh": now - fetched_at < PAGE_CACHE_FRESH_SECONDS,
+            }
+            pipe.zadd(LRU_KEY, {key: now})
+        pipe.hincrby(STATS_KEY, "hits", sum(1 for e in found.values() if e["fresh"]))
+        pipe.hincrby(STATS_KEY, "misses", len(urls) - len(found))
+        pipe.execute()
+        return found
+    except Exception as e:
+        log.warning(f"Page cache lookup failed, fetching without cache: {e}")
+        return {}
+
+
+def conditional_headers(entry: dict) -> dict:
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def mark_revalidated(url: str, response_headers: dict | None = None):
+    """Record a 304 Not Modified: the cached text stays, its freshness is renewed."""
+    if not PAGE_CACHE_ENABLED:
+        return
+    try:
+        r = get_redis_client()
+        key = _entry_key(url)
+        now = time.time()
+        mapping = {"fetched_at": now}
+        etag = (response_headers or {}).get("ETag")
+        if etag:
+            mapping["etag"] = etag
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, PAGE_CACHE_TTL)
+        pipe.zadd(LRU_KEY, {key: now})
+        pipe.hincrby(STATS_KEY, "revalidated", 1)
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Page cache revalidation update failed for {url}: {e}")
+
+
+def store_page(url: str, text: str, response_headers: dict | None = None):
+    """Cache extracted text for a URL, evicting least recently used entries over the size cap."""
+    if not PAGE_CACHE_ENABLED:
+        return
+    headers = response_headers or {}
+    cache_control = headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control or "private" in cache_control:
+        return
+    try:
+        r = get_redis_client()
+        key = _entry_key(url)
+        size = len(text.encode("utf-8"))
+        if size > PAGE_CACHE_MAX_BYTES:
+            return
+        now = time.time()
+        previous_size = r.hget(SIZES_KEY, key)
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(key, mapping={
+            "url": canonical_url(url),
+            "text": text,
+            "etag": headers.get("ETag", ""),
+            "last_modified": headers.get("Last-Modified", ""),
+            "fetched_at": now,
+        })
+        pipe.expire(key, PAGE_CACHE_TTL)
+        pipe.zadd(LRU_KEY, {key: now})
+        pipe.hset(SIZES_KEY, key, size)
+        pipe.incrby(TOTAL_BYTES_KEY, size - int(previous_size or 0))
+        pipe.hincrby(STATS_KEY, "stores", 1)
+        pipe.execute()
+        _evict_if_needed(r)
+    except Exception as e:
+        log.warning(f"Page cache store failed for {url}: {e}")
+
+
+def _evict_if_needed(r):
+    total = int(r.get(TOTAL_BYTES_KEY) or 0)
+    evicted = 0
+    while total > PAGE_CACHE_MAX_BYTES:
+        oldest = r.zpopmin(LRU_KEY, 1)
+        if not oldest:
+            break
+        key = oldest[0][0]
+        size = int(r.hget(SIZES_KEY, key) or 0)
+        pipe = r.pipeline(transaction=False)
+        pipe.delete(key)
+        pipe.hdel(SIZES_KEY, key)
+        pipe.decrby(TOTAL_BYTES_KEY, size)
+        pipe.execute()
+        total -= size
+        evicted += 1
+    if evicted:
+        _incr("evictions", evicted)
+
+
+def record_bypass(count: int = 1):
+    _incr("bypassed", count)
+
+
+def get_page_cache_stats() -> dict:
+    """Return hit/miss/revalidate/store/eviction counters and current cache size."""
+    try:
+        r = get_redis_client()
+        stats = {k.decode("utf-8"): int(v) for k, v in r.hgetall(STATS_KEY).items()}
+        stats["entries"] = r.zcard(LRU_KEY)
+        stats["bytes"] = int(r.get(TOTAL_BYTES_KEY) or 0)
+        return stats
+    except Exception as e:
+        log.warning(f"Page cache stats unavailable: {e}")
+        return {}
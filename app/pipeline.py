@@ -0,0 +1,134 @@
+import os
+import time
+
+from celery import chain, group, uuid
+
+from app import fair_share
+from app.celery_app import celery_app
+from app.dispatch import TASKS, signature
+from app.fair_share import FAIR_SHARE_ENABLED
+from app.idempotency import claim_dispatch
+from app.instrumentation import get_logger
+from app.progress import publish_status
+from app.queues import PRIORITIES
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Declared stage graph for one prompt:
+#
+#   retrieval ──> summary ──┐
+#            └──> mcp ──────┴──> pipeline_complete      (mcp only when URLs are given)
+#
+# Each stage receives the previous stage's output dict as its first argument,
+# so it can skip re-reading 'results', and starts as soon as that stage ends.
+# Tasks are referenced by name (app/dispatch.py), so dispatching never imports app.tasks.
+STAGES = {
+    "retrieval": {"task": TASKS["retrieval"][0], "after": None, "optional": False},
+    "summary": {"task": TASKS["summary"][0], "after": "retrieval", "optional": False},
+    "mcp": {"task": TASKS["mcp"][0], "after": "retrieval", "optional": True},
+}
+FINAL_TASK = TASKS["complete"][0]
+
+DEFAULT_AGENT_ID = int(os.getenv("DEFAULT_AGENT_ID", "1"))
+
+# Per-stage retry policy for transient failures (database/network errors):
+# up to max_retries attempts, waiting backoff * 2**attempt seconds.
+STAGE_RETRY_POLICIES = {
+    "retrieval": {"max_retries": int(os.getenv("RETRIEVAL_MAX_RETRIES", "2")), "backoff": float(os.getenv("RETRIEVAL_RETRY_BACKOFF", "2"))},
+    "summary": {"max_retries": int(os.getenv("SUMMARY_MAX_RETRIES", "2")), "backoff": float(os.getenv("SUMMARY_RETRY_BACKOFF", "2"))},
+    "mcp": {"max_retries": int(os.getenv("MCP_MAX_RETRIES", "1")), "backoff": float(os.getenv("MCP_RETRY_BACKOFF", "5"))},
+}
+
+LATENCY_KEY = "tia:pipeline:latency_ms"
+LATENCY_SAMPLES = int(os.getenv("PIPELINE_LATENCY_SAMPLES", "1000"))
+
+
+def retry_countdown(stage: str, retries: int, error: Exception) -> float | None:
+    """Seconds to wait before retrying a failed stage, or None if it should fail now."""
+    if isinstance(error, ValueError): # configuration errors won't fix themselves
+        return None
+    policy = STAGE_RETRY_POLICIES[stage]
+    if retries >= policy["max_retries"]:
+        return None
+    return policy["backoff"] * (2 ** retries)
+
+
+def build_pipeline(prompt_id: int, user_prompt: str, agent_id: int = DEFAULT_AGENT_ID, urls: list[str] | None = None,
+                   priority: str = "interactive", batch_id: str | None = None, final_task_id: str | None = None,
+                   user_id: str | None = None):
+    """
+    Celery canvas for a prompt: retrieval, then summary (and mcp in parallel), then completion.
+    Each stage goes to its own queue (app.queues.TASK_ROUTES) at the given priority
+    ('interactive' prompts are taken ahead of 'bulk' ones on every queue). Prompts
+    of a batch (app.batches) report their outcome to it when they complete.
+    final_task_id fixes the completion task's id, so its result can be awaited
+    before the pipeline is dispatched (app.fair_share). user_id, the prompt's
+    user, reaches retrieval and MCP (through retrieval's output).
+    """
+    started_at = time.time()
+    options = {"priority": PRIORITIES[priority]}
+    retrieval_payload = {"prompt_id": prompt_id, "user_prompt": user_prompt}
+    if user_id is not None:
+        retrieval_payload["user_id"] = user_id
+    retrieval = signature("retrieval", retrieval_payload, **options)
+    summary = signature("summary", {"agent_id": agent_id}, **options)
+    final_payload = {"prompt_id": prompt_id, "started_at": started_at}
+    if batch_id is not None:
+        final_payload["batch_id"] = batch_id
+    final = signature("complete", final_payload, **options)
+    if final_task_id is not None:
+        final.set(task_id=final_task_id)
+
+    if urls:
+        mcp = signature("mcp", {"urls": urls}, **options)
+        # chain(task, group, task) becomes a chord: the final task waits for both branches.
+        return chain(retrieval, group(summary, mcp), final)
+    return chain(retrieval, summary, final)
+
+
+def start_pipeline(prompt_id: int, user_prompt: str, agent_id: int = DEFAULT_AGENT_ID, urls: list[str] | None = None,
+                   priority: str = "interactive", user_id: str | None = None):
+    """
+    Dispatch the whole stage graph for a prompt; no later UI action is needed
+    to advance it. With fair-share scheduling the pipeline waits in its user's
+    queue until it gets a slot (app.fair_share). Returns the AsyncResult of the
+    completion task, or None if the prompt was already dispatched.
+    """
+    if not claim_dispatch(prompt_id, "pipeline"):
+        log.info(f"Pipeline for prompt_id {prompt_id} already dispatched; ignoring duplicate")
+        return None
+    # Marks the prompt as pipelined, so progress watchers wait for pipeline_complete.
+    publish_status(prompt_id, "pending_retrieval", pipeline=True)
+    if FAIR_SHARE_ENABLED:
+        task_id = uuid()
+        fair_share.submit(prompt_id, user_prompt, agent_id, urls or [], priority, task_id, user_id=user_id)
+        return celery_app.AsyncResult(task_id)
+    return build_pipeline(prompt_id, user_prompt, agent_id, urls, priority, user_id=user_id).apply_async()
+
+
+def record_pipeline_latency(latency_ms: float):
+    try:
+        r = get_redis_client()
+        pipe = r.pipeline(transaction=False)
+        pipe.lpush(LATENCY_KEY, round(latency_ms, 1))
+        pipe.ltrim(LATENCY_KEY, 0, LATENCY_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Failed to record pipeline latency: {e}")
+
+
+def get_pipeline_latency_stats() -> dict:
+    """p50/p95/p99/max end-to-end latency (ms) over the last PIPELINE_LATENCY_SAMPLES prompts."""
+    try:
+        samples = sorted(float(v) for v in get_redis_client().lrange(LATENCY_KEY, 0, -1))
+    except Exception as e:
+        log.warning(f"Pipeline latency stats unavailable: {e}")
+        return {}
+    if not samples:
+        return {"count": 0}
+
+    def percentile(p: float) -> float:
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {"count": len(samples), "p50": percentile(50), "p95": percentile(95), "p99": percentile(99), "max": samples[-1]}
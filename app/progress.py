@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+import redis.asyncio as aioredis
+
+from app.instrumentation import get_logger
+from app.utils import REDIS_URL, get_redis_client
+
+log = get_logger(__name__)
+
+# Stage transitions are published by the tasks on a per-prompt pub/sub channel
+# and mirrored into a short-lived status hash. The Reflex State subscribes to
+# the channel; the hash lets reconnecting clients catch up without Supabase.
+PROGRESS_CHANNEL_PREFIX = "tia:progress:"
+STATUS_CACHE_PREFIX = "tia:prompt_status:"
+STATUS_CACHE_TTL = int(os.getenv("STATUS_CACHE_TTL", "3600"))
+PROGRESS_WATCH_TIMEOUT = float(os.getenv("PROGRESS_WATCH_TIMEOUT", "900"))
+
+# Statuses after which nothing more happens for a prompt without user action.
+TERMINAL_STATUSES = {
+    "completed", "retrieval_error", "summary_error", "summary_error_config",
+    "mcp_complete", "mcp_error", "mcp_error_config", "mcp_error_storage",
+}
+
+
+def _channel(prompt_id: int) -> str:
+    return f"{PROGRESS_CHANNEL_PREFIX}{prompt_id}"
+
+
+def _cache_key(prompt_id: int) -> str:
+    return f"{STATUS_CACHE_PREFIX}{prompt_id}"
+
+
+def publish_status(prompt_id: int, status: str, **fields):
+    """
+    Publish a stage transition (plus optional outputs such as summary,
+    processed_options or mcp_data) to subscribers and the status cache.
+    Failures are logged and never affect the task.
+    """
+    event = {"prompt_id": prompt_id, "status": status, "updated_at": datetime.now().isoformat(), **fields}
+    try:
+        r = get_redis_client()
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(_cache_key(prompt_id), mapping={k: json.dumps(v) for k, v in event.items()})
+        pipe.expire(_cache_key(prompt_id), STATUS_CACHE_TTL)
+        pipe.publish(_channel(prompt_id), json.dumps(event))
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Failed to publish status '{status}' for prompt_id {prompt_id}: {e}")
+
+
+def publish_stage(prompt_id: int, stage: str, status: str, **fields):
+    """
+    Publish the status of a stage that runs alongside another one (e.g. mcp
+    next to summarization in a pipeline) as '<stage>_status', leaving the
+    prompt's main status untouched.
+    """
+    event = {"prompt_id": prompt_id, f"{stage}_status": status, "updated_at": datetime.now().isoformat(), **fields}
+    try:
+        r = get_redis_client()
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(_cache_key(prompt_id), mapping={k: json.dumps(v) for k, v in event.items()})
+        pipe.expire(_cache_key(prompt_id), STATUS_CACHE_TTL)
+        pipe.publish(_channel(prompt_id), json.dumps(event))
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Failed to publish {stage} status '{status}' for prompt_id {prompt_id}: {e}")
+
+
+def is_finished(state: dict) -> bool:
+    """Whether a prompt's state is final. Pipelined prompts finish only at pipeline_complete."""
+    if state.get("pipeline"):
+        return bool(state.get("pipeline_complete"))
+    return state.get("status") in TERMINAL_STATUSES
+
+
+def get_cached_status(prompt_id: int) -> dict | None:
+    """Latest published state for a prompt (status and any outputs), or None."""
+    try:
+        row = get_redis_client().hgetall(_cache_key(prompt_id))
+    except Exception as e:
+        log.warning(f"Status cache unavailable for prompt_id {prompt_id}: {e}")
+        return None
+    if not row:
+        return None
+    return {k.decode("utf-8"): json.loads(v) for k, v in row.items()}
+
+
+async def subscribe_progress(prompt_id: int, timeout: float = PROGRESS_WATCH_TIMEOUT):
+    """
+    Async generator of progress events for a prompt.
+
+    Subscribes first and then yields the cached state, so a transition that
+    happens in between is not lost. Stops after a terminal status (for
+    pipelined prompts, after pipeline_complete) or timeout.
+    """
+    client = aioredis.from_url(REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(_channel(prompt_id))
+        cached = await client.hgetall(_cache_key(prompt_id))
+        if cached:
+            event = {k.decode("utf-8"): json.loads(v) for k, v in cached.items()}
+            yield event
+            pipelined = bool(event.get("pipeline"))
+            if is_finished(event):
+                return
+        else:
+            pipelined = False
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                await asyncio.sleep(0)
+                continue
+            event = json.loads(message["data"])
+            pipelined = pipelined or bool(event.get("pipeline"))
+            yield event
+            if is_finished({**event, "pipeline": pipelined}):
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,172 @@
+import json
+import math
+import os
+import sys
+import time
+
+from app.instrumentation import get_logger, observe
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Named queues, so a backlog of slow MCP scrapes can't hold up quick retrieval
+# calls. Per-queue worker settings apply to workers consuming that queue
+# (WORKER_QUEUES); a worker consuming several queues adds up their concurrency
+# and uses the smallest prefetch multiplier.
+#   concurrency  - worker processes (or threads in asyncio mode)
+#   prefetch     - messages reserved per process; keep 1 for long tasks so they
+#                  don't sit behind a busy process while others are idle
+#   target_wait  - seconds a message may wait before the autoscaler adds processes
+QUEUES = {
+    "retrieval": {
+        "concurrency": int(os.getenv("RETRIEVAL_QUEUE_CONCURRENCY", "4")),
+        "prefetch": int(os.getenv("RETRIEVAL_QUEUE_PREFETCH", "4")),
+        "target_wait": float(os.getenv("RETRIEVAL_QUEUE_TARGET_WAIT", "2")),
+    },
+    "summary": {
+        "concurrency": int(os.getenv("SUMMARY_QUEUE_CONCURRENCY", "4")),
+        "prefetch": int(os.getenv("SUMMARY_QUEUE_PREFETCH", "1")),
+        "target_wait": float(os.getenv("SUMMARY_QUEUE_TARGET_WAIT", "10")),
+    },
+    "mcp": {
+        "concurrency": int(os.getenv("MCP_QUEUE_CONCURRENCY", "4")),
+        "prefetch": int(os.getenv("MCP_QUEUE_PREFETCH", "1")),
+        "target_wait": float(os.getenv("MCP_QUEUE_TARGET_WAIT", "60")),
+    },
+}
+DEFAULT_QUEUE = "retrieval"
+WORKER_QUEUES = [q.strip() for q in os.getenv("WORKER_QUEUES", ",".join(QUEUES)).split(",") if q.strip()]
+
+# Pipeline completion and batch/fair-share dispatch are quick bookkeeping steps, so they share the retrieval queue.
+TASK_ROUTES = {
+    "app.tasks.information_retrieval_task": {"queue": "retrieval"},
+    "app.tasks.process_and_summarize_task": {"queue": "summary"},
+    "app.tasks.mcp_task": {"queue": "mcp"},
+    "app.tasks.pipeline_complete_task": {"queue": "retrieval"},
+    "app.tasks.batch_dispatch_task": {"queue": "retrieval"},
+    "app.tasks.fair_share_dispatch_task": {"queue": "retrieval"},
+}
+# Stage label for each task in metrics and logs.
+TASK_STAGES = {
+    "app.tasks.information_retrieval_task": "retrieval",
+    "app.tasks.process_and_summarize_task": "summary",
+    "app.tasks.mcp_task": "mcp",
+    "app.tasks.pipeline_complete_task": "complete",
+}
+
+# Message priorities. With the Redis broker, lower numbers are consumed first,
+# and kombu buckets them into PRIORITY_STEPS (one Redis list per step).
+PRIORITIES = {"interactive": 0, "default": 3, "bulk": 6}
+PRIORITY_STEPS = [0, 3, 6, 9]
+PRIORITY_SEP = "\x06\x16" # kombu's separator between queue name and priority step
+
+# Queue-depth autoscaling (prefork pool, started with --autoscale=max,min; see app/autoscaler.py):
+# aim for AUTOSCALE_DEPTH_PER_PROCESS waiting messages per process, and double
+# the pool whenever the oldest message has waited longer than target_wait.
+AUTOSCALE_DEPTH_PER_PROCESS = int(os.getenv("AUTOSCALE_DEPTH_PER_PROCESS", "2"))
+AUTOSCALE_CHECK_INTERVAL = float(os.getenv("AUTOSCALE_CHECK_INTERVAL", "5"))
+
+ENQUEUED_AT_HEADER = "tia_enqueued_at"
+WAIT_SAMPLES = int(os.getenv("QUEUE_WAIT_SAMPLES", "1000"))
+
+
+def _wait_key(queue: str) -> str:
+    return f"tia:queue:{queue}:wait_ms"
+
+
+def worker_settings(queues: list[str]) -> tuple[int, int]:
+    """(concurrency, prefetch multiplier) for a worker consuming these queues."""
+    known = [QUEUES[q] for q in queues if q in QUEUES] or list(QUEUES.values())
+    return sum(q["concurrency"] for q in known), min(q["prefetch"] for q in known)
+
+
+def _priority_keys(queue: str) -> list[str]:
+    return [queue if step == 0 else f"{queue}{PRIORITY_SEP}{step}" for step in PRIORITY_STEPS]
+
+
+def stamp_enqueued_at(headers: dict):
+    """Record publish time in the message headers, for wait-time and age metrics."""
+    headers.setdefault(ENQUEUED_AT_HEADER, time.time())
+
+
+def record_queue_wait(queue: str | None, enqueued_at) -> None:
+    """Store how long a message sat in `queue` before a worker started it."""
+    if not queue or enqueued_at is None:
+        return
+    try:
+        wait_ms = max(0.0, (time.time() - float(enqueued_at)) * 1000)
+        observe("tia_queue_wait_seconds", wait_ms / 1000, queue=queue)
+        r = get_redis_client()
+        pipe = r.pipeline(transaction=False)
+        pipe.lpush(_wait_key(queue), round(wait_ms, 1))
+        pipe.ltrim(_wait_key(queue), 0, WAIT_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Failed to record queue wait for {queue}: {e}")
+
+
+def queue_depth(queue: str) -> dict:
+    """Waiting messages per priority step, and the age (s) of the oldest one."""
+    r = get_redis_client()
+    keys = _priority_keys(queue)
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.llen(key)
+        pipe.lindex(key, -1) # kombu LPUSHes and BRPOPs, so the tail is the oldest message
+    replies = pipe.execute()
+
+    by_priority, oldest = {}, None
+    for step, size, tail in zip(PRIORITY_STEPS, replies[::2], replies[1::2]):
+        by_priority[step] = size
+        if tail is None:
+            continue
+        try:
+            enqueued_at = float(json.loads(tail)["headers"][ENQUEUED_AT_HEADER])
+        except (ValueError, KeyError, TypeError):
+            continue
+        oldest = enqueued_at if oldest is None else min(oldest, enqueued_at)
+    return {
+        "depth": sum(by_priority.values()),
+        "depth_by_priority": by_priority,
+        "oldest_age_s": round(time.time() - oldest, 1) if oldest is not None else 0.0,
+    }
+
+
+def desired_concurrency(queues: list[str], current: int, min_concurrency: int, max_concurrency: int) -> int:
+    """Pool size the autoscaler should aim for, from the depth and age of `queues`."""
+    depth, lagging = 0, False
+    for queue in queues:
+        stats = queue_depth(queue)
+        depth += stats["depth"]
+        target_wait = QUEUES.get(queue, {}).get("target_wait")
+        if target_wait is not None and stats["oldest_age_s"] > target_wait:
+            lagging = True
+    desired = math.ceil(depth / max(1, AUTOSCALE_DEPTH_PER_PROCESS))
+    if lagging:
+        desired = max(desired, current * 2, current + 1)
+    return max(min_concurrency, min(max_concurrency, desired))
+
+
+def get_queue_stats() -> dict:
+    """Depth, oldest message age and p50/p95/max wait (ms) over the last QUEUE_WAIT_SAMPLES tasks, per queue."""
+    stats = {}
+    for queue in QUEUES:
+        try:
+            entry = queue_depth(queue)
+            samples = sorted(float(v) for v in get_redis_client().lrange(_wait_key(queue), 0, -1))
+        except Exception as e:
+            log.warning(f"Queue stats unavailable for {queue}: {e}")
+            continue
+        entry["wait_count"] = len(samples)
+        if samples:
+            entry["wait_ms_p50"] = samples[min(len(samples) - 1, int(0.5 * len(samples)))]
+            entry["wait_ms_p95"] = samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+            entry["wait_ms_max"] = samples[-1]
+        stats[queue] = entry
+    return stats
+
+
+if __name__ == "__main__":
+    # `python -m app.queues` prints current queue metrics, e.g. for an external autoscaler.
+    json.dump(get_queue_stats(), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,476 @@
+import asyncio
+import os
+import random
+import time
+import uuid
+
+import openai
+
+from app.instrumentation import ametered_stream, get_logger, metered_stream, record_llm_usage, span
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Cluster-wide OpenAI budget shared by every worker through Redis:
+#   * token buckets for requests/minute and tokens/minute per model,
+#   * a pause for all workers when the API answers 429 with Retry-After,
+#   * an AIMD concurrency limit per model: +1 slot per window of successful
+#     calls, halved (at most once per cooldown) on a 429.
+# Redis errors never block a call; it then goes out unthrottled.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+OPENAI_DEFAULT_RPM = int(os.getenv("OPENAI_DEFAULT_RPM", "3500"))
+OPENAI_DEFAULT_TPM = int(os.getenv("OPENAI_DEFAULT_TPM", "90000"))
+# Per-model budgets, e.g. "gpt-3.5-turbo=3500:160000,gpt-4o=500:30000" (model=rpm:tpm).
+OPENAI_MODEL_LIMITS = os.getenv("OPENAI_MODEL_LIMITS", "")
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", "1"))
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", "60"))
+# Longest a call waits for budget before going out anyway (the API then decides).
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "120"))
+AIMD_INITIAL_CONCURRENCY = float(os.getenv("AIMD_INITIAL_CONCURRENCY", "8"))
+AIMD_MIN_CONCURRENCY = float(os.getenv("AIMD_MIN_CONCURRENCY", "1"))
+AIMD_MAX_CONCURRENCY = float(os.getenv("AIMD_MAX_CONCURRENCY", "64"))
+AIMD_DECREASE_COOLDOWN = float(os.getenv("AIMD_DECREASE_COOLDOWN", "5"))
+# A slot held longer than this (crashed worker) is reclaimed.
+AIMD_SLOT_TTL = float(os.getenv("AIMD_SLOT_TTL", "300"))
+
+KEY_PREFIX = "tia:ratelimit:"
+STATS_KEY = "tia:ratelimit:stats"
+
+# Refill both buckets, then take 1 request and `cost` tokens if both have
+# enough. Returns 0 on success, otherwise the milliseconds until they will.
+_TAKE_SCRIPT = """
+local now = tonumber(ARGV[4])
+local blocked = tonumber(redis.call('get', KEYS[3]) or '0')
+if blocked > now then
+    return blocked - now
+end
+local function level(key, capacity, rate)
+    local b = redis.call('hmget', key, 'tokens', 'ts')
+    local tokens = tonumber(b[1]) or capacity
+    local ts = tonumber(b[2]) or now
+    return math.min(capacity, tokens + math.max(0, now - ts) * rate)
+end
+local rpm, tpm = tonumber(ARGV[1]), tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), tpm)
+local requests = level(KEYS[1], rpm, rpm / 60000)
+local tokens = level(KEYS[2], tpm, tpm / 60000)
+if requests >= 1 and tokens >= cost then
+    redis.call('hset', KEYS[1], 'tokens', requests - 1, 'ts', now)
+    redis.call('hset', KEYS[2], 'tokens', tokens - cost, 'ts', now)
+    redis.call('pexpire', KEYS[1], 120000)
+    redis.call('pexpire', KEYS[2], 120000)
+    return 0
+end
+local wait = 0
+if requests < 1 then wait = (1 - requests) / (rpm / 60000) end
+if tokens < cost then wait = math.max(wait, (cost - tokens) / (tpm / 60000)) end
+return math.ceil(wait)
+"""
+
+# Take a concurrency slot if fewer than floor(limit) are held.
+_SLOT_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+local limit = tonumber(redis.call('get', KEYS[2]) or ARGV[4])
+if redis.call('zcard', KEYS[1]) < math.floor(limit) then
+    redis.call('zadd', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# Additive increase: +1 slot once `limit` calls have succeeded.
+_INCREASE_SCRIPT = """
+local limit = tonumber(redis.call('get', KEYS[1]) or ARGV[1])
+redis.call('set', KEYS[1], math.min(tonumber(ARGV[2]), limit + 1 / limit))
+"""
+
+
+def _parse_model_limits(spec: str) -> dict:
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        model, budget = item.split("=", 1)
+        rpm, _, tpm = budget.partition(":")
+        limits[model.strip()] = (int(rpm), int(tpm or OPENAI_DEFAULT_TPM))
+    return limits
+
+
+MODEL_LIMITS = _parse_model_limits(OPENAI_MODEL_LIMITS)
+
+
+class LimiterWaitExceeded(Exception):
+    """
+    The call deadline passed while waiting for this limiter (budget or a slot),
+    before a request was sent. Deliberately not a TimeoutError: it says
+    nothing about the upstream's health.
+    """
+
+
+def model_budget(model: str) -> tuple[int, int]:
+    """(requests per minute, tokens per minute) for a model."""
+    return MODEL_LIMITS.get(model, (OPENAI_DEFAULT_RPM, OPENAI_DEFAULT_TPM))
+
+
+def estimate_tokens(messages: list[dict], max_tokens: int | None = None) -> int:
+    """Tokens the API counts against TPM: prompt (~4 chars/token) plus max_tokens."""
+    chars = sum(len(m.get("content") or "") for m in messages if isinstance(m.get("content"), str))
+    return chars // 4 + 4 * len(messages) + (max_tokens or 256)
+
+
+def _key(model: str, name: str) -> str:
+    return f"{KEY_PREFIX}{model}:{name}"
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _count(model: str, counter: str, amount: int = 1):
+    try:
+        get_redis_client().hincrby(STATS_KEY, f"{model}:{counter}", amount)
+    except Exception as e:
+        log.warning(f"Rate limiter stats update failed: {e}")
+
+
+def try_take_budget(model: str, tokens: int) -> int:
+    """One attempt to take budget for a call: 0 if taken, else milliseconds to wait before trying again."""
+    rpm, tpm = model_budget(model)
+    return get_redis_client().eval(_TAKE_SCRIPT, 3, _key(model, "rpm"), _key(model, "tpm"), _key(model, "blocked_until"),
+                                   rpm, tpm, tokens, _now_ms())
+
+
+def try_acquire_slot(model: str, slot: str) -> bool:
+    """One attempt to take an AIMD concurrency slot for the model."""
+    return bool(get_redis_client().eval(_SLOT_SCRIPT, 2, _key(model, "slots"), _key(model, "limit"),
+                                        slot, _now_ms(), int(AIMD_SLOT_TTL * 1000), AIMD_INITIAL_CONCURRENCY))
+
+
+def _wait_deadline(call_deadline: float | None) -> float:
+    return min(time.monotonic() + RATE_LIMIT_MAX_WAIT, call_deadline if call_deadline is not None else float("inf"))
+
+
+def _check_deadline(model: str, call_deadline: float | None, waiting_for: str):
+    if call_deadline is not None and time.monotonic() >= call_deadline:
+        raise LimiterWaitExceeded(f"{model}: call deadline passed while waiting for {waiting_for}")
+
+
+def wait_for_budget(model: str, tokens: int, call_deadline: float | None = None):
+    """
+    Block until the model's RPM/TPM buckets admit one call of `tokens` tokens.
+    Raises LimiterWaitExceeded if call_deadline (time.monotonic()) passes first.
+    """
+    deadline = _wait_deadline(call_deadline)
+    waited_ms = 0
+    while True:
+        wait_ms = try_take_budget(model, tokens)
+        if not wait_ms:
+            break
+        if time.monotonic() >= deadline:
+            _check_deadline(model, call_deadline, "rate-limit budget")
+            log.warning(f"Rate limiter: waited {RATE_LIMIT_MAX_WAIT}s for {model} budget; sending anyway")
+            break
+        # Jitter spreads out workers that were all told to wait the same time.
+        sleep_s = min(wait_ms / 1000 * random.uniform(1.0, 1.2), deadline - time.monotonic())
+        time.sleep(max(0.005, sleep_s))
+        waited_ms += int(sleep_s * 1000)
+    if waited_ms:
+        _count(model, "wait_ms", waited_ms)
+
+
+def reconcile_tokens(model: str, estimated: int, actual: int):
+    """Return (or charge) the difference between the estimated and the reported token usage."""
+    try:
+        get_redis_client().hincrbyfloat(_key(model, "tpm"), "tokens", estimated - actual)
+    except Exception as e:
+        log.warning(f"Rate limiter token reconcile failed: {e}")
+
+
+def acquire_slot(model: str, call_deadline: float | None = None) -> str | None:
+    """Take one of the model's AIMD concurrency slots, waiting if all are busy. Returns the slot id."""
+    slot = uuid.uuid4().hex
+    deadline = _wait_deadline(call_deadline)
+    delay = 0.02
+    while time.monotonic() < deadline:
+        if try_acquire_slot(model, slot):
+            return slot
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, 0.5)
+    _check_deadline(model, call_deadline, "a concurrency slot")
+    log.warning(f"Rate limiter: no {model} concurrency slot after {RATE_LIMIT_MAX_WAIT}s; sending anyway")
+    return None
+
+
+def release_slot(model: str, slot: str | None, outcome: str = "ok"):
+    """Free a slot and adapt the limit: grow after "ok", halve after "throttled", keep after "error"."""
+    if slot is None:
+        return
+    try:
+        r = get_redis_client()
+        r.zrem(_key(model, "slots"), slot)
+        if outcome == "throttled":
+            # Multiplicative decrease, once per cooldown so a burst of 429s counts once.
+            if r.set(_key(model, "decrease_cooldown"), 1, nx=True, px=int(AIMD_DECREASE_COOLDOWN * 1000)):
+                limit = float(r.get(_key(model, "limit")) or AIMD_INITIAL_CONCURRENCY)
+                r.set(_key(model, "limit"), max(AIMD_MIN_CONCURRENCY, limit / 2))
+        elif outcome == "ok":
+            r.eval(_INCREASE_SCRIPT, 1, _key(model, "limit"), AIMD_INITIAL_CONCURRENCY, AIMD_MAX_CONCURRENCY)
+    except Exception as e:
+        log.warning(f"Rate limiter slot release failed (it will expire): {e}")
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    """Retry-After (or retry-after-ms) from an API error response, in seconds."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass # HTTP-date form; fall back to exponential backoff
+    return None
+
+
+def backoff_seconds(attempt: int, retry_after: float | None = None) -> float:
+    if retry_after is not None:
+        return retry_after + random.uniform(0, min(1.0, retry_after * 0.2))
+    # Full jitter: uniform over [0, base * 2**attempt].
+    return random.uniform(0, min(RATE_LIMIT_BACKOFF_MAX, RATE_LIMIT_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _retry_delay(error: Exception, attempt: int, retry_after: float | None, call_deadline: float | None) -> float:
+    """Backoff before the next attempt; re-raises `error` if that would run past call_deadline."""
+    delay = backoff_seconds(attempt, retry_after)
+    if call_deadline is not None and time.monotonic() + delay >= call_deadline:
+        raise error
+    return delay
+
+
+def _with_timeout(params: dict, call_deadline: float | None) -> dict:
+    """Bound the HTTP request by what is left of call_deadline (unless the caller set a timeout)."""
+    if call_deadline is None or "timeout" in params:
+        return params
+    remaining = call_deadline - time.monotonic()
+    if remaining <= 0:
+        raise LimiterWaitExceeded("call deadline passed before the request was sent")
+    return {**params, "timeout": remaining}
+
+
+def pause_model(model: str, seconds: float):
+    """Make every worker hold off calls to `model` for `seconds` (after a 429 with Retry-After)."""
+    try:
+        get_redis_client().set(_key(model, "blocked_until"), _now_ms() + int(seconds * 1000), px=int(seconds * 1000) + 1000)
+    except Exception as e:
+        log.warning(f"Rate limiter pause failed: {e}")
+
+
+def _stream_and_release(stream, model: str, slot: str | None, estimated: int):
+    actual = None
+    finished = False
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                actual = chunk.usage.total_tokens
+            yield chunk
+        finished = True
+    finally:
+        release_slot(model, slot, "ok" if finished else "error")
+        if actual is not None:
+            reconcile_tokens(model, estimated, actual)
+
+
+def limited_chat_completion(client, model: str, messages: list[dict], call_deadline: float | None = None, **params):
+    """
+    client.chat.completions.create(model=..., messages=..., **params) under the
+    cluster-wide budget. 429s, connection errors and 5xx are retried here
+    (Retry-After aware, with jitter) instead of by the OpenAI client, so
+    retries also go through the limiter. With stream=True the returned
+    iterator holds its concurrency slot until it is exhausted.
+
+    call_deadline (a time.monotonic() value, see app/resilience.py) bounds
+    the whole call: waiting for budget, each request's timeout and retries.
+    LimiterWaitExceeded (or the last API error, e.g. APITimeoutError) is
+    raised once it has passed.
+    """
+    # The "llm" span includes time spent waiting for budget; streamed tokens are counted at the end of the stream.
+    with span("llm", model, stream=bool(params.get("stream"))) as fields:
+        response = _limited_chat_completion(client, model, messages, call_deadline, **params)
+        if params.get("stream"):
+            return metered_stream(response, model)
+        record_llm_usage(model, getattr(response, "usage", None), fields)
+        return response
+
+
+def _limited_chat_completion(client, model: str, messages: list[dict], call_deadline: float | None = None, **params):
+    if not RATE_LIMIT_ENABLED:
+        return client.chat.completions.create(model=model, messages=messages, **_with_timeout(params, call_deadline))
+
+    raw_client = client.with_options(max_retries=0)
+    estimated = estimate_tokens(messages, params.get("max_tokens"))
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        try:
+            wait_for_budget(model, estimated, call_deadline)
+            slot = acquire_slot(model, call_deadline)
+        except LimiterWaitExceeded:
+            raise
+        except Exception as e:
+            log.warning(f"Rate limiter unavailable, calling upstream directly: {e}")
+            return client.chat.completions.create(model=model, messages=messages, **_with_timeout(params, call_deadline))
+
+        try:
+            response = raw_client.chat.completions.create(model=model, messages=messages, **_with_timeout(params, call_deadline))
+        except openai.RateLimitError as e:
+            retry_after = retry_after_seconds(e)
+            release_slot(model, slot, "throttled")
+            _count(model, "throttled")
+            if retry_after is not None:
+                pause_model(model, retry_after)
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            time.sleep(_retry_delay(e, attempt, retry_after, call_deadline))
+            continue
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            release_slot(model, slot, "error")
+            _count(model, "transient_errors")
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            time.sleep(_retry_delay(e, attempt, retry_after_seconds(e), call_deadline))
+            continue
+        except Exception:
+            release_slot(model, slot, "error")
+            raise
+
+        _count(model, "requests")
+        if params.get("stream"):
+            return _stream_and_release(response, model, slot, estimated)
+        release_slot(model, slot)
+        if getattr(response, "usage", None) is not None:
+            reconcile_tokens(model, estimated, response.usage.total_tokens)
+        return response
+
+
+async def await_budget(model: str, tokens: int, call_deadline: float | None = None):
+    """wait_for_budget for coroutines: waits with asyncio.sleep; each Redis round trip runs in a thread."""
+    deadline = _wait_deadline(call_deadline)
+    waited_ms = 0
+    while True:
+        wait_ms = await asyncio.to_thread(try_take_budget, model, tokens)
+        if not wait_ms:
+            break
+        if time.monotonic() >= deadline:
+            _check_deadline(model, call_deadline, "rate-limit budget")
+            log.warning(f"Rate limiter: waited {RATE_LIMIT_MAX_WAIT}s for {model} budget; sending anyway")
+            break
+        sleep_s = min(wait_ms / 1000 * random.uniform(1.0, 1.2), deadline - time.monotonic())
+        await asyncio.sleep(max(0.005, sleep_s))
+        waited_ms += int(sleep_s * 1000)
+    if waited_ms:
+        await asyncio.to_thread(_count, model, "wait_ms", waited_ms)
+
+
+async def aacquire_slot(model: str, call_deadline: float | None = None) -> str | None:
+    """acquire_slot for coroutines."""
+    slot = uuid.uuid4().hex
+    deadline = _wait_deadline(call_deadline)
+    delay = 0.02
+    while time.monotonic() < deadline:
+        if await asyncio.to_thread(try_acquire_slot, model, slot):
+            return slot
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+        delay = min(delay * 2, 0.5)
+    _check_deadline(model, call_deadline, "a concurrency slot")
+    log.warning(f"Rate limiter: no {model} concurrency slot after {RATE_LIMIT_MAX_WAIT}s; sending anyway")
+    return None
+
+
+async def _astream_and_release(stream, model: str, slot: str | None, estimated: int):
+    actual = None
+    finished = False
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                actual = chunk.usage.total_tokens
+            yield chunk
+        finished = True
+    finally:
+        await asyncio.to_thread(release_slot, model, slot, "ok" if finished else "error")
+        if actual is not None:
+            await asyncio.to_thread(reconcile_tokens, model, estimated, actual)
+
+
+async def alimited_chat_completion(aclient, model: str, messages: list[dict], call_deadline: float | None = None, **params):
+    """limited_chat_completion for an AsyncOpenAI client (TASK_EXECUTION_MODE=asyncio)."""
+    with span("llm", model, stream=bool(params.get("stream"))) as fields:
+        response = await _alimited_chat_completion(aclient, model, messages, call_deadline, **params)
+        if params.get("stream"):
+            return ametered_stream(response, model)
+        record_llm_usage(model, getattr(response, "usage", None), fields)
+        return response
+
+
+async def _alimited_chat_completion(aclient, model: str, messages: list[dict], call_deadline: float | None = None, **params):
+    if not RATE_LIMIT_ENABLED:
+        return await aclient.chat.completions.create(model=model, messages=messages, **_with_timeout(params, call_deadline))
+
+    raw_client = aclient.with_options(max_retries=0)
+    estimated = estimate_tokens(messages, params.get("max_tokens"))
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        try:
+            await await_budget(model, estimated, call_deadline)
+            slot = await aacquire_slot(model, call_deadline)
+        except LimiterWaitExceeded:
+            raise
+        except Exception as e:
+            log.warning(f"Rate limiter unavailable, calling upstream directly: {e}")
+            return await aclient.chat.completions.create(model=model, messages=messages, **_with_timeout(params, call_deadline))
+
+        try:
+            response = await raw_client.chat.completions.create(model=model, messages=messages, **_with_timeout(params, call_deadline))
+        except openai.RateLimitError as e:
+            retry_after = retry_after_seconds(e)
+            await asyncio.to_thread(release_slot, model, slot, "throttled")
+            await asyncio.to_thread(_count, model, "throttled")
+            if retry_after is not None:
+                await asyncio.to_thread(pause_model, model, retry_after)
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            await asyncio.sleep(_retry_delay(e, attempt, retry_after, call_deadline))
+            continue
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            await asyncio.to_thread(release_slot, model, slot, "error")
+            await asyncio.to_thread(_count, model, "transient_errors")
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            await asyncio.sleep(_retry_delay(e, attempt, retry_after_seconds(e), call_deadline))
+            continue
+        except BaseException:
+            await asyncio.to_thread(release_slot, model, slot, "error")
+            raise
+
+        await asyncio.to_thread(_count, model, "requests")
+        if params.get("stream"):
+            return _astream_and_release(response, model, slot, estimated)
+        await asyncio.to_thread(release_slot, model, slot)
+        if getattr(response, "usage", None) is not None:
+            await asyncio.to_thread(reconcile_tokens, model, estimated, response.usage.total_tokens)
+        return response
+
+
+def get_rate_limit_stats() -> dict:
+    """Per-model requests, 429s, transient errors and time spent waiting, plus current AIMD limits."""
+    try:
+        r = get_redis_client()
+        stats = {k.decode("utf-8"): int(v) for k, v in r.hgetall(STATS_KEY).items()}
+        for key in r.scan_iter(match=f"{KEY_PREFIX}*:limit"):
+            model = key.decode("utf-8")[len(KEY_PREFIX):-len(":limit")]
+            stats[f"{model}:concurrency_limit"] = round(float(r.get(key) or 0), 2)
+        return stats
+    except Exception as e:
+        log.warning(f"Rate limiter stats unavailable: {e}")
+        return {}
@@ -0,0 +1,517 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+from app.instrumentation import current_context, get_logger, in_current_context, inc
+from app.rate_limit import LimiterWaitExceeded, alimited_chat_completion, limited_chat_completion
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Guard around every LLM call, between the cache and the rate limiter:
+#   * a deadline per call, by pipeline stage: budget waits, retries and the
+#     HTTP requests all end by then (LLMDeadlineExceeded),
+#   * hedging: a call still running at the LLM_HEDGE_PERCENTILE latency of
+#     recent calls (same model and stage) gets a duplicate request, to the
+#     fallback model when one is configured; the first answer wins and the
+#     other request is cancelled,
+#   * a circuit breaker per model, shared by all workers through Redis: once
+#     at least LLM_BREAKER_FAILURES calls, and LLM_BREAKER_FAILURE_RATE of all
+#     calls, within LLM_BREAKER_WINDOW seconds ended in a timeout, connection
+#     error or 5xx, calls go to the fallback model or fail fast
+#     (CircuitOpenError) for LLM_BREAKER_COOLDOWN seconds; then a single
+#     probe call decides whether the breaker closes again.
+# Redis errors never block a call; the breaker then counts as closed.
+LLM_GUARD_ENABLED = os.getenv("LLM_GUARD_ENABLED", "true").lower() == "true"
+LLM_DEFAULT_DEADLINE = float(os.getenv("LLM_DEFAULT_DEADLINE", "60"))
+# Per-stage deadlines in seconds, e.g. "retrieval=30,summary=45,mcp=90" (other stages get LLM_DEFAULT_DEADLINE).
+LLM_STAGE_DEADLINES = os.getenv("LLM_STAGE_DEADLINES", "retrieval=30,summary=45,mcp=90")
+# Fallback model per model, e.g. "gpt-3.5-turbo=gpt-4o-mini": hedges and calls during an outage go there.
+LLM_FALLBACK_MODELS = os.getenv("LLM_FALLBACK_MODELS", "")
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+# Latencies kept per model and stage (per worker process); no hedging until LLM_HEDGE_MIN_SAMPLES are known.
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+# Hedges per call, on average: each call earns this fraction of a hedge (at most 10 saved up),
+# so a slow upstream can't make every call a duplicate.
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))
+# Threads running hedged attempts in prefork mode (per worker process).
+LLM_HEDGE_THREADS = int(os.getenv("LLM_HEDGE_THREADS", "32"))
+LLM_BREAKER_ENABLED = os.getenv("LLM_BREAKER_ENABLED", "true").lower() == "true"
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+LLM_BREAKER_WINDOW = float(os.getenv("LLM_BREAKER_WINDOW", "30"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+KEY_PREFIX = "tia:breaker:"
+HEDGE_BURST = 10
+
+# Admit a call: 0 while open (or while another worker's probe is running),
+# 1 when closed (counting the call in the current window), 2 for the single
+# probe allowed after the cooldown.
+_ADMIT_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+if redis.call('exists', KEYS[2]) == 0 then
+    if redis.call('hincrby', KEYS[4], 'calls', 1) == 1 then
+        redis.call('pexpire', KEYS[4], ARGV[2])
+    end
+    return 1
+end
+if redis.call('set', KEYS[3], 1, 'nx', 'px', ARGV[1]) then
+    return 2
+end
+return 0
+"""
+
+# Count a failure; open the breaker past both thresholds, or at once when the probe failed. Returns 1 if it opened.
+_FAILURE_SCRIPT = """
+local failures = redis.call('hincrby', KEYS[1], 'failures', 1)
+if redis.call('pttl', KEYS[1]) < 0 then
+    redis.call('pexpire', KEYS[1], ARGV[1])
+end
+local calls = math.max(failures, tonumber(redis.call('hget', KEYS[1], 'calls') or '0'))
+if ARGV[4] == '1' or (failures >= tonumber(ARGV[2]) and failures >= tonumber(ARGV[5]) * calls) then
+    redis.call('set', KEYS[2], 1, 'px', ARGV[3])
+    redis.call('set', KEYS[3], 1, 'ex', 86400)
+    redis.call('del', KEYS[1], KEYS[4])
+    return 1
+end
+return 0
+"""
+
+CLOSED, PROBE = 1, 2
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """The call's stage deadline passed before any request (or hedge) answered."""
+
+
+class CircuitOpenError(RuntimeError):
+    """The model's circuit breaker is open and there is no usable fallback model."""
+
+
+def _parse_pairs(spec: str) -> dict[str, str]:
+    pairs = {}
+    for item in spec.split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+STAGE_DEADLINES = {stage: float(seconds) for stage, seconds in _parse_pairs(LLM_STAGE_DEADLINES).items()}
+FALLBACK_MODELS = _parse_pairs(LLM_FALLBACK_MODELS)
+# A probe that never reports back (crashed worker) stops blocking other calls after the longest deadline.
+_PROBE_TTL = max([LLM_DEFAULT_DEADLINE, *STAGE_DEADLINES.values()])
+
+_latencies: dict[tuple[str, str], deque] = {}
+_hedge_tokens = float(HEDGE_BURST)
+_lock = threading.Lock()
+_executor: ThreadPoolExecutor | None = None
+_executor_pid: int | None = None
+
+
+def stage_deadline(stage: str) -> float:
+    """Seconds one LLM call of `stage` may take, hedges and retries included."""
+    return STAGE_DEADLINES.get(stage, LLM_DEFAULT_DEADLINE)
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    pid = os.getpid()
+    with _lock:
+        if _executor is None or _executor_pid != pid:
+            _executor = ThreadPoolExecutor(max_workers=LLM_HEDGE_THREADS, thread_name_prefix="llm-hedge")
+            _executor_pid = pid
+        return _executor
+
+
+def _upstream_failure(error: BaseException) -> bool:
+    """
+    Errors that say the upstream is slow or down (and count against its
+    breaker): a request timing out or running past the deadline, connection
+    errors and 5xx. A deadline spent waiting on our own rate limiter
+    (LimiterWaitExceeded) is not one of them.
+    """
+    return isinstance(error, (LLMDeadlineExceeded, openai.APITimeoutError, openai.APIConnectionError,
+                              openai.InternalServerError))
+
+
+def _timed_out(error: BaseException) -> bool:
+    """Errors reported to the caller as LLMDeadlineExceeded."""
+    return isinstance(error, (TimeoutError, LimiterWaitExceeded, openai.APITimeoutError))
+
+
+def _deadline_exceeded(model: str, stage: str, error: BaseException | None = None) -> LLMDeadlineExceeded:
+    inc("tia_llm_deadlines_total", model=model, stage=stage)
+    message = f"{model} call for stage {stage} passed its {stage_deadline(stage)}s deadline"
+    return LLMDeadlineExceeded(f"{message}: {error}" if error is not None else message)
+
+
+# --- Latency percentiles and hedging ------------------------------------------
+
+def record_latency(model: str, stage: str, seconds: float):
+    with _lock:
+        window = _latencies.setdefault((model, stage), deque(maxlen=LLM_HEDGE_WINDOW))
+        window.append(seconds)
+
+
+def hedge_delay(model: str, stage: str) -> float | None:
+    """Seconds after which a call is hedged: the LLM_HEDGE_PERCENTILE of recent latencies (None until known)."""
+    with _lock:
+        samples = sorted(_latencies.get((model, stage), ()))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return max(LLM_HEDGE_MIN_DELAY, samples[min(len(samples) - 1, int(LLM_HEDGE_PERCENTILE / 100 * len(samples)))])
+
+
+def _hedge_at(model: str, stage: str, deadline: float, probe: bool) -> float | None:
+    """When to send a hedge for this call (a time.monotonic() value), or None for no hedge."""
+    global _hedge_tokens
+    if not LLM_HEDGE_ENABLED or probe:
+        return None
+    with _lock:
+        _hedge_tokens = min(HEDGE_BURST, _hedge_tokens + LLM_HEDGE_BUDGET)
+    delay = hedge_delay(model, stage)
+    if delay is None or time.monotonic() + delay >= deadline:
+        return None
+    return time.monotonic() + delay
+
+
+def _take_hedge_token() -> bool:
+    global _hedge_tokens
+    with _lock:
+        if _hedge_tokens < 1:
+            return False
+        _hedge_tokens -= 1
+        return True
+
+
+# --- Circuit breaker -----------------------------------------------------------
+
+def _keys(model: str, *names: str) -> list[str]:
+    return [f"{KEY_PREFIX}{model}:{name}" for name in names]
+
+
+def breaker_state(model: str) -> int:
+    """CLOSED, PROBE (this call is the probe) or 0 (open): admits one call to `model`."""
+    if not LLM_BREAKER_ENABLED:
+        return CLOSED
+    try:
+        return int(get_redis_client().eval(_ADMIT_SCRIPT, 4, *_keys(model, "open", "tripped", "probe", "window"),
+                                           int(_PROBE_TTL * 1000), int(LLM_BREAKER_WINDOW * 1000)))
+    except Exception as e:
+        log.warning(f"Circuit breaker unavailable, treating {model} as healthy: {e}")
+        return CLOSED
+
+
+def record_failure(model: str, probe: bool = False):
+    if not LLM_BREAKER_ENABLED:
+        return
+    try:
+        opened = get_redis_client().eval(_FAILURE_SCRIPT, 4, *_keys(model, "window", "open", "tripped", "probe"),
+                                         int(LLM_BREAKER_WINDOW * 1000), LLM_BREAKER_FAILURES,
+                                         int(LLM_BREAKER_COOLDOWN * 1000), "1" if probe else "0", LLM_BREAKER_FAILURE_RATE)
+    except Exception as e:
+        log.warning(f"Circuit breaker failure update for {model} failed: {e}")
+        return
+    if opened:
+        inc("tia_llm_breaker_total", model=model, event="opened")
+        log.warning(f"Circuit breaker for {model} opened for {LLM_BREAKER_COOLDOWN}s"
+                    + (" (probe failed)" if probe else f" ({LLM_BREAKER_FAILURE_RATE:.0%}+ of calls failing)"))
+
+
+def record_success(model: str, probe: bool = False):
+    if not (LLM_BREAKER_ENABLED and probe):
+        return
+    try:
+        get_redis_client().delete(*_keys(model, "tripped", "probe", "window"))
+    except Exception as e:
+        log.warning(f"Circuit breaker reset for {model} failed: {e}")
+        return
+    inc("tia_llm_breaker_total", model=model, event="closed")
+    log.info(f"Circuit breaker for {model} closed (probe succeeded)")
+
+
+def _admit(model: str, state_of=breaker_state) -> tuple[str, bool]:
+    """(model to call, whether the call is the breaker's probe): `model`, or its fallback while it is open."""
+    state = state_of(model)
+    if state:
+        return model, state == PROBE
+    fallback = FALLBACK_MODELS.get(model)
+    if fallback and (fallback_state := state_of(fallback)):
+        inc("tia_llm_breaker_total", model=model, event="fallback")
+        return fallback, fallback_state == PROBE
+    inc("tia_llm_breaker_total", model=model, event="rejected")
+    raise CircuitOpenError(f"Circuit breaker for {model} is open" + (f" (and for {fallback})" if fallback else ""))
+
+
+def _fallback_after(model: str, error: BaseException, deadline: float, state_of=breaker_state) -> tuple[str, bool] | None:
+    """The fallback model to retry on after `model` failed with an upstream error, if there is one and time left."""
+    fallback = FALLBACK_MODELS.get(model)
+    if not fallback or not _upstream_failure(error) or time.monotonic() >= deadline:
+        return None
+    state = state_of(fallback)
+    return (fallback, state == PROBE) if state else None
+
+
+# --- Guarded calls -----------------------------------------------------------
+
+def _attempt(client, model: str, messages: list[dict], deadline: float, params: dict):
+    started = time.monotonic()
+    response = limited_chat_completion(client, model, messages, call_deadline=deadline, **params)
+    return response, time.monotonic() - started
+
+
+def _watched_stream(stream, model: str, probe: bool):
+    try:
+        yield from stream
+    except Exception as e:
+        if _upstream_failure(e):
+            record_failure(model, probe)
+        raise
+    record_success(model, probe)
+
+
+def guarded_chat_completion(client, model: str, messages: list[dict], **params):
+    """
+    limited_chat_completion with the stage deadline, hedging, model fallback
+    and circuit breaker described above. Raises LLMDeadlineExceeded,
+    CircuitOpenError or the last API error.
+
+    In prefork mode hedged attempts run on a small thread pool; the losing
+    request can't be interrupted mid-read, so it is abandoned (its answer is
+    discarded) and ends by the deadline at the latest. Streamed calls get the
+    deadline, breaker and fallback but are not hedged.
+    """
+    if not LLM_GUARD_ENABLED:
+        return limited_chat_completion(client, model, messages, **params)
+    stage = current_context().get("stage", "none")
+    deadline = time.monotonic() + stage_deadline(stage)
+    current, probe = _admit(model)
+
+    if params.get("stream"):
+        while True:
+            try:
+                stream = limited_chat_completion(client, current, messages, call_deadline=deadline, **params)
+                return _watched_stream(stream, current, probe)
+            except Exception as e:
+                if _upstream_failure(e):
+                    record_failure(current, probe)
+                retry = _fallback_after(current, e, deadline) if current == model else None
+                if retry is None:
+                    raise
+                current, probe = retry
+
+    hedge_at = _hedge_at(current, stage, deadline, probe)
+    if hedge_at is None:
+        # Nothing to hedge: call inline; the deadline bounds the limiter and the request.
+        while True:
+            try:
+                response, seconds = _attempt(client, current, messages, deadline, params)
+            except Exception as e:
+                if _upstream_failure(e):
+                    record_failure(current, probe)
+                retry = _fallback_after(current, e, deadline) if current == model else None
+                if retry is not None:
+                    current, probe = retry
+                    continue
+                if _timed_out(e):
+                    raise _deadline_exceeded(model, stage, e) from e
+                raise
+            record_latency(current, stage, seconds)
+            record_success(current, probe)
+            return response
+
+    attempts = {} # future -> (model, probe, "primary" | "hedge" | "fallback")
+
+    def launch(attempt_model: str, attempt_probe: bool, kind: str):
+        future = _pool().submit(in_current_context(_attempt), client, attempt_model, messages, deadline, params)
+        attempts[future] = (attempt_model, attempt_probe, kind)
+
+    launch(current, probe, "primary")
+    tried = {current}
+    hedged = False
+    last_error = None
+    while True:
+        next_event = hedge_at if hedge_at is not None else deadline
+        done, _ = wait(list(attempts), timeout=max(0.0, next_event - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            attempt_model, attempt_probe, kind = attempts.pop(future)
+            try:
+                response, seconds = future.result()
+            except Exception as e:
+                last_error = e
+                if _upstream_failure(e):
+                    record_failure(attempt_model, attempt_probe)
+                continue
+            for other in attempts:
+                other.cancel() # not started yet; running losers are abandoned
+            record_latency(attempt_model, stage, seconds)
+            record_success(attempt_model, attempt_probe)
+            if hedged:
+                inc("tia_llm_hedges_total", model=model, stage=stage, winner=kind)
+            return response
+
+        now = time.monotonic()
+        if hedge_at is not None and now >= hedge_at:
+            hedge_at = None
+            hedge_model = FALLBACK_MODELS.get(current, current)
+            state = breaker_state(hedge_model) if hedge_model != current else CLOSED
+            if state and attempts and _take_hedge_token():
+                launch(hedge_model, state == PROBE, "hedge")
+                tried.add(hedge_model)
+                hedged = True
+        if not attempts:
+            retry = _fallback_after(current, last_error, deadline) if last_error is not None else None
+            if retry is not None and retry[0] not in tried:
+                launch(*retry, "fallback")
+                tried.add(retry[0])
+                continue
+            if hedged:
+                inc("tia_llm_hedges_total", model=model, stage=stage, winner="none")
+            if _timed_out(last_error):
+                raise _deadline_exceeded(model, stage, last_error) from last_error
+            raise last_error
+        if now >= deadline:
+            for future, (attempt_model, attempt_probe, _kind) in attempts.items():
+                future.cancel()
+                record_failure(attempt_model, attempt_probe)
+            if hedged:
+                inc("tia_llm_hedges_total", model=model, stage=stage, winner="none")
+            raise _deadline_exceeded(model, stage)
+
+
+async def _aattempt(aclient, model: str, messages: list[dict], deadline: float, params: dict):
+    started = time.monotonic()
+    response = await alimited_chat_completion(aclient, model, messages, call_deadline=deadline, **params)
+    return response, time.monotonic() - started
+
+
+async def _awatched_stream(stream, model: str, probe: bool):
+    try:
+        async for chunk in stream:
+            yield chunk
+    except Exception as e:
+        if _upstream_failure(e):
+            await asyncio.to_thread(record_failure, model, probe)
+        raise
+    await asyncio.to_thread(record_success, model, probe)
+
+
+async def _astate(model: str) -> int:
+    return await asyncio.to_thread(breaker_state, model)
+
+
+async def aguarded_chat_completion(aclient, model: str, messages: list[dict], **params):
+    """
+    guarded_chat_completion for an AsyncOpenAI client. Attempts are tasks on
+    the process loop, so the losing request of a hedge is really cancelled
+    (its connection closed and its rate-limit slot released).
+    """
+    if not LLM_GUARD_ENABLED:
+        return await alimited_chat_completion(aclient, model, messages, **params)
+    stage = current_context().get("stage", "none")
+    deadline = time.monotonic() + stage_deadline(stage)
+    state = await _astate(model)
+    if state:
+        current, probe = model, state == PROBE
+    else:
+        fallback = FALLBACK_MODELS.get(model)
+        fallback_state = await _astate(fallback) if fallback else 0
+        current, probe = _admit(model, state_of=lambda m: state if m == model else fallback_state)
+
+    async def fallback_after(failed_model: str, error: BaseException):
+        fallback = FALLBACK_MODELS.get(failed_model)
+        if not fallback or failed_model != model:
+            return None
+        fallback_state = await _astate(fallback) if _upstream_failure(error) else 0
+        return _fallback_after(failed_model, error, deadline, state_of=lambda m: fallback_state)
+
+    if params.get("stream"):
+        while True:
+            try:
+                stream = await alimited_chat_completion(aclient, current, messages, call_deadline=deadline, **params)
+                return _awatched_stream(stream, current, probe)
+            except Exception as e:
+                if _upstream_failure(e):
+                    await asyncio.to_thread(record_failure, current, probe)
+                retry = await fallback_after(current, e)
+                if retry is None:
+                    raise
+                current, probe = retry
+
+    hedge_at = _hedge_at(current, stage, deadline, probe)
+    attempts = {} # task -> (model, probe, "primary" | "hedge" | "fallback")
+
+    def launch(attempt_model: str, attempt_probe: bool, kind: str):
+        task = asyncio.ensure_future(_aattempt(aclient, attempt_model, messages, deadline, params))
+        attempts[task] = (attempt_model, attempt_probe, kind)
+
+    async def cancel_all():
+        for task in attempts:
+            task.cancel()
+        await asyncio.gather(*attempts, return_exceptions=True)
+
+    launch(current, probe, "primary")
+    tried = {current}
+    hedged = False
+    last_error = None
+    try:
+        while True:
+            next_event = hedge_at if hedge_at is not None else deadline
+            done, _ = await asyncio.wait(list(attempts), timeout=max(0.0, next_event - time.monotonic()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                attempt_model, attempt_probe, kind = attempts.pop(task)
+                try:
+                    response, seconds = task.result()
+                except Exception as e:
+                    last_error = e
+                    if _upstream_failure(e):
+                        await asyncio.to_thread(record_failure, attempt_model, attempt_probe)
+                    continue
+                await cancel_all()
+                record_latency(attempt_model, stage, seconds)
+                await asyncio.to_thread(record_success, attempt_model, attempt_probe)
+                if hedged:
+                    inc("tia_llm_hedges_total", model=model, stage=stage, winner=kind)
+                return response
+
+            now = time.monotonic()
+            if hedge_at is not None and now >= hedge_at:
+                hedge_at = None
+                hedge_model = FALLBACK_MODELS.get(current, current)
+                state = await _astate(hedge_model) if hedge_model != current else CLOSED
+                if state and attempts and _take_hedge_token():
+                    launch(hedge_model, state == PROBE, "hedge")
+                    tried.add(hedge_model)
+                    hedged = True
+            if not attempts:
+                retry = await fallback_after(current, last_error) if last_error is not None else None
+                if retry is not None and retry[0] not in tried:
+                    launch(*retry, "fallback")
+                    tried.add(retry[0])
+                    continue
+                if hedged:
+                    inc("tia_llm_hedges_total", model=model, stage=stage, winner="none")
+                if _timed_out(last_error):
+                    raise _deadline_exceeded(model, stage, last_error) from last_error
+                raise last_error
+            if now >= deadline:
+                for attempt_model, attempt_probe, _kind in attempts.values():
+                    await asyncio.to_thread(record_failure, attempt_model, attempt_probe)
+                if hedged:
+                    inc("tia_llm_hedges_total", model=model, stage=stage, winner="none")
+                raise _deadline_exceeded(model, stage)
+    finally:
+        await cancel_all()
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING
+
+import redis.asyncio as aioredis
+
+from app.instrumentation import get_logger
+from app.utils import REDIS_URL, get_redis_client
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletion
+
+log = get_logger(__name__)
+
+# Optional token streaming: worker LLM calls use streamed completions and
+# forward the text to a per-prompt Redis stream that the Reflex State renders
+# live. The final text is still written to 'results' once, at the end.
+# The web tier only reads streams (subscribe_tokens), so the worker-side
+# imports (openai, the LLM cache and call guard) happen on first use.
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() == "true"
+# Deltas are batched into one stream entry per this many characters / seconds.
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "48"))
+STREAM_FLUSH_SECONDS = float(os.getenv("STREAM_FLUSH_SECONDS", "0.1"))
+# Approximate cap on entries kept per prompt stream (bounds Redis memory).
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", "2000"))
+STREAM_TTL = int(os.getenv("STREAM_TTL", "3600"))
+STREAM_WATCH_TIMEOUT = float(os.getenv("STREAM_WATCH_TIMEOUT", "900"))
+
+STREAM_PREFIX = "tia:stream:"
+
+
+def _stream_key(prompt_id: int) -> str:
+    return f"{STREAM_PREFIX}{prompt_id}"
+
+
+def _append(prompt_id: int, stage: str, text: str = "", done: bool = False):
+    try:
+        r = get_redis_client()
+        pipe = r.pipeline(transaction=False)
+        pipe.xadd(_stream_key(prompt_id), {"stage": stage, "text": text, "done": "1" if done else "0"},
+                  maxlen=STREAM_MAXLEN, approximate=True)
+        pipe.expire(_stream_key(prompt_id), STREAM_TTL)
+        pipe.execute()
+    except Exception as e:
+        log.warning(f"Failed to append to token stream for prompt_id {prompt_id}: {e}")
+
+
+def reset_stream(prompt_id: int, stage: str):
+    """Mark the start of a stage so readers discard partial text from an earlier attempt."""
+    _append(prompt_id, stage, text="", done=False)
+
+
+class _StreamCollector:
+    """Assembles streamed chunks into a ChatCompletion and batches deltas for the Redis stream."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.parts = []
+        self.pending = []
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        self.finish_reason = "stop"
+        self.usage = None
+        self.response_id = None
+        self.created = int(time.time())
+
+    def add(self, chunk) -> str | None:
+        """Take one chunk; returns batched text when it is time to flush it to the stream."""
+        self.response_id = self.response_id or chunk.id
+        self.model = chunk.model or self.model # the fallback model's name if the call went there
+        self.created = chunk.created or self.created
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return None
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        delta = choice.delta.content or ""
+        if not delta:
+            return None
+        self.parts.append(delta)
+        self.pending.append(delta)
+        self.pending_chars += len(delta)
+        if self.pending_chars >= STREAM_FLUSH_CHARS or time.monotonic() - self.last_flush >= STREAM_FLUSH_SECONDS:
+            return self.take_pending()
+        return None
+
+    def take_pending(self) -> str:
+        text = "".join(self.pending)
+        self.pending, self.pending_chars, self.last_flush = [], 0, time.monotonic()
+        return text
+
+    def response(self) -> "ChatCompletion":
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate({
+            "id": self.response_id or "chatcmpl-streamed",
+            "object": "chat.completion",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self.parts)}, "finish_reason": self.finish_reason}],
+            "usage": self.usage.model_dump() if self.usage is not None else None,
+        })
+
+
+def streamed_chat_completion(client, prompt_id: int, stage: str, model: str, messages: list[dict],
+                             use_cache: bool = True, **params) -> "ChatCompletion":
+    """
+    Like cached_chat_completion, but the upstream call is streamed and text is
+    forwarded to the prompt's Redis stream as it arrives. Returns a regular
+    ChatCompletion assembled from the chunks (with usage when reported).
+    """
+    from app.llm_cache import lookup_completion, store_completion
+    from app.resilience import guarded_chat_completion
+    reset_stream(prompt_id, stage)
+    if use_cache:
+        cached = lookup_completion(model, messages, **params)
+        if cached is not None:
+            _append(prompt_id, stage, cached.choices[0].message.content or "", done=True)
+            return cached
+
+    stream = guarded_chat_completion(
+        client, model, messages, stream=True, stream_options={"include_usage": True}, **params
+    )
+    collector = _StreamCollector(model)
+    for chunk in stream:
+        text = collector.add(chunk)
+        if text:
+            _append(prompt_id, stage, text)
+    _append(prompt_id, stage, collector.take_pending(), done=True)
+
+    response = collector.response()
+    if use_cache:
+        store_completion(model, messages, response, **params)
+    return response
+
+
+async def astreamed_chat_completion(aclient, prompt_id: int, stage: str, model: str, messages: list[dict],
+                                    use_cache: bool = True, **params) -> "ChatCompletion":
+    """streamed_chat_completion for an AsyncOpenAI client; Redis writes run in a thread."""
+    from app.llm_cache import lookup_completion, store_completion
+    from app.resilience import aguarded_chat_completion
+    await asyncio.to_thread(reset_stream, prompt_id, stage)
+    if use_cache:
+        cached = await asyncio.to_thread(lookup_completion, model, messages, **params)
+        if cached is not None:
+            await asyncio.to_thread(_append, prompt_id, stage, cached.choices[0].message.content or "", True)
+            return cached
+
+    stream = await aguarded_chat_completion(
+        aclient, model, messages, stream=True, stream_options={"include_usage": True}, **params
+    )
+    collector = _StreamCollector(model)
+    async for chunk in stream:
+        text = collector.add(chunk)
+        if text:
+            await asyncio.to_thread(_append, prompt_id, stage, text)
+    await asyncio.to_thread(_append, prompt_id, stage, collector.take_pending(), True)
+
+    response = collector.response()
+    if use_cache:
+        await asyncio.to_thread(store_completion, model, messages, response, **params)
+    return response
+
+
+async def subscribe_tokens(prompt_id: int, timeout: float = STREAM_WATCH_TIMEOUT):
+    """
+    Async generator of (stage, text_so_far, done) for a prompt's token stream.
+
+    Reads from the beginning of the stream, so a reconnecting client catches up
+    on text produced so far. Stops after timeout.
+    """
+    client = aioredis.from_url(REDIS_URL)
+    texts = {}
+    last_id = "0"
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            entries = await client.xread({_stream_key(prompt_id): last_id}, count=100, block=1000)
+            if not entries:
+                await asyncio.sleep(0)
+                continue
+            for _key, messages in entries:
+                for message_id, fields in messages:
+                    last_id = message_id
+                    stage = fields[b"stage"].decode("utf-8")
+                    text = fields[b"text"].decode("utf-8")
+                    done = fields[b"done"] == b"1"
+                    if not text and not done:
+                        texts[stage] = "" # a new attempt of this stage started
+                        continue
+                    texts[stage] = texts.get(stage, "") + text
+                    yield stage, texts[stage], done
+    finally:
+        await client.aclose()
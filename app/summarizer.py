@@ -0,0 +1,277 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tiktoken
+except ImportError: # Optional: fall back to a character estimate
+    tiktoken = None
+
+from app.instrumentation import get_logger, in_current_context
+from app.resilience import aguarded_chat_completion, guarded_chat_completion
+from app.streaming import astreamed_chat_completion, streamed_chat_completion
+
+log = get_logger(__name__)
+
+# Token-aware map-reduce summarization for mcp_task.
+MCP_SUMMARY_MODEL = os.getenv("MCP_SUMMARY_MODEL", "gpt-3.5-turbo")
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+SUMMARY_MAP_MAX_TOKENS = int(os.getenv("SUMMARY_MAP_MAX_TOKENS", "400"))
+SUMMARY_FINAL_MAX_TOKENS = int(os.getenv("SUMMARY_FINAL_MAX_TOKENS", "1000"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+# Upper bound on prompt + completion tokens spent on one job across all calls.
+SUMMARY_JOB_TOKEN_BUDGET = int(os.getenv("SUMMARY_JOB_TOKEN_BUDGET", "60000"))
+
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+MESSAGE_OVERHEAD_TOKENS = 12 # role markers and message framing per request
+CHARS_PER_TOKEN = 4 # estimate used when tiktoken or its encoding is unavailable
+
+SYSTEM_PROMPT = "You are an AI assistant skilled in summarizing text and extracting key information and quotes."
+
+MAP_PROMPT = (
+    "Summarize the following excerpt compiled from web sources. Keep the most important information "
+    "and copy several Key Quotes verbatim, in quotation marks, that capture essential points or statements.\n\n"
+    "Excerpt:\n"
+    "---------------------\n"
+    "{text}\n"
+    "---------------------\n\n"
+    "Summary with Key Quotes:"
+)
+
+COMBINE_PROMPT = (
+    "The following are partial summaries, with key quotes, of different parts of a set of web sources. "
+    "Merge them into one summary, keeping the most important information and the strongest Key Quotes verbatim.\n\n"
+    "Partial summaries:\n"
+    "---------------------\n"
+    "{text}\n"
+    "---------------------\n\n"
+    "Merged summary with Key Quotes:"
+)
+
+FINAL_PROMPT = (
+    "You are an expert research assistant. Based on the following text compiled from various web sources, "
+    "please create a concise resume or summary. Your summary should highlight the most important information "
+    "and explicitly include several Key Quotes from the text that capture essential points or statements. "
+    "Structure the output clearly.\n\n"
+    "Source Text:\n"
+    "---------------------\n"
+    "{text}\n"
+    "---------------------\n\n"
+    "Resume/Summary with Key Quotes:"
+)
+
+_encodings = {}
+
+
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # e.g. the BPE file cannot be downloaded in an offline worker
+            log.warning(f"tiktoken encoding unavailable for {model}, estimating tokens from characters: {e}")
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = MCP_SUMMARY_MODEL) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _split_long_line(line: str, max_tokens: int, model: str) -> list[str]:
+    encoding = _encoding(model)
+    if encoding is None:
+        step = max_tokens * CHARS_PER_TOKEN
+        return [line[i:i + step] for i in range(0, len(line), step)]
+    tokens = encoding.encode(line, disallowed_special=())
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+
+def split_by_tokens(text: str, max_tokens: int, model: str = MCP_SUMMARY_MODEL) -> list[str]:
+    """Split text into chunks of at most max_tokens, breaking on line boundaries where possible."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text.split("\n"):
+        line_tokens = count_tokens(line, model) + 1 # +1 for the newline
+        if line_tokens > max_tokens:
+            if current:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_long_line(line, max_tokens, model))
+            continue
+        if current_tokens + line_tokens > max_tokens and current:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current and "\n".join(current).strip():
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def _context_tokens(model: str) -> int:
+    for name, size in MODEL_CONTEXT_TOKENS.items():
+        if model == name or model.startswith(name + "-"):
+            return size
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def _new_stats() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "chunks": 0, "chunks_skipped": 0, "reduce_levels": 0}
+
+
+def _messages(template: str, body: str) -> list[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": template.format(text=body)}
+    ]
+
+
+def _record_usage(stats: dict, response):
+    stats["calls"] += 1
+    if getattr(response, "usage", None):
+        stats["prompt_tokens"] += response.usage.prompt_tokens
+        stats["completion_tokens"] += response.usage.completion_tokens
+
+
+def _summary_steps(text: str, model: str, token_budget: int, stats: dict):
+    """
+    The map-reduce plan as a generator shared by the sync and async drivers:
+    yields (template, bodies, max_tokens) batches of requests to run in
+    parallel, receives their outputs, and returns the final summary.
+    """
+    overhead = MESSAGE_OVERHEAD_TOKENS + count_tokens(SYSTEM_PROMPT, model) + count_tokens(FINAL_PROMPT, model)
+    # Largest body that still leaves room for the final completion in the context window.
+    max_input_tokens = _context_tokens(model) - SUMMARY_FINAL_MAX_TOKENS - overhead
+    text_tokens = count_tokens(text, model)
+
+    if text_tokens <= max_input_tokens and text_tokens + overhead + SUMMARY_FINAL_MAX_TOKENS <= token_budget:
+        return (yield FINAL_PROMPT, [text], SUMMARY_FINAL_MAX_TOKENS)[0]
+
+    chunk_tokens = min(SUMMARY_CHUNK_TOKENS, max_input_tokens)
+    chunks = split_by_tokens(text, chunk_tokens, model)
+
+    # Map phase: keep chunks (in source order) while the estimated cost of
+    # summarizing them, plus the final request over their summaries, fits the budget.
+    selected = []
+    spent = 0
+    for chunk in chunks:
+        map_cost = count_tokens(chunk, model) + overhead + SUMMARY_MAP_MAX_TOKENS
+        reduce_reserve = (len(selected) + 1) * SUMMARY_MAP_MAX_TOKENS + overhead + SUMMARY_FINAL_MAX_TOKENS
+        if spent + map_cost + reduce_reserve > token_budget:
+            break
+        selected.append(chunk)
+        spent += map_cost
+    stats["chunks"] = len(chunks)
+    stats["chunks_skipped"] = len(chunks) - len(selected)
+    if stats["chunks_skipped"]:
+        log.warning(f"token budget ({token_budget}) allows {len(selected)} of {len(chunks)} chunks; skipping the rest.")
+    if not selected:
+        raise ValueError(f"Token budget ({token_budget}) is too small to summarize any of the source text.")
+
+    partials = yield MAP_PROMPT, selected, SUMMARY_MAP_MAX_TOKENS
+
+    # Reduce phase: merge partial summaries until they fit a single final request.
+    separator = "\n\n--- Next Part ---\n\n"
+    combined = separator.join(partials)
+    while count_tokens(combined, model) > max_input_tokens and len(partials) > 1:
+        used = stats["prompt_tokens"] + stats["completion_tokens"]
+        if used + count_tokens(combined, model) + overhead * len(partials) + SUMMARY_FINAL_MAX_TOKENS > token_budget:
+            break
+        stats["reduce_levels"] += 1
+        groups = split_by_tokens(combined, chunk_tokens, model)
+        if len(groups) >= len(partials):
+            groups = [separator.join(partials[i:i + 2]) for i in range(0, len(partials), 2)]
+        partials = yield COMBINE_PROMPT, groups, SUMMARY_MAP_MAX_TOKENS
+        combined = separator.join(partials)
+    if count_tokens(combined, model) > max_input_tokens:
+        log.warning("partial summaries exceed the model context within the token budget; truncating.")
+        combined = split_by_tokens(combined, max_input_tokens, model)[0]
+
+    return (yield FINAL_PROMPT, [combined], SUMMARY_FINAL_MAX_TOKENS)[0]
+
+
+def summarize_sources(client, text: str, model: str = MCP_SUMMARY_MODEL, token_budget: int | None = None,
+                      stream_prompt_id: int | None = None) -> tuple[str, dict]:
+    """
+    Summarize combined source text into a "Resume/Summary with Key Quotes".
+
+    Text that fits the model context in a single request is summarized
+    directly. Larger text is split by token count, the chunks are summarized
+    in parallel (at most SUMMARY_CONCURRENCY requests at a time), and the
+    partial summaries are merged, hierarchically if they still do not fit,
+    before the final request. Chunks that would push the job past
+    token_budget (default SUMMARY_JOB_TOKEN_BUDGET) are skipped. With
+    stream_prompt_id, the final request is streamed to that prompt's token
+    stream (stage "mcp").
+
+    Returns (summary_text, stats).
+    """
+    token_budget = SUMMARY_JOB_TOKEN_BUDGET if token_budget is None else token_budget
+    stats = _new_stats()
+    stats_lock = threading.Lock()
+
+    def complete(template: str, body: str, max_tokens: int) -> str:
+        messages = _messages(template, body)
+        if template is FINAL_PROMPT and stream_prompt_id is not None:
+            response = streamed_chat_completion(client, stream_prompt_id, "mcp", model=model, messages=messages,
+                                                max_tokens=max_tokens, use_cache=False)
+        else:
+            response = guarded_chat_completion(client, model, messages, max_tokens=max_tokens)
+        with stats_lock:
+            _record_usage(stats, response)
+        return response.choices[0].message.content.strip()
+
+    steps = _summary_steps(text, model, token_budget, stats)
+    outputs = None
+    with ThreadPoolExecutor(max_workers=max(1, SUMMARY_CONCURRENCY)) as executor:
+        while True:
+            try:
+                template, bodies, max_tokens = steps.send(outputs)
+            except StopIteration as done:
+                return done.value, stats
+            outputs = list(executor.map(in_current_context(lambda body: complete(template, body, max_tokens)), bodies))
+
+
+async def asummarize_sources(aclient, text: str, model: str = MCP_SUMMARY_MODEL, token_budget: int | None = None,
+                             stream_prompt_id: int | None = None) -> tuple[str, dict]:
+    """summarize_sources for an AsyncOpenAI client: same plan, requests run as coroutines."""
+    token_budget = SUMMARY_JOB_TOKEN_BUDGET if token_budget is None else token_budget
+    stats = _new_stats()
+    semaphore = asyncio.Semaphore(max(1, SUMMARY_CONCURRENCY))
+
+    async def complete(template: str, body: str, max_tokens: int) -> str:
+        messages = _messages(template, body)
+        async with semaphore:
+            if template is FINAL_PROMPT and stream_prompt_id is not None:
+                response = await astreamed_chat_completion(aclient, stream_prompt_id, "mcp", model=model, messages=messages,
+                                                           max_tokens=max_tokens, use_cache=False)
+            else:
+                response = await aguarded_chat_completion(aclient, model, messages, max_tokens=max_tokens)
+        _record_usage(stats, response)
+        return response.choices[0].message.content.strip()
+
+    steps = _summary_steps(text, model, token_budget, stats)
+    outputs = None
+    while True:
+        try:
+            template, bodies, max_tokens = steps.send(outputs)
+        except StopIteration as done:
+            return done.value, stats
+        outputs = list(await asyncio.gather(*(complete(template, body, max_tokens) for body in bodies)))
@@ -1,138 +1,340 @@
 from app.celery_app import celery_app
-from app.utils import get_supabase_client # Import the helper
+from app.utils import get_supabase_client, commit_stage, StageConflict # Import the helper
+from app.fetcher import fetch_urls
+from app.extractors import StreamingExtractor, extract_text
+from app.summarizer import summarize_sources
+from app.dedup import dedup_sources
+from app.vector_index import augment_text, hit_refs, index_retrieval, index_sources, lookup_context
+from app.agent_config import get_agent_config, render_summarization_prompt
+from app.llm_cache import cached_chat_completion, agent_cache_enabled
+from app.progress import publish_status, publish_stage
+from app.pipeline import STAGE_RETRY_POLICIES, retry_countdown, record_pipeline_latency
+from app.idempotency import idempotent_stage
+from app.aio import ASYNC_MODE
+from app.streaming import LLM_STREAMING, streamed_chat_completion
+from app.page_cache import lookup_pages, conditional_headers, mark_revalidated, store_page, record_bypass
+from app.blob_store import BLOB_STORE, get_blob, store_payload, store_sources
+from app.instrumentation import get_logger
+from app.batches import dispatch_batch, finish_batch_prompt
+from app.fair_share import FAIR_SHARE_ENABLED, dispatch as dispatch_fair_share, finish_prompt
 # from app.models import Prompt, Result # If needed for type hinting or ORM-like use
-import requests
-from bs4 import BeautifulSoup
-import openai
-from dotenv import load_dotenv
-load_dotenv()
+# The environment (.env) is loaded by app.celery_app, imported above.
 import os
 import json
-from datetime import datetime
+import threading
+import time
 # Use the new OpenAI client for v1.x
 from openai import OpenAI
 
-OPENAI_API_KEY_FROM_ENV = os.getenv("OPENAI_API_KEY") 
-if OPENAI_API_KEY_FROM_ENV:
-    client = OpenAI(api_key=OPENAI_API_KEY_FROM_ENV)
-else:
-    print("Warning: OPENAI_API_KEY not found. AI features will be limited.")
+log = get_logger(__name__)
 
+OPENAI_API_KEY_FROM_ENV = os.getenv("OPENAI_API_KEY") 
+if not OPENAI_API_KEY_FROM_ENV:
+    log.warning("OPENAI_API_KEY not found. AI features will be limited.")
+
+_client: OpenAI | None = None
+_client_pid: int | None = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client() -> OpenAI:
+    """
+    Process-wide OpenAI client, created on first use: in each prefork child
+    rather than at import, so its connection pool is never shared across a fork.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            _client = OpenAI(api_key=OPENAI_API_KEY_FROM_ENV)
+            _client_pid = pid
+        return _client
+
+# Request/parsing helpers shared with the asyncio implementations in app/async_stages.py.
+def retrieval_messages(user_prompt: str, context: str = "") -> list[dict]:
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant that summarizes and extracts options."},
+        {"role": "user", "content": f"Gather key information and potential options related to the following query: {user_prompt}. Present it as a structured summary."}
+    ]
+    if context:
+        # Related results from earlier prompts (app/vector_index.py), to build on rather than repeat.
+        messages.insert(1, {"role": "system", "content": f"Information gathered for related earlier queries:\n\n{context}"})
+    return messages
+
+
+def reused_raw_data(found: dict) -> dict:
+    """raw_data for a prompt answered from the vector index instead of an LLM call."""
+    hit = found["reuse"]
+    return {"llm_response": hit["context"], "reused_from": hit_refs([hit])[0]}
+
+
+def raw_data_columns(raw_data_json: str) -> dict:
+    """'results' columns for a retrieval payload: a blob store ref, or the JSON inline when the store is off."""
+    ref = store_payload(raw_data_json)
+    return {"raw_data_ref": ref} if ref else {"raw_data": raw_data_json}
+
+
+# Only select raw_data_ref where the blob store migration has been applied.
+RAW_DATA_SELECT = "id, raw_data" if BLOB_STORE == "off" else "id, raw_data, raw_data_ref"
+
+
+def stored_raw_data(row: dict) -> str:
+    """A results row's raw_data JSON; blob-stored payloads are fetched and decompressed only here."""
+    if row.get("raw_data_ref"):
+        return get_blob(row["raw_data_ref"]).text()
+    return row["raw_data"]
+
+
+def fetch_notes(fetched: dict[str, dict]) -> dict[str, dict]:
+    """Per-URL notes on fetches that were cut off (at FETCH_MAX_BYTES or the batch deadline) or skipped as non-text."""
+    notes = {}
+    for url, result in fetched.items():
+        if result.get("skipped"):
+            notes[url] = {"skipped": result["skipped"]}
+        elif result.get("truncated"):
+            notes[url] = {"truncated": True, "bytes": result["bytes"]}
+    return notes
+
+
+def add_dedup_notes(notes: dict[str, dict], dedup_stats: dict) -> dict[str, dict]:
+    """Fetch notes plus, per URL, the paragraphs dropped as duplicates of other sources (app/dedup.py)."""
+    for url, note in dedup_stats["sources"].items():
+        notes.setdefault(url, {}).update(note)
+    return notes
+
+
+def dedup_summary(prompt_id: int, dedup_stats: dict) -> dict:
+    """Job-level dedup counts (without the per-URL notes), logged when anything was removed."""
+    summary = {k: v for k, v in dedup_stats.items() if k != "sources"}
+    if summary["exact_removed"] or summary["near_removed"]:
+        log.info(f"Removed {summary['exact_removed']} exact and {summary['near_removed']} near-duplicate paragraphs "
+                 f"({summary['tokens_removed']} tokens) from the sources of prompt_id {prompt_id}")
+    return summary
+
+
+def mcp_result_columns(mcp_summary_text: str, urls: list[str], extracted_texts: list[str],
+                       notes: dict[str, dict] | None = None) -> dict:
+    """'results' columns for an MCP stage: the summary, plus blob refs to each source's extracted text (and fetch notes)."""
+    columns = {"mcp_data": mcp_summary_text}
+    source_refs = store_sources(urls, extracted_texts, notes)
+    if source_refs:
+        columns["source_refs"] = source_refs
+    return columns
+
+
+def content_to_summarize(raw_data_json: str) -> str:
+    try:
+        raw_data = json.loads(raw_data_json) # raw_data is stored as JSON string
+        # Extract the actual content, e.g., from llm_response or placeholder_data
+        content = raw_data.get("llm_response", raw_data.get("placeholder_data", ""))
+        if not content:
+             raise Exception("Raw data content is empty or not in expected format.")
+        return content
+    except json.JSONDecodeError:
+        # If raw_data wasn't a JSON string, treat it as plain text.
+        return raw_data_json
+
+
+def parse_summary_output(prompt_id: int, ai_output_text: str) -> tuple[str, str]:
+    """(summary_text, processed_options_str) from the summarization model's output."""
+    # Attempt to parse the AI output as JSON
+    try:
+        parsed_output = json.loads(ai_output_text)
+        processed_options_list = parsed_output.get("options", [])
+        processed_options_str = json.dumps(processed_options_list) # Store as JSON string
+        summary_text = parsed_output.get("summary", "Summary could not be extracted.")
+    except json.JSONDecodeError:
+        log.warning(f"Failed to parse LLM output as JSON for prompt_id {prompt_id}. Output: {ai_output_text}")
+        # Fallback: use the raw output as summary, and indicate options weren't parsed
+        summary_text = f"Summary (raw output, JSON parsing failed): {ai_output_text}"
+        processed_options_str = json.dumps(["Could not parse options from AI output."])
+    return summary_text, processed_options_str
+
+
+def source_text(url: str, cached_page: dict | None, fetch_result: dict | None, bypass_cache: bool) -> str:
+    """Text for one MCP source URL from its page-cache entry and/or fetch result (errors become placeholders)."""
+    try:
+        log.info(f"Processing URL: {url}")
+        if "youtube.com/" in url or "youtu.be/" in url:
+            # TODO: In a future iteration, integrate YouTube transcription service here.
+            return f"Content from YouTube URL ({url}): Transcription not yet implemented."
+
+        if cached_page is not None and cached_page["fresh"]:
+            log.info(f"Using cached text for {url}")
+            return cached_page["text"]
+
+        if fetch_result["error"]:
+            log.warning(f"Error fetching URL {url}: {fetch_result['error']}")
+            return f"[Error fetching content from {url}: {fetch_result['error']}]"
+
+        if fetch_result["status_code"] == 304 and cached_page is not None:
+            mark_revalidated(url, fetch_result["headers"])
+            log.info(f"Cached text for {url} revalidated (304 Not Modified)")
+            return cached_page["text"]
+
+        if fetch_result.get("skipped"):
+            return f"[Skipped {url}: {fetch_result['skipped']}]"
+
+        # Text parsed while streaming (fetch_urls with a parser_factory), or extracted
+        # here with the configured backend (BeautifulSoup is the fallback)
+        text = fetch_result["text"] if fetch_result.get("text") is not None else extract_text(fetch_result["content"])
+        # A body cut off at FETCH_MAX_BYTES or by the batch deadline is used once but not cached as the page.
+        if not bypass_cache and not fetch_result.get("truncated"):
+            store_page(url, text, fetch_result["headers"])
+        log.info(f"Successfully extracted text from {url}")
+        return text
 
-@celery_app.task
-def information_retrieval_task(prompt_id: int, user_prompt: str):
-    supabase = get_supabase_client() # This will raise ValueError if keys are default
+    except Exception as e:
+        log.warning(f"Error extracting text from URL {url}: {e}")
+        return f"[Error processing content from {url}: {str(e)}]"
+
+
+
+def set_prompt_status(prompt_id: int, status: str, **fields) -> bool:
+    """Move the prompt to `status` (if its current status allows) and publish it; False if it had moved on."""
+    outcome = commit_stage(prompt_id, status)
+    if not outcome["applied"]:
+        log.info(f"Not moving prompt_id {prompt_id} to '{status}': it is '{outcome['status']}'")
+        return False
+    publish_status(prompt_id, status, **fields)
+    return True
+
+
+def advance_prompt(prompt_id: int, status: str, result: dict | None = None, new_result: bool = False,
+                   result_id: int | None = None, **fields) -> dict:
+    """
+    Commit a stage step (app.utils.commit_stage) and publish the new status.
+    Raises StageConflict if the prompt has moved on, so a stale worker stops.
+    """
+    outcome = commit_stage(prompt_id, status, result=result, new_result=new_result, result_id=result_id)
+    if not outcome["applied"]:
+        raise StageConflict(prompt_id, status, outcome["status"])
+    publish_status(prompt_id, status, **fields)
+    return outcome
+
+
+@celery_app.task(bind=True)
+@idempotent_stage("retrieval")
+def information_retrieval_task(self, prompt_id: int, user_prompt: str, user_id: str | None = None):
+    if ASYNC_MODE:
+        from app.async_stages import run_stage # imports this module; loaded on first use
+        return run_stage(self, "retrieval", prompt_id, user_prompt, user_id)
+    get_supabase_client() # This will raise ValueError if keys are default
+    started = time.monotonic()
 
     try:
         # 1. Update prompt status to 'processing_retrieval'
-        update_status_payload = {"status": "processing_retrieval", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(update_status_payload).eq("id", prompt_id).execute()
+        advance_prompt(prompt_id, "processing_retrieval")
 
         # 2. Perform information retrieval (simulated with OpenAI call for simplicity)
         raw_data_content = {}
-        if OPENAI_API_KEY_FROM_ENV:
+        # The user's past results for this or a similar prompt: reused as they are, or passed to the LLM as context.
+        found = lookup_context(user_prompt, user_id)
+        if "reuse" in found:
+            raw_data_content = reused_raw_data(found)
+        elif OPENAI_API_KEY_FROM_ENV:
             try:
-                response = client.chat.completions.create(
+                response = cached_chat_completion(
+                    get_openai_client(),
                     model="gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant that summarizes and extracts options."},
-                        {"role": "user", "content": f"Gather key information and potential options related to the following query: {user_prompt}. Present it as a structured summary."}
-                    ],
+                    messages=retrieval_messages(user_prompt, augment_text(found.get("augment", []))),
                     max_tokens=500
                 )
                 raw_data_content["llm_response"] = response.choices[0].message.content.strip()
+                if found.get("augment"):
+                    raw_data_content["context_from"] = hit_refs(found["augment"])
+                index_retrieval(prompt_id, user_prompt, raw_data_content["llm_response"], user_id)
             except Exception as e:
-                print(f"OpenAI call failed for prompt_id {prompt_id}: {e}")
+                log.warning(f"OpenAI call failed for prompt_id {prompt_id}: {e}")
                 raw_data_content["error"] = f"OpenAI call failed: {str(e)}"
                 raw_data_content["placeholder_data"] = f"Simulated search data for '{user_prompt}'. Actual web search would go here."
         else:
-            print(f"OpenAI API key not configured. Using placeholder data for prompt_id {prompt_id}.")
+            log.warning(f"OpenAI API key not configured. Using placeholder data for prompt_id {prompt_id}.")
             raw_data_content["placeholder_data"] = f"Simulated search data for '{user_prompt}' (OpenAI API key not configured). Actual web search would go here."
         
         raw_data_json = json.dumps(raw_data_content)
 
-        # 3. Store raw data in 'results' table
-        insert_payload = {
+        # 3. Store raw data in a new 'results' row and mark the prompt 'retrieval_complete',
+        #    in one round trip ('processed_options' and 'summary' are added by subsequent tasks)
+        result_id = advance_prompt(prompt_id, "retrieval_complete", result=raw_data_columns(raw_data_json), new_result=True)["result_id"]
+
+        # Stage output for the next pipeline stage, so it doesn't re-read 'results'.
+        return {
             "prompt_id": prompt_id,
-            "raw_data": raw_data_json,
-            "created_at": datetime.now().isoformat()
-            # 'processed_options' and 'summary' will be added by subsequent tasks
+            "status": "retrieval_complete",
+            "result_id": result_id,
+            "raw_data": raw_data_content,
+            "user_id": user_id,
+            "timings_ms": {"retrieval": round((time.monotonic() - started) * 1000, 1)},
         }
-        insert_response = supabase.table("results").insert(insert_payload).execute()
-        
-        # Check for errors during insert
-        if hasattr(insert_response, 'error') and insert_response.error:
-            raise Exception(f"Failed to insert results: {insert_response.error.message}")
-        if not insert_response.data: # Supabase often returns data on success
-             print(f"Warning: Insert response for prompt_id {prompt_id} had no data, but also no explicit error. Check Supabase logs.")
-             # Depending on Supabase client version, this might not always indicate an error if error is None.
-
-
-        # 4. Update prompt status to 'retrieval_complete'
-        update_status_payload = {"status": "retrieval_complete", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(update_status_payload).eq("id", prompt_id).execute()
-        
-        return f"Information retrieval complete for prompt ID: {prompt_id}"
 
     except Exception as e:
-        print(f"Error in information_retrieval_task for prompt_id {prompt_id}: {e}")
+        countdown = retry_countdown("retrieval", self.request.retries, e)
+        if countdown is not None:
+            log.warning(f"Retrying information_retrieval_task for prompt_id {prompt_id} in {countdown}s: {e}")
+            raise self.retry(exc=e, countdown=countdown, max_retries=STAGE_RETRY_POLICIES["retrieval"]["max_retries"])
+        log.error(f"Error in information_retrieval_task for prompt_id {prompt_id}: {e}")
         # Update prompt status to 'retrieval_error'
-        error_status_payload = {"status": "retrieval_error", "updated_at": datetime.now().isoformat()}
         try:
-            supabase.table("prompts").update(error_status_payload).eq("id", prompt_id).execute()
+            set_prompt_status(prompt_id, "retrieval_error")
         except Exception as db_error:
-            print(f"Failed to update prompt status to retrieval_error for prompt_id {prompt_id}: {db_error}")
-        return f"Error during information retrieval for prompt ID: {prompt_id}. Error: {str(e)}"
+            log.error(f"Failed to update prompt status to retrieval_error for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "retrieval_error", "error": str(e)}
+
+
+@celery_app.task(bind=True)
+@idempotent_stage("summary")
+def process_and_summarize_task(self, prompt_id: int, agent_id: int):
+    if ASYNC_MODE:
+        from app.async_stages import run_stage
+        return run_stage(self, "summary", prompt_id, agent_id)
+    # In a pipeline (app/pipeline.py) the retrieval stage's output dict arrives in place of prompt_id.
+    retrieval = prompt_id if isinstance(prompt_id, dict) else None
+    if retrieval is not None:
+        prompt_id = retrieval["prompt_id"]
+        if retrieval.get("error"):
+            return retrieval # Retrieval failed; there is nothing to summarize
+    started = time.monotonic()
 
-
-@celery_app.task
-def process_and_summarize_task(prompt_id: int, agent_id: int):
     supabase = get_supabase_client()
 
     # Fetch agent configuration
-    agent_config_response = supabase.table("agents").select("summarization_prompt, role, content").eq("id", agent_id).maybe_single().execute()
-    if agent_config_response.data is None:
-        raise Exception(f"Agent configuration not found for agent_id: {agent_id}")
-
-    agent_config = agent_config_response.data
-    summarization_prompt_template = agent_config.get("summarization_prompt", "Default summarization prompt if not found")
-    agent_role = agent_config.get("role", "system")
-    agent_content_template = agent_config.get("content", "You are a helpful assistant that summarizes and extracts options.")
+    # (cached per worker process; see app/agent_config.py)
+    agent_config = get_agent_config(agent_id)
+    agent_role = agent_config["role"]
+    agent_content_template = agent_config["content"]
 
     # It's assumed openai.api_key is already set as in information_retrieval_task
     if not OPENAI_API_KEY_FROM_ENV:
-        print("Warning: OPENAI_API_KEY not found. Summarization features will be limited.")
+        log.warning("OPENAI_API_KEY not found. Summarization features will be limited.")
         # Update prompt status to indicate an error due to configuration
-        error_status_payload = {"status": "summary_error_config", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(error_status_payload).eq("id", prompt_id).execute()
-        return f"Summarization failed for prompt ID: {prompt_id} due to missing OpenAI API key."
+        set_prompt_status(prompt_id, "summary_error_config")
+        return {"prompt_id": prompt_id, "status": "summary_error_config", "error": "OpenAI API key not configured"}
 
     try:
         # 1. Update prompt status to 'processing_summary'
-        update_status_payload = {"status": "processing_summary", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(update_status_payload).eq("id", prompt_id).execute()
+        advance_prompt(prompt_id, "processing_summary")
 
-        # 2. Fetch the raw_data from the 'results' table for the given prompt_id
-        #    Assuming there's one main result entry per prompt_id that contains the raw_data.
-        #    Fetch the most recent one if multiple could exist.
-        result_response = supabase.table("results").select("id, raw_data").eq("prompt_id", prompt_id).order("created_at", desc=True).limit(1).execute()
-        
-        if not result_response.data:
-            raise Exception(f"No raw data found in 'results' table for prompt_id: {prompt_id}")
+        # 2. Get the raw_data: from the retrieval stage's output when running in a pipeline,
+        #    otherwise from the 'results' table for the given prompt_id.
+        if retrieval is not None and retrieval.get("result_id") is not None:
+            result_id = retrieval["result_id"]
+            raw_data_json = json.dumps(retrieval["raw_data"])
+        else:
+            #    Assuming there's one main result entry per prompt_id that contains the raw_data.
+            #    Fetch the most recent one if multiple could exist.
+            result_response = supabase.table("results").select(RAW_DATA_SELECT).eq("prompt_id", prompt_id).order("created_at", desc=True).limit(1).execute()
+
+            if not result_response.data:
+                raise Exception(f"No raw data found in 'results' table for prompt_id: {prompt_id}")
 
-        raw_result_entry = result_response.data[0]
-        result_id = raw_result_entry["id"]
-        raw_data_json = raw_result_entry["raw_data"]
+            raw_result_entry = result_response.data[0]
+            result_id = raw_result_entry["id"]
+            raw_data_json = stored_raw_data(raw_result_entry)
         
-        try:
-            raw_data = json.loads(raw_data_json) # raw_data is stored as JSON string
-            # Extract the actual content, e.g., from llm_response or placeholder_data
-            content_to_summarize = raw_data.get("llm_response", raw_data.get("placeholder_data", ""))
-            if not content_to_summarize:
-                 raise Exception("Raw data content is empty or not in expected format.")
-        except json.JSONDecodeError:
-            # If raw_data wasn't a JSON string, treat it as plain text.
-            content_to_summarize = raw_data_json
+        text_to_summarize = content_to_summarize(raw_data_json)
 
 
         # 3. Use AI to process and summarize the raw_data
@@ -141,127 +343,144 @@ def process_and_summarize_task(prompt_id: int, agent_id: int):
         summary_text = "Default summary: No specific summary generated."
 
         try:
-            user_message_content = summarization_prompt_template.replace("{content_to_summarize}", content_to_summarize)
-
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": agent_role, "content": agent_content_template},
-                    {"role": "user", "content": user_message_content}
-                ],
-                max_tokens=700
-            )
+            user_message_content = render_summarization_prompt(agent_config, text_to_summarize)
+
+            summary_messages = [
+                {"role": agent_role, "content": agent_content_template},
+                {"role": "user", "content": user_message_content}
+            ]
+            if LLM_STREAMING:
+                # Partial text goes to the prompt's token stream for the UI as it is generated.
+                response = streamed_chat_completion(
+                    get_openai_client(), prompt_id, "summary",
+                    model="gpt-3.5-turbo",
+                    messages=summary_messages,
+                    max_tokens=700,
+                    use_cache=agent_cache_enabled(agent_id)
+                )
+            else:
+                response = cached_chat_completion(
+                    get_openai_client(),
+                    model="gpt-3.5-turbo",
+                    messages=summary_messages,
+                    max_tokens=700,
+                    use_cache=agent_cache_enabled(agent_id)
+                )
             ai_output_text = response.choices[0].message.content.strip()
 
-            # Attempt to parse the AI output as JSON
-            try:
-                parsed_output = json.loads(ai_output_text)
-                processed_options_list = parsed_output.get("options", [])
-                processed_options_str = json.dumps(processed_options_list) # Store as JSON string
-                summary_text = parsed_output.get("summary", "Summary could not be extracted.")
-            except json.JSONDecodeError:
-                print(f"Failed to parse LLM output as JSON for prompt_id {prompt_id}. Output: {ai_output_text}")
-                # Fallback: use the raw output as summary, and indicate options weren't parsed
-                summary_text = f"Summary (raw output, JSON parsing failed): {ai_output_text}"
-                processed_options_str = json.dumps(["Could not parse options from AI output."])
+            summary_text, processed_options_str = parse_summary_output(prompt_id, ai_output_text)
 
         except Exception as e:
-            print(f"OpenAI call for summarization failed for prompt_id {prompt_id}: {e}")
+            log.warning(f"OpenAI call for summarization failed for prompt_id {prompt_id}: {e}")
             summary_text = f"Error during AI summarization: {str(e)}"
             # Keep default empty options if AI call fails
             processed_options_str = json.dumps([f"Error during AI summarization: {str(e)}"])
 
 
-        # 4. Store processed options and summary in the 'results' table (update existing row)
-        update_payload = {
-            "processed_options": processed_options_str,
+        # 4. Store processed options and summary in the 'results' row and mark the prompt
+        #    'completed', in one round trip
+        advance_prompt(prompt_id, "completed", result={"processed_options": processed_options_str, "summary": summary_text},
+                       result_id=result_id, summary=summary_text, processed_options=processed_options_str)
+
+        timings = dict(retrieval.get("timings_ms", {})) if retrieval else {}
+        timings["summary"] = round((time.monotonic() - started) * 1000, 1)
+        return {
+            "prompt_id": prompt_id,
+            "status": "completed",
+            "result_id": result_id,
             "summary": summary_text,
-            "updated_at": datetime.now().isoformat()
+            "processed_options": processed_options_str,
+            "timings_ms": timings,
         }
-        supabase.table("results").update(update_payload).eq("id", result_id).execute()
-        
-        # 5. Update prompt status to 'completed'
-        final_status_payload = {"status": "completed", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(final_status_payload).eq("id", prompt_id).execute()
-
-        return f"Processing and summarization complete for prompt ID: {prompt_id}"
 
     except Exception as e:
-        print(f"Error in process_and_summarize_task for prompt_id {prompt_id}: {e}")
-        error_status_payload = {"status": "summary_error", "updated_at": datetime.now().isoformat()}
+        countdown = retry_countdown("summary", self.request.retries, e)
+        if countdown is not None:
+            log.warning(f"Retrying process_and_summarize_task for prompt_id {prompt_id} in {countdown}s: {e}")
+            raise self.retry(exc=e, countdown=countdown, max_retries=STAGE_RETRY_POLICIES["summary"]["max_retries"])
+        log.error(f"Error in process_and_summarize_task for prompt_id {prompt_id}: {e}")
         try:
-            supabase.table("prompts").update(error_status_payload).eq("id", prompt_id).execute()
+            set_prompt_status(prompt_id, "summary_error")
         except Exception as db_error:
-            print(f"Failed to update prompt status to summary_error for prompt_id {prompt_id}: {db_error}")
-        return f"Error during processing and summarization for prompt ID: {prompt_id}. Error: {str(e)}"
-
-
-@celery_app.task
-def mcp_task(prompt_id: int, urls: list[str]):
-    supabase = get_supabase_client()
+            log.error(f"Failed to update prompt status to summary_error for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "summary_error", "error": str(e)}
+
+
+@celery_app.task(bind=True)
+@idempotent_stage("mcp")
+def mcp_task(self, prompt_id: int, urls: list[str], bypass_cache: bool = False):
+    if ASYNC_MODE:
+        from app.async_stages import run_stage
+        return run_stage(self, "mcp", prompt_id, urls, bypass_cache)
+    # In a pipeline (app/pipeline.py) the retrieval stage's output dict arrives in place of prompt_id,
+    # and this stage runs alongside summarization.
+    retrieval = prompt_id if isinstance(prompt_id, dict) else None
+    in_pipeline = retrieval is not None
+    if in_pipeline:
+        prompt_id = retrieval["prompt_id"]
+        if retrieval.get("error"):
+            return retrieval
+    started = time.monotonic()
+
+    get_supabase_client()
+
+    def set_mcp_status(status: str, **fields):
+        if in_pipeline:
+            # Summarization owns prompts.status while both branches run; report MCP progress separately.
+            publish_stage(prompt_id, "mcp", status, **fields)
+            return
+        set_prompt_status(prompt_id, status, **fields)
 
     if not OPENAI_API_KEY_FROM_ENV:
-        print(f"Warning: OPENAI_API_KEY not found. MCP task for prompt_id {prompt_id} will be limited.")
-        error_status_payload = {"status": "mcp_error_config", "updated_at": datetime.now().isoformat()}
+        log.warning(f"OPENAI_API_KEY not found. MCP task for prompt_id {prompt_id} will be limited.")
         try:
-            supabase.table("prompts").update(error_status_payload).eq("id", prompt_id).execute()
+            set_mcp_status("mcp_error_config")
         except Exception as db_error:
-            print(f"Failed to update prompt status to mcp_error_config for prompt_id {prompt_id}: {db_error}")
-        return f"MCP task failed for prompt ID: {prompt_id} due to missing OpenAI API key."
+            log.error(f"Failed to update prompt status to mcp_error_config for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "mcp_error_config", "error": "OpenAI API key not configured"}
 
     try:
-        update_status_payload = {"status": "processing_mcp", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(update_status_payload).eq("id", prompt_id).execute()
+        set_mcp_status("processing_mcp")
     except Exception as db_error:
-        print(f"Failed to update prompt status to processing_mcp for prompt_id {prompt_id}: {db_error}")
+        log.error(f"Failed to update prompt status to processing_mcp for prompt_id {prompt_id}: {db_error}")
         # Optionally re-raise or handle if this is critical before proceeding
 
     try:
-        # TODO: Implement URL fetching and content extraction
-        print(f"MCP task received for prompt_id: {prompt_id} with URLs: {urls}") # Temporary print
+        log.info(f"MCP task received for prompt_id: {prompt_id} with URLs: {urls}")
 
         all_extracted_text = []
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+        # Fetch all non-YouTube URLs concurrently; results come back in input order.
+        fetchable_urls = [url for url in urls if not ("youtube.com/" in url or "youtu.be/" in url)]
+
+        # Fresh cache entries skip download and parse; stale ones are revalidated with a conditional GET.
+        if bypass_cache:
+            cached_pages = {}
+            record_bypass(len(fetchable_urls))
+        else:
+            cached_pages = lookup_pages(fetchable_urls)
+        urls_to_fetch = [url for url in fetchable_urls if not (url in cached_pages and cached_pages[url]["fresh"])]
+        revalidation_headers = {url: conditional_headers(cached_pages[url]) for url in urls_to_fetch if url in cached_pages}
+        # Bodies are streamed into the parser, capped at FETCH_MAX_BYTES; non-text downloads are skipped.
+        fetched = dict(zip(urls_to_fetch, fetch_urls(urls_to_fetch, request_headers=revalidation_headers,
+                                                     parser_factory=StreamingExtractor)))
+        notes = fetch_notes(fetched)
+        if notes:
+            log.info(f"Sources truncated or skipped for prompt_id {prompt_id}: {notes}")
 
         for url in urls:
-            try:
-                print(f"Processing URL: {url}")
-                if "youtube.com/" in url or "youtu.be/" in url:
-                    all_extracted_text.append(f"Content from YouTube URL ({url}): Transcription not yet implemented.")
-                    # TODO: In a future iteration, integrate YouTube transcription service here.
-                    continue
-
-                response = requests.get(url, headers=headers, timeout=10) # 10 second timeout
-                response.raise_for_status() # Raises an HTTPError for bad responses (4XX or 5XX)
-
-                # Use BeautifulSoup to parse HTML and extract text
-                soup = BeautifulSoup(response.content, 'html.parser')
-
-                # Remove script and style elements
-                for script_or_style in soup(["script", "style"]):
-                    script_or_style.decompose()
-
-                # Get text
-                text = soup.get_text(separator='\n', strip=True)
-                all_extracted_text.append(text)
-                print(f"Successfully extracted text from {url}")
-
-            except requests.exceptions.RequestException as e:
-                print(f"Error fetching URL {url}: {e}")
-                all_extracted_text.append(f"[Error fetching content from {url}: {str(e)}]")
-            except Exception as e:
-                print(f"Error processing URL {url} with BeautifulSoup: {e}")
-                all_extracted_text.append(f"[Error processing content from {url}: {str(e)}]")
+            all_extracted_text.append(source_text(url, cached_pages.get(url), fetched.get(url), bypass_cache))
 
-        combined_text = "\n\n--- Next Source ---\n\n".join(all_extracted_text)
+        # Paragraphs repeated across sources (mirrors, syndicated copies, site boilerplate) are summarized once;
+        # the full extracted text is still what gets stored.
+        texts_to_summarize, dedup_stats = dedup_sources(urls, all_extracted_text)
+        notes = add_dedup_notes(notes, dedup_stats)
+        combined_text = "\n\n--- Next Source ---\n\n".join(texts_to_summarize)
+        index_sources(prompt_id, urls, all_extracted_text, retrieval.get("user_id") if in_pipeline else None)
 
-        # Make combined_text available for the next step (summarization)
-        # For now, we can just print it or store it in a variable that the summarization placeholder will use.
-        print(f"Combined text length: {len(combined_text)}")
+        log.info(f"Combined text length: {len(combined_text)}")
         if not combined_text.strip():
-            print("No text could be extracted from the provided URLs.")
-            # Potentially update status to an error or a specific "no_content" status here
-            # For now, let the task proceed, OpenAI call might handle empty input gracefully or error out.
+            log.warning("No text could be extracted from the provided URLs.")
+            # The task still completes, with a summary saying nothing could be extracted.
 
         mcp_summary_text = "Default MCP summary: No specific summary generated."
         # Placeholder for structured results like key quotes
@@ -273,95 +492,117 @@ def mcp_task(prompt_id: int, urls: list[str]):
             mcp_summary_text = "OpenAI API key not configured. Cannot generate MCP summary."
         else:
             try:
-                # Truncate combined_text to avoid exceeding token limits (e.g., ~12000 chars for a 4k token model context)
-                # This is a simple approach. A more robust solution might involve chunking.
-                # Average token length is ~4 chars. 3000 tokens * 4 chars/token = 12000 chars for user content.
-                max_chars = 12000
-                if len(combined_text) > max_chars:
-                    print(f"Warning: Combined text length ({len(combined_text)}) exceeds max_chars ({max_chars}). Truncating.")
-                    combined_text = combined_text[:max_chars]
-
-                # Define the prompt for the LLM
-                # The user wants a "resume" and "Key Quotes"
-                # For now, we will aim for a textual summary that includes key quotes.
-                # A more advanced version might ask for JSON.
-                mcp_prompt = (
-                    "You are an expert research assistant. Based on the following text compiled from various web sources, "
-                    "please create a concise resume or summary. Your summary should highlight the most important information "
-                    "and explicitly include several Key Quotes from the text that capture essential points or statements. "
-                    "Structure the output clearly.\n\n"
-                    "Source Text:\n"
-                    "---------------------\n"
-                    f"{combined_text}\n"
-                    "---------------------\n\n"
-                    "Resume/Summary with Key Quotes:"
-                )
-
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo", # Or a model suitable for longer contexts if available and configured
-                    messages=[
-                        {"role": "system", "content": "You are an AI assistant skilled in summarizing text and extracting key information and quotes."},
-                        {"role": "user", "content": mcp_prompt}
-                    ],
-                    max_tokens=1000  # Adjust as needed, allowing for a decent-sized summary
-                )
-                mcp_summary_text = response.choices[0].message.content.strip()
+                # Token-aware map-reduce summarization: text that doesn't fit one request is
+                # chunked, summarized in parallel and merged instead of being truncated.
+                mcp_summary_text, summary_stats = summarize_sources(get_openai_client(), combined_text, stream_prompt_id=prompt_id if LLM_STREAMING else None)
+                log.info(f"MCP summarization stats for prompt_id {prompt_id}: {summary_stats}")
                 # TODO: Implement parsing of key quotes if a structured response is attempted later.
 
             except Exception as e:
-                print(f"OpenAI call for MCP summarization failed for prompt_id {prompt_id}: {e}")
+                log.warning(f"OpenAI call for MCP summarization failed for prompt_id {prompt_id}: {e}")
                 mcp_summary_text = f"Error during AI summarization for MCP task: {str(e)}"
 
-        # Ensure mcp_summary_text is available for the next step (storing results)
-        # For now, print it:
-        print(f"MCP Summary: {mcp_summary_text}")
+        log.info(f"MCP Summary: {mcp_summary_text}")
 
         try:
-            # Find the relevant result_id for the given prompt_id
-            # Assuming we update the most recent result associated with the prompt_id
-            result_response = supabase.table("results").select("id").eq("prompt_id", prompt_id).order("created_at", desc=True).limit(1).execute()
-
-            if not result_response.data:
-                raise Exception(f"No result entry found in 'results' table for prompt_id: {prompt_id} to store MCP data.")
-
-            result_id_to_update = result_response.data[0]['id']
-
-            update_payload = {
-                "mcp_data": mcp_summary_text, # IMPORTANT: The 'results' table requires a new TEXT column named 'mcp_data' for this to work.
-                "updated_at": datetime.now().isoformat()
-            }
-
-            update_response = supabase.table("results").update(update_payload).eq("id", result_id_to_update).execute()
-
-            if hasattr(update_response, 'error') and update_response.error:
-                raise Exception(f"Failed to store MCP results: {update_response.error.message}")
-
-            print(f"MCP results stored successfully for result_id: {result_id_to_update}")
-
+            # Store the summary on the prompt's current 'results' row (the retrieval stage's row in
+            # a pipeline) and, outside a pipeline, mark the prompt 'mcp_complete', in one round trip.
+            # IMPORTANT: The 'results' table requires a TEXT column named 'mcp_data' for this to work.
+            outcome = commit_stage(prompt_id, None if in_pipeline else "mcp_complete",
+                                   result=mcp_result_columns(mcp_summary_text, urls, all_extracted_text, notes),
+                                   result_id=retrieval.get("result_id") if in_pipeline else None)
+            if not outcome["applied"]:
+                raise StageConflict(prompt_id, "mcp_complete", outcome["status"])
+            result_id_to_update = outcome["result_id"]
+            log.info(f"MCP results stored successfully for result_id: {result_id_to_update}")
+
+        except StageConflict:
+            raise
         except Exception as e:
-            print(f"Error storing MCP results for prompt_id {prompt_id}: {e}")
+            log.error(f"Error storing MCP results for prompt_id {prompt_id}: {e}")
             # Update prompt status to mcp_error_storage if not already in an error state
-            error_status_payload = {"status": "mcp_error_storage", "updated_at": datetime.now().isoformat()}
-            supabase.table("prompts").update(error_status_payload).eq("id", prompt_id).execute()
+            set_mcp_status("mcp_error_storage")
             # Allow the main exception handler to return the error message for the task
             raise # Re-raise the exception to be caught by the main task error handler
 
-        final_status_payload = {"status": "mcp_complete", "updated_at": datetime.now().isoformat()}
-        supabase.table("prompts").update(final_status_payload).eq("id", prompt_id).execute()
-        return f"MCP task completed for prompt ID: {prompt_id}"
+        if in_pipeline:
+            publish_stage(prompt_id, "mcp", "mcp_complete", mcp_data=mcp_summary_text)
+        else:
+            publish_status(prompt_id, "mcp_complete", mcp_data=mcp_summary_text)
+        timings = dict(retrieval.get("timings_ms", {})) if in_pipeline else {}
+        timings["mcp"] = round((time.monotonic() - started) * 1000, 1)
+        return {
+            "prompt_id": prompt_id,
+            "status": "mcp_complete",
+            "result_id": result_id_to_update,
+            "mcp_data": mcp_summary_text,
+            "source_notes": notes,
+            "dedup": dedup_summary(prompt_id, dedup_stats),
+            "timings_ms": timings,
+        }
 
     except Exception as e:
-        print(f"Error in mcp_task for prompt_id {prompt_id}: {e}")
+        countdown = retry_countdown("mcp", self.request.retries, e)
+        if countdown is not None:
+            log.warning(f"Retrying mcp_task for prompt_id {prompt_id} in {countdown}s: {e}")
+            raise self.retry(exc=e, countdown=countdown, max_retries=STAGE_RETRY_POLICIES["mcp"]["max_retries"])
+        log.error(f"Error in mcp_task for prompt_id {prompt_id}: {e}")
         # The error status might have been set to 'mcp_error_storage' already if storage failed.
-        # If it's another error, or if it didn't reach storage error handling, set to 'mcp_error'.
-        # To avoid overwriting a more specific error, could check current status or let this be general.
-        # For simplicity here, we'll set it to 'mcp_error' if it reaches this general handler.
-        # A more sophisticated error handling could preserve specific error states.
-        current_status_response = supabase.table("prompts").select("status").eq("id", prompt_id).single().execute()
-        if current_status_response.data and current_status_response.data.get("status") not in ["mcp_error_storage", "mcp_error_config"]:
-            error_status_payload = {"status": "mcp_error", "updated_at": datetime.now().isoformat()}
+        # 'mcp_error' is only entered from 'processing_mcp' (STATUS_TRANSITIONS), so it never
+        # overwrites that more specific error.
+        if in_pipeline:
+            set_mcp_status("mcp_error", error=str(e))
+        else:
             try:
-                supabase.table("prompts").update(error_status_payload).eq("id", prompt_id).execute()
+                set_mcp_status("mcp_error")
             except Exception as db_error:
-                print(f"Failed to update prompt status to mcp_error for prompt_id {prompt_id}: {db_error}")
-        return f"Error during MCP task for prompt ID: {prompt_id}. Error: {str(e)}"
+                log.error(f"Failed to update prompt status to mcp_error for prompt_id {prompt_id}: {db_error}")
+        return {"prompt_id": prompt_id, "status": "mcp_error", "error": str(e)}
+
+
+@celery_app.task(bind=True)
+@idempotent_stage("complete")
+def pipeline_complete_task(self, results, prompt_id: int, started_at: float, batch_id: str | None = None):
+    """
+    Final pipeline stage: records end-to-end latency and tells watchers the
+    prompt is done, and frees its fair-share slot (and, for a batch prompt, its
+    batch slot) for the next one.
+    """
+    stage_results = results if isinstance(results, list) else [results]
+    stage_results = [r for r in stage_results if isinstance(r, dict)]
+    latency_ms = (time.time() - started_at) * 1000
+    record_pipeline_latency(latency_ms)
+
+    fields = {}
+    timings = {}
+    for r in stage_results:
+        timings.update(r.get("timings_ms", {}))
+        for key in ("summary", "processed_options", "mcp_data"):
+            if r.get(key) is not None:
+                fields[key] = r[key]
+    # The summary branch's outcome is the prompt's status; MCP outcome is reported as mcp_status.
+    main = next((r for r in stage_results if not r.get("status", "").startswith("mcp")), stage_results[0] if stage_results else {})
+    mcp = next((r for r in stage_results if r.get("status", "").startswith("mcp")), None)
+    if mcp is not None:
+        fields["mcp_status"] = mcp["status"]
+    status = main.get("status", "summary_error")
+    publish_status(prompt_id, status, pipeline_complete=True, pipeline_latency_ms=round(latency_ms, 1), stage_timings_ms=timings, **fields)
+    log.info(f"Pipeline for prompt_id {prompt_id} finished with status {status} in {latency_ms:.0f} ms (stages: {timings})")
+    if FAIR_SHARE_ENABLED:
+        finish_prompt(prompt_id)
+    if batch_id is not None:
+        finish_batch_prompt(batch_id, prompt_id, status)
+    return {"prompt_id": prompt_id, "status": "pipeline_complete", "prompt_status": status, "latency_ms": round(latency_ms, 1),
+            "stage_timings_ms": timings, "mcp_status": fields.get("mcp_status")}
+
+
+@celery_app.task
+def batch_dispatch_task(batch_id: str):
+    """Dispatch a batch's queued prompts later, when the queue was too deep to take them before."""
+    return dispatch_batch(batch_id)
+
+
+@celery_app.task
+def fair_share_dispatch_task():
+    """Release queued pipelines later, when none were running to trigger it (e.g. every user at their token quota)."""
+    return dispatch_fair_share()
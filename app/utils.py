@@ -1,13 +1,345 @@
-from supabase import create_client, Client
+from supabase import create_client, acreate_client, Client, AsyncClient, ClientOptions, AsyncClientOptions
+import asyncio
+import httpx
+import redis
 import os
+import threading
+import time
+from datetime import datetime
+
+from app.instrumentation import get_logger, record_span
+
+log = get_logger(__name__)
 
 # It's better to ensure rxconfig is importable or pass vars.
 # For worker context, direct env var reading is often more straightforward.
 SUPABASE_URL = os.getenv("SUPABASE_URL", "YOUR_SUPABASE_URL_HERE")
 SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY", "YOUR_SUPABASE_KEY_HERE")
 
+# Connection pool settings for the shared Supabase client.
+# One client (and one httpx connection pool) is kept per process; Celery prefork
+# children and Reflex worker threads all reuse it instead of reconnecting per call.
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "10"))
+SUPABASE_POOL_KEEPALIVE = int(os.getenv("SUPABASE_POOL_KEEPALIVE", str(SUPABASE_POOL_SIZE)))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "30"))
+SUPABASE_CONNECT_RETRIES = int(os.getenv("SUPABASE_CONNECT_RETRIES", "2"))
+
+# Pool for the async client used by TASK_EXECUTION_MODE=asyncio (app/aio.py), where
+# one process runs many stages at once.
+ASYNC_SUPABASE_POOL_SIZE = int(os.getenv("ASYNC_SUPABASE_POOL_SIZE", "50"))
+
+# Stage commits (commit_stage below) go through the commit_stage() database function
+# from supabase/migrations: one round trip, atomic. Set to false on databases
+# without that migration to use separate REST calls instead.
+STAGE_COMMIT_RPC = os.getenv("STAGE_COMMIT_RPC", "true").lower() == "true"
+
+# Statuses a prompt must be in to move to each status (compare-and-set in
+# commit_stage); None allows any. Keeps late or duplicate workers from moving
+# a prompt backwards, e.g. a retried retrieval overwriting 'completed'.
+STATUS_TRANSITIONS = {
+    "processing_retrieval": ("pending", "pending_retrieval", "processing_retrieval", "retrieval_error"),
+    "retrieval_complete": ("processing_retrieval",),
+    "retrieval_error": ("pending", "pending_retrieval", "processing_retrieval"),
+    "processing_summary": ("retrieval_complete", "processing_summary", "summary_error", "summary_error_config", "completed"),
+    "completed": ("processing_summary",),
+    "summary_error": ("retrieval_complete", "processing_summary"),
+    "summary_error_config": ("retrieval_complete", "processing_summary", "summary_error_config"),
+    "processing_mcp": None, # sources can be summarized for a prompt at any point
+    "mcp_complete": ("processing_mcp",),
+    "mcp_error_storage": ("processing_mcp",),
+    "mcp_error": ("processing_mcp",), # never replaces the more specific mcp_error_storage / mcp_error_config
+    "mcp_error_config": None,
+}
+RESULT_COLUMNS = ("raw_data", "raw_data_ref", "processed_options", "summary", "mcp_data", "source_refs")
+
+# Shared Redis used for caches and coordination (same instance as the Celery broker).
+REDIS_URL = os.getenv("REDIS_", "redis://redis:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+
+_client: Client | None = None
+_http_client: httpx.Client | None = None
+_client_pid: int | None = None
+_client_lock = threading.Lock()
+_redis_client: redis.Redis | None = None
+_async_client: AsyncClient | None = None
+_async_client_pid: int | None = None
+
+_pool_metrics = {
+    "clients_created": 0,
+    "reconnects": 0,
+    "requests": 0,
+    "errors": 0,
+    "health_checks": 0,
+    "health_check_failures": 0,
+}
+
+
+def _db_operation(request) -> str:
+    """Span name for a Supabase request: method and table, e.g. 'PATCH prompts' or 'POST rpc/commit_stage'."""
+    path = request.url.path
+    path = path.split("/rest/v1/", 1)[1] if "/rest/v1/" in path else path.strip("/").split("/", 1)[0]
+    return f"{request.method} {path}"
+
+
+def _count_request(request):
+    _pool_metrics["requests"] += 1
+    request.extensions["tia_started"] = time.perf_counter()
+
+
+def _count_response(response):
+    if response.status_code >= 500:
+        _pool_metrics["errors"] += 1
+    started = response.request.extensions.get("tia_started")
+    if started is not None:
+        record_span("db", _db_operation(response.request), time.perf_counter() - started,
+                    f"HTTP {response.status_code}" if response.status_code >= 400 else None, status=response.status_code)
+
+
+async def _acount_request(request):
+    _count_request(request)
+
+
+async def _acount_response(response):
+    _count_response(response)
+
+
+def _build_http_client() -> httpx.Client:
+    limits = httpx.Limits(
+        max_connections=SUPABASE_POOL_SIZE,
+        max_keepalive_connections=SUPABASE_POOL_KEEPALIVE,
+        keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(SUPABASE_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT, pool=SUPABASE_TIMEOUT)
+    # retries= makes the transport transparently re-open connections that fail to
+    # connect (e.g. a keep-alive socket dropped by PostgREST or a load balancer).
+    transport = httpx.HTTPTransport(limits=limits, retries=SUPABASE_CONNECT_RETRIES)
+    return httpx.Client(
+        transport=transport,
+        timeout=timeout,
+        follow_redirects=True,
+        event_hooks={"request": [_count_request], "response": [_count_response]},
+    )
+
+
+def _reset_after_fork():
+    # Sockets inherited from the parent must never be shared with a forked child
+    # (Celery prefork). Drop the references without closing the parent's sockets.
+    global _client, _http_client, _client_pid, _async_client, _async_client_pid
+    _client = None
+    _http_client = None
+    _client_pid = None
+    _async_client = None
+    _async_client_pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def get_supabase_client() -> Client:
+    global _client, _http_client, _client_pid
     # Ensure that SUPABASE_URL and SUPABASE_KEY are not the placeholder values
     if SUPABASE_URL == "YOUR_SUPABASE_URL_HERE" or SUPABASE_KEY == "YOUR_SUPABASE_KEY_HERE":
         raise ValueError("Supabase URL or Key is not configured. Please set the environment variables.")
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            _http_client = _build_http_client()
+            _client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=_http_client))
+            _client_pid = pid
+            _pool_metrics["clients_created"] += 1
+        return _client
+
+
+async def get_async_supabase_client() -> AsyncClient:
+    """
+    Process-wide async Supabase client with its own httpx.AsyncClient pool.
+    Must be used from the process event loop (app.aio.get_loop()).
+    """
+    global _async_client, _async_client_pid
+    if SUPABASE_URL == "YOUR_SUPABASE_URL_HERE" or SUPABASE_KEY == "YOUR_SUPABASE_KEY_HERE":
+        raise ValueError("Supabase URL or Key is not configured. Please set the environment variables.")
+
+    pid = os.getpid()
+    if _async_client is not None and _async_client_pid == pid:
+        return _async_client
+
+    http_client = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=ASYNC_SUPABASE_POOL_SIZE, max_keepalive_connections=ASYNC_SUPABASE_POOL_SIZE,
+                                keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY),
+            retries=SUPABASE_CONNECT_RETRIES,
+        ),
+        timeout=httpx.Timeout(SUPABASE_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT, pool=SUPABASE_TIMEOUT),
+        follow_redirects=True,
+        event_hooks={"request": [_acount_request], "response": [_acount_response]},
+    )
+    client = await acreate_client(SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(httpx_client=http_client))
+    if _async_client is None or _async_client_pid != pid: # another coroutine may have won the race
+        _async_client, _async_client_pid = client, pid
+        _pool_metrics["clients_created"] += 1
+    else:
+        await http_client.aclose()
+    return _async_client
+
+
+def reset_supabase_client():
+    """Close the pooled client so the next get_supabase_client() call reconnects."""
+    global _client, _http_client, _client_pid
+    with _client_lock:
+        if _http_client is not None and _client_pid == os.getpid():
+            try:
+                _http_client.close()
+            except Exception as e:
+                log.warning(f"Error closing Supabase HTTP client: {e}")
+        if _client is not None:
+            _pool_metrics["reconnects"] += 1
+        _client = None
+        _http_client = None
+        _client_pid = None
+
+
+def supabase_health_check() -> bool:
+    """Run a cheap query through the pooled client; reconnect if it fails."""
+    _pool_metrics["health_checks"] += 1
+    try:
+        get_supabase_client().table("prompts").select("id").limit(1).execute()
+        return True
+    except ValueError:
+        raise
+    except Exception as e:
+        log.warning(f"Supabase health check failed, resetting client: {e}")
+        _pool_metrics["health_check_failures"] += 1
+        reset_supabase_client()
+        return False
+
+
+def authenticated_user_id(authorization: str | None) -> str | None:
+    """
+    Supabase Auth user id for an "Authorization: Bearer <access token>" header
+    value, or None when it is missing, malformed, expired or rejected.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    try:
+        response = get_supabase_client().auth.get_user(token.strip())
+    except ValueError:
+        raise
+    except Exception as e:
+        log.info(f"Access token rejected: {e}")
+        return None
+    user = getattr(response, "user", None)
+    return str(user.id) if user is not None and user.id else None
+
+
+def get_supabase_pool_metrics() -> dict:
+    """Return counters plus a snapshot of the httpx connection pool for sizing."""
+    metrics = dict(_pool_metrics)
+    metrics["pool_size"] = SUPABASE_POOL_SIZE
+    metrics["pool_keepalive"] = SUPABASE_POOL_KEEPALIVE
+    connections = []
+    if _http_client is not None and _client_pid == os.getpid():
+        pool = getattr(_http_client._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+    metrics["connections_open"] = len(connections)
+    metrics["connections_idle"] = sum(1 for c in connections if c.is_idle())
+    metrics["connections_active"] = metrics["connections_open"] - metrics["connections_idle"]
+    return metrics
+
+
+class StageConflict(ValueError):
+    """A stage commit was refused because the prompt has moved on (not retried)."""
+
+    def __init__(self, prompt_id: int, status: str, current_status: str | None):
+        super().__init__(f"prompt_id {prompt_id} is '{current_status}'; refusing to move it to '{status}'")
+        self.current_status = current_status
+
+
+def _commit_params(prompt_id: int, status: str | None, result: dict | None, new_result: bool, result_id: int | None) -> dict:
+    return {
+        "p_prompt_id": prompt_id,
+        "p_to_status": status,
+        "p_from_statuses": list(STATUS_TRANSITIONS[status]) if status is not None and STATUS_TRANSITIONS.get(status) is not None else None,
+        "p_result": result,
+        "p_new_result": new_result,
+        "p_result_id": result_id,
+    }
+
+
+def _commit_stage_rest(client: Client, params: dict) -> dict:
+    """commit_stage() without the database function: the same steps as separate (non-atomic) REST calls."""
+    prompt_id, status, from_statuses = params["p_prompt_id"], params["p_to_status"], params["p_from_statuses"]
+    result, result_id = params["p_result"], params["p_result_id"]
+    now = datetime.now().isoformat()
+    previous = None
+    if from_statuses is not None:
+        current = client.table("prompts").select("status").eq("id", prompt_id).execute()
+        if not current.data:
+            return {"applied": False, "status": None, "previous_status": None, "result_id": None, "reason": "prompt_not_found"}
+        previous = current.data[0]["status"]
+        if previous not in from_statuses:
+            return {"applied": False, "status": previous, "previous_status": previous, "result_id": result_id, "reason": "status_conflict"}
+
+    if result is not None:
+        columns = {k: v for k, v in result.items() if k in RESULT_COLUMNS}
+        if params["p_new_result"]:
+            inserted = client.table("results").insert({"prompt_id": prompt_id, **columns, "created_at": now}).execute()
+            result_id = inserted.data[0]["id"] if inserted.data else None
+        else:
+            if result_id is None:
+                latest = client.table("results").select("id").eq("prompt_id", prompt_id).order("created_at", desc=True).limit(1).execute()
+                if not latest.data:
+                    raise Exception(f"No results row for prompt_id {prompt_id} to update")
+                result_id = latest.data[0]["id"]
+            client.table("results").update({**columns, "updated_at": now}).eq("id", result_id).execute()
+
+    if status is not None:
+        client.table("prompts").update({"status": status, "updated_at": now}).eq("id", prompt_id).execute()
+    return {"applied": True, "status": status or previous, "previous_status": previous, "result_id": result_id}
+
+
+def commit_stage(prompt_id: int, status: str | None = None, result: dict | None = None, new_result: bool = False,
+                 result_id: int | None = None) -> dict:
+    """
+    Commit a stage in one round trip: write `result` columns (RESULT_COLUMNS)
+    to a new results row (new_result) or to result_id / the prompt's current
+    row, and move the prompt to `status`, provided its current status is one
+    STATUS_TRANSITIONS allows.
+
+    Returns {applied, status, previous_status, result_id}. When applied is
+    False the prompt had moved on (e.g. a stale or duplicate worker) and
+    nothing was written.
+    """
+    params = _commit_params(prompt_id, status, result, new_result, result_id)
+    client = get_supabase_client()
+    if not STAGE_COMMIT_RPC:
+        return _commit_stage_rest(client, params)
+    return client.rpc("commit_stage", params).execute().data
+
+
+async def acommit_stage(prompt_id: int, status: str | None = None, result: dict | None = None, new_result: bool = False,
+                        result_id: int | None = None) -> dict:
+    """commit_stage() for coroutines on the process event loop (TASK_EXECUTION_MODE=asyncio)."""
+    if not STAGE_COMMIT_RPC:
+        return await asyncio.to_thread(commit_stage, prompt_id, status, result, new_result, result_id)
+    params = _commit_params(prompt_id, status, result, new_result, result_id)
+    db = await get_async_supabase_client()
+    return (await db.rpc("commit_stage", params).execute()).data
+
+
+def get_redis_client() -> redis.Redis:
+    """Process-wide Redis client; redis-py's pool reconnects itself after fork."""
+    global _redis_client
+    if _redis_client is None:
+        with _client_lock:
+            if _redis_client is None:
+                pool = redis.ConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
+                _redis_client = redis.Redis(connection_pool=pool)
+    return _redis_client
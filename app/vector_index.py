@@ -0,0 +1,403 @@
+import fcntl
+import hashlib
+import importlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+except ImportError: # Optional: without it the index is disabled
+    np = None
+
+from app.instrumentation import get_logger, inc, span
+from app.utils import get_redis_client
+
+log = get_logger(__name__)
+
+# Local embedding index of past results, for information_retrieval_task.
+# Each worker host keeps one on disk (shared by its processes): prompts with
+# their retrieval answers, the answers themselves, and MCP source text, each
+# tagged with the user it came from. Lookups only see the same user's entries
+# (prompts without a user only see other prompts without one). Entries above
+# VECTOR_INDEX_AUGMENT_THRESHOLD similarity (cosine) are added to the
+# retrieval request as context. An answer is reused without an LLM call
+# depending on VECTOR_INDEX_REUSE:
+#   "exact"   (default) the user asked the same prompt before, up to case,
+#             whitespace and trailing punctuation,
+#   "similar" also a past prompt at least VECTOR_INDEX_REUSE_THRESHOLD
+#             similar; needs a semantic embedder (not "hashing", which is
+#             lexical: "flights to Miami" and "flights to Cancun" score
+#             close), else only exact repeats are reused,
+#   "off"     never.
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "true").lower() == "true"
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", ".vector_index")
+VECTOR_INDEX_REUSE = os.getenv("VECTOR_INDEX_REUSE", "exact").lower()
+VECTOR_INDEX_REUSE_THRESHOLD = float(os.getenv("VECTOR_INDEX_REUSE_THRESHOLD", "0.95"))
+VECTOR_INDEX_AUGMENT_THRESHOLD = float(os.getenv("VECTOR_INDEX_AUGMENT_THRESHOLD", "0.6"))
+VECTOR_INDEX_TOP_K = int(os.getenv("VECTOR_INDEX_TOP_K", "3"))
+# Characters of stored context added to one retrieval request, and kept per entry.
+VECTOR_INDEX_CONTEXT_CHARS = int(os.getenv("VECTOR_INDEX_CONTEXT_CHARS", "4000"))
+# Shorter source texts (error pages, stubs) are not indexed.
+VECTOR_INDEX_MIN_SOURCE_CHARS = int(os.getenv("VECTOR_INDEX_MIN_SOURCE_CHARS", "200"))
+# Embedding function: "hashing" (offline, word and word-pair feature hashing),
+# "openai" (VECTOR_INDEX_OPENAI_MODEL) or "package.module:function", a callable
+# taking a list of texts and returning an (n, VECTOR_INDEX_DIM) array.
+VECTOR_INDEX_EMBEDDER = os.getenv("VECTOR_INDEX_EMBEDDER", "hashing")
+VECTOR_INDEX_DIM = int(os.getenv("VECTOR_INDEX_DIM", "256"))
+VECTOR_INDEX_OPENAI_MODEL = os.getenv("VECTOR_INDEX_OPENAI_MODEL", "text-embedding-3-small")
+# Approximate search: each vector also gets a VECTOR_INDEX_BITS-bit sign code
+# (random hyperplanes). A lookup ranks every row by Hamming distance between
+# codes and scores only the VECTOR_INDEX_CANDIDATES closest exactly.
+VECTOR_INDEX_BITS = int(os.getenv("VECTOR_INDEX_BITS", "256"))
+VECTOR_INDEX_CANDIDATES = int(os.getenv("VECTOR_INDEX_CANDIDATES", "200"))
+
+STATS_KEY = "tia:vector_index:stats"
+
+_WORD = re.compile(r"\w+")
+_embedders = {}
+
+
+def register_embedder(name: str, fn):
+    """Make fn (list of texts -> (n, VECTOR_INDEX_DIM) array) selectable as VECTOR_INDEX_EMBEDDER=name."""
+    _embedders[name] = fn
+
+
+def hashing_embedder(texts: list[str]):
+    """Signed feature hashing of words and word pairs: no model, no network, stable across processes."""
+    vectors = np.zeros((len(texts), VECTOR_INDEX_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = _WORD.findall(text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode("utf-8"))
+            vectors[row, h % VECTOR_INDEX_DIM] += 1.0 if h & 0x80000000 else -1.0
+    return vectors
+
+
+def openai_embedder(texts: list[str]):
+    from app.tasks import get_openai_client # worker-side client, created on first use
+    response = get_openai_client().embeddings.create(model=VECTOR_INDEX_OPENAI_MODEL, input=texts,
+                                                     dimensions=VECTOR_INDEX_DIM)
+    return np.array([d.embedding for d in response.data], dtype=np.float32)
+
+
+register_embedder("hashing", hashing_embedder)
+register_embedder("openai", openai_embedder)
+
+
+def get_embedder():
+    name = VECTOR_INDEX_EMBEDDER
+    if name not in _embedders:
+        module, _, attr = name.partition(":")
+        register_embedder(name, getattr(importlib.import_module(module), attr))
+    return _embedders[name]
+
+
+def embed(texts: list[str]):
+    """Unit-length float32 embeddings of texts, one row each."""
+    vectors = np.asarray(get_embedder()(texts), dtype=np.float32).reshape(len(texts), VECTOR_INDEX_DIM)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def prompt_hash(text: str) -> str:
+    """Hash of a prompt up to case, whitespace and trailing punctuation: the key for exact reuse."""
+    normalized = " ".join(text.casefold().split()).rstrip(" ?.!")
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:32]
+
+
+def similar_reuse() -> bool:
+    """Whether answers of similar (not just repeated) prompts may be reused."""
+    return VECTOR_INDEX_REUSE == "similar" and VECTOR_INDEX_EMBEDDER != "hashing"
+
+
+def _popcount(x):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return np.unpackbits(x.view(np.uint8).reshape(len(x), -1), axis=1).sum(axis=1)
+
+
+class VectorIndex:
+    """
+    Append-only index in one directory per embedder and dimension:
+
+        vectors.f32  row-major float32 vectors (memory-mapped for lookups)
+        codes.u64    sign codes of the vectors, VECTOR_INDEX_BITS // 64 words per row
+        contexts     UTF-8 context text, read by offset for the rows a lookup returns
+        rows.jsonl   per-row metadata; a row exists once its line is complete
+
+    Processes on the host append under an exclusive file lock and pick up each
+    other's rows on their next lookup. Rows are grouped by "user_id" (rows
+    written before entries carried one are never returned), and prompt rows
+    are also found by prompt_hash().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.words = max(1, VECTOR_INDEX_BITS // 64)
+        rng = np.random.default_rng(VECTOR_INDEX_DIM)
+        self.planes = rng.standard_normal((self.words * 64, VECTOR_INDEX_DIM)).astype(np.float32)
+        self.rows = []
+        self.keys = set()
+        self.user_rows: dict[str | None, list[int]] = {}
+        self.prompt_rows: dict[tuple[str | None, str], int] = {}
+        self._user_arrays = {}
+        self.vectors = np.zeros((0, VECTOR_INDEX_DIM), dtype=np.float32)
+        self.codes = np.zeros((0, self.words), dtype=np.uint64)
+        self._meta_offset = 0
+        self._lock = threading.Lock()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _codes(self, vectors):
+        bits = (vectors @ self.planes.T > 0).astype(np.uint8).reshape(len(vectors), self.words, 64)
+        return np.packbits(bits, axis=2, bitorder="little").view(np.uint64).reshape(len(vectors), self.words)
+
+    def _refresh(self):
+        """Map rows other processes (or this one) have appended since the last call."""
+        try:
+            with open(self._file("rows.jsonl"), "rb") as f:
+                f.seek(self._meta_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        complete = data[:data.rfind(b"\n") + 1]
+        if not complete:
+            return
+        for line in complete.splitlines():
+            row = json.loads(line)
+            self.keys.add(row["key"])
+            if "user_id" in row:
+                self.user_rows.setdefault(row["user_id"], []).append(len(self.rows))
+                if row.get("prompt_hash"):
+                    self.prompt_rows[(row["user_id"], row["prompt_hash"])] = len(self.rows)
+            self.rows.append(row)
+        self._user_arrays = {}
+        self._meta_offset += len(complete)
+        n = len(self.rows)
+        self.vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r", shape=(n, VECTOR_INDEX_DIM))
+        self.codes = np.memmap(self._file("codes.u64"), dtype=np.uint64, mode="r", shape=(n, self.words))
+
+    def add(self, entries: list[dict]) -> int:
+        """
+        Insert entries {"kind", "text" (embedded), "context" (returned by lookups), "user_id", **metadata}.
+        Entries whose user, kind and text are already indexed are skipped; returns the number added.
+        """
+        with self._lock:
+            self._refresh()
+            fresh, seen = [], set()
+            for entry in entries:
+                entry = {"user_id": None, **entry}
+                key = hashlib.sha256(f"{entry['user_id']}\0{entry['kind']}\0{entry['text']}".encode("utf-8")).hexdigest()[:32]
+                if key not in self.keys and key not in seen:
+                    seen.add(key)
+                    fresh.append((key, entry))
+            if not fresh:
+                return 0
+            vectors = embed([entry["text"] for _, entry in fresh])
+            codes = self._codes(vectors)
+            with open(self._file("lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._refresh()
+                n = len(self.rows)
+                # Drop any partial row a crashed writer left behind its last complete metadata line.
+                for name, width in (("vectors.f32", VECTOR_INDEX_DIM * 4), ("codes.u64", self.words * 8)):
+                    with open(self._file(name), "ab") as f:
+                        f.truncate(n * width)
+                        f.write((vectors if name == "vectors.f32" else codes).tobytes())
+                lines = []
+                with open(self._file("contexts"), "ab") as f:
+                    offset = f.tell()
+                    for key, entry in fresh:
+                        context = entry["context"][:VECTOR_INDEX_CONTEXT_CHARS].encode("utf-8")
+                        f.write(context)
+                        meta = {k: v for k, v in entry.items() if k not in ("text", "context")}
+                        lines.append(json.dumps({**meta, "key": key, "offset": offset, "length": len(context),
+                                                 "added_at": time.time()}) + "\n")
+                        offset += len(context)
+                with open(self._file("rows.jsonl"), "a") as f:
+                    f.write("".join(lines))
+                self._refresh()
+            return len(fresh)
+
+    def _context(self, row: dict) -> str:
+        with open(self._file("contexts"), "rb") as f:
+            f.seek(row["offset"])
+            return f.read(row["length"]).decode("utf-8", errors="replace")
+
+    def find_prompt(self, user_id: str | None, text: str) -> dict | None:
+        """The user's latest prompt row for the same prompt (see prompt_hash), with "context", or None."""
+        with self._lock:
+            self._refresh()
+            row = self.prompt_rows.get((user_id, prompt_hash(text)))
+            row = self.rows[row] if row is not None else None
+        return {**row, "similarity": 1.0, "context": self._context(row)} if row is not None else None
+
+    def search(self, text: str, k: int = VECTOR_INDEX_TOP_K, kinds: tuple[str, ...] | None = None,
+               exact: bool = False, user_id: str | None = None) -> list[dict]:
+        """The k rows of `user_id` (optionally of `kinds`) most similar to text: metadata plus "similarity" and "context"."""
+        with self._lock:
+            self._refresh()
+            rows, vectors, codes = self.rows, self.vectors, self.codes
+            if user_id not in self._user_arrays:
+                self._user_arrays[user_id] = np.array(self.user_rows.get(user_id, []), dtype=np.int64)
+            members = self._user_arrays[user_id]
+        if not len(members):
+            return []
+        query = embed([text])[0]
+        if exact or len(members) <= VECTOR_INDEX_CANDIDATES:
+            candidates = members
+        else:
+            distances = _popcount(codes[members] ^ self._codes(query[None, :])).sum(axis=1)
+            candidates = members[np.argpartition(distances, VECTOR_INDEX_CANDIDATES)[:VECTOR_INDEX_CANDIDATES]]
+        if kinds is not None:
+            candidates = np.array([i for i in candidates if rows[i]["kind"] in kinds], dtype=np.int64)
+            if len(candidates) == 0:
+                return []
+        candidates = np.sort(candidates) # memmap reads in file order
+        scores = np.asarray(vectors[candidates] @ query)
+        order = np.argsort(-scores)[:k]
+        hits = []
+        for i in order:
+            row = rows[candidates[i]]
+            hits.append({**row, "similarity": float(scores[i]), "context": self._context(row)})
+        return hits
+
+
+_index: VectorIndex | None = None
+_index_pid: int | None = None
+_index_lock = threading.Lock()
+
+
+def index_enabled() -> bool:
+    return VECTOR_INDEX_ENABLED and np is not None
+
+
+def get_index() -> VectorIndex:
+    """This process's handle on the host's index (reopened after a fork)."""
+    global _index, _index_pid
+    with _index_lock:
+        if _index is None or _index_pid != os.getpid():
+            name = re.sub(r"[^\w.-]", "_", VECTOR_INDEX_EMBEDDER)
+            _index = VectorIndex(os.path.join(VECTOR_INDEX_DIR, f"{name}-{VECTOR_INDEX_DIM}"))
+            _index_pid = os.getpid()
+            if VECTOR_INDEX_REUSE == "similar" and not similar_reuse():
+                log.warning("VECTOR_INDEX_REUSE=similar needs a semantic VECTOR_INDEX_EMBEDDER; "
+                            "only exact repeats of a prompt are reused")
+        return _index
+
+
+def _record(counter: str):
+    try:
+        get_redis_client().hincrby(STATS_KEY, counter, 1)
+    except Exception as e:
+        log.warning(f"Vector index stats update failed: {e}")
+
+
+def lookup_context(user_prompt: str, user_id: str | None = None) -> dict:
+    """
+    The user's past results for a retrieval prompt: {"reuse": hit} when an
+    answer can be reused (see VECTOR_INDEX_REUSE), else {"augment": [hits]}
+    with the rows (any kind) worth adding as context, else {}. Index errors
+    never fail the stage; they are logged and treated as a miss.
+    """
+    if not index_enabled():
+        return {}
+    try:
+        with span("index", "lookup") as fields:
+            index = get_index()
+            repeat = index.find_prompt(user_id, user_prompt) if VECTOR_INDEX_REUSE != "off" else None
+            hits = [] if repeat is not None else index.search(user_prompt, k=VECTOR_INDEX_TOP_K, user_id=user_id)
+            fields.update(hits=len(hits), best=round(hits[0]["similarity"], 3) if hits else None, repeat=repeat is not None)
+    except Exception as e:
+        log.warning(f"Vector index lookup failed: {e}")
+        return {}
+    prompts = [h for h in hits if h["kind"] == "prompt" and h["similarity"] >= VECTOR_INDEX_REUSE_THRESHOLD] \
+        if similar_reuse() else []
+    if repeat is not None or prompts:
+        outcome, found = "reused", {"reuse": repeat or prompts[0]}
+    else:
+        augment = [h for h in hits if h["similarity"] >= VECTOR_INDEX_AUGMENT_THRESHOLD]
+        outcome, found = ("augmented", {"augment": augment}) if augment else ("miss", {})
+    inc("tia_retrieval_reuse_total", outcome=outcome)
+    _record(outcome)
+    return found
+
+
+def augment_text(hits: list[dict]) -> str:
+    """Context block for the retrieval request, at most VECTOR_INDEX_CONTEXT_CHARS long."""
+    parts, left = [], VECTOR_INDEX_CONTEXT_CHARS
+    for hit in hits:
+        source = hit.get("url") or f"an earlier answer (prompt {hit.get('prompt_id')})"
+        part = f"From {source}:\n{hit['context']}"[:left]
+        parts.append(part)
+        left -= len(part)
+        if left <= 0:
+            break
+    return "\n\n".join(parts)
+
+
+def hit_refs(hits: list[dict]) -> list[dict]:
+    """What raw_data records about the entries used: where they came from and how similar they were."""
+    return [{k: hit[k] for k in ("kind", "prompt_id", "url", "similarity") if hit.get(k) is not None} for hit in hits]
+
+
+def index_retrieval(prompt_id: int, user_prompt: str, llm_response: str, user_id: str | None = None):
+    """Add a user's retrieval answer, keyed both by its prompt and by its own text."""
+    if not index_enabled() or not llm_response:
+        return
+    try:
+        added = get_index().add([
+            {"kind": "prompt", "text": user_prompt, "context": llm_response, "prompt_id": prompt_id,
+             "user_id": user_id, "prompt_hash": prompt_hash(user_prompt)},
+            {"kind": "raw_data", "text": llm_response, "context": llm_response, "prompt_id": prompt_id, "user_id": user_id},
+        ])
+        if added:
+            _record("inserts")
+    except Exception as e:
+        log.warning(f"Vector index insert failed for prompt_id {prompt_id}: {e}")
+
+
+def index_sources(prompt_id: int, urls: list[str], texts: list[str], user_id: str | None = None):
+    """Add a user's MCP source texts (error/skip placeholders and short texts are left out)."""
+    if not index_enabled():
+        return
+    entries = [
+        {"kind": "source", "text": text[:VECTOR_INDEX_CONTEXT_CHARS], "context": text, "prompt_id": prompt_id, "url": url,
+         "user_id": user_id}
+        for url, text in zip(urls, texts)
+        if len(text) >= VECTOR_INDEX_MIN_SOURCE_CHARS and not text.startswith(("[Error ", "[Skipped "))
+    ]
+    if not entries:
+        return
+    try:
+        if get_index().add(entries):
+            _record("inserts")
+    except Exception as e:
+        log.warning(f"Vector index insert failed for prompt_id {prompt_id}: {e}")
+
+
+def get_vector_index_stats() -> dict:
+    """Return lookups by outcome (reused/augmented/miss), reuse rate, inserts and this host's row count."""
+    stats = {}
+    try:
+        stats = {k.decode("utf-8"): int(v) for k, v in get_redis_client().hgetall(STATS_KEY).items()}
+    except Exception as e:
+        log.warning(f"Vector index stats unavailable: {e}")
+    lookups = sum(stats.get(k, 0) for k in ("reused", "augmented", "miss"))
+    stats["reuse_rate"] = stats.get("reused", 0) / lookups if lookups else 0.0
+    if index_enabled():
+        index = get_index()
+        with index._lock:
+            index._refresh()
+            stats["rows"] = len(index.rows)
+    return stats
+
+
+if __name__ == "__main__":
+    print(json.dumps(get_vector_index_stats(), indent=2))
@@ -0,0 +1,120 @@
+"""
+Retrieval + summary stages in prefork vs asyncio execution mode.
+
+    python -m benchmarks.bench_async_worker --prompts 200 --in-flight 32 --latency 300
+
+Each mode runs in a fresh child process with TASK_EXECUTION_MODE set, against
+the fake OpenAI and Supabase servers. prefork forks one process per in-flight
+prompt (like --concurrency on the prefork pool); asyncio runs that many
+threads in one process (like --pool=threads), all sharing the process event
+loop. Reports prompts/s and resident memory per in-flight prompt, summed over
+every process of the mode. Needs a Redis at REDIS_.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import psutil
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fake_supabase import FAKE_KEY, FakeSupabase
+
+
+def _run_prompts(prompt_ids: list[int], run_id: str):
+    from app.tasks import information_retrieval_task, process_and_summarize_task
+    for prompt_id in prompt_ids:
+        # Unique text per prompt so the LLM response cache never short-circuits a call.
+        retrieval = information_retrieval_task.apply(args=(prompt_id, f"{run_id} question {prompt_id}")).get()
+        summary = process_and_summarize_task.apply(args=(retrieval, 1)).get()
+        if summary.get("status") != "completed":
+            print(f"FAILED prompt {prompt_id}: {retrieval.get('status')} / {summary.get('status')}", file=sys.stderr)
+
+
+def _sample_rss(pids_fn, stop: threading.Event, peak: list):
+    while not stop.is_set():
+        total = 0
+        for pid in pids_fn():
+            try:
+                total += psutil.Process(pid).memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        peak[0] = max(peak[0], total)
+        time.sleep(0.05)
+
+
+def child(args):
+    """Runs in the benchmark subprocess, after TASK_EXECUTION_MODE is set in its environment."""
+    import app.tasks # noqa: F401 - import (and pay for) the app before forking, as the worker does
+    run_id = uuid.uuid4().hex[:8]
+    first_id = args.first_id
+    batches = [list(range(first_id + i, first_id + args.prompts, args.in_flight)) for i in range(args.in_flight)]
+    me = psutil.Process()
+    peak = [0]
+    stop = threading.Event()
+
+    if args.mode == "prefork":
+        ctx = multiprocessing.get_context("fork")
+        workers = [ctx.Process(target=_run_prompts, args=(batch, run_id)) for batch in batches]
+        sampler = threading.Thread(target=_sample_rss, args=(lambda: [me.pid] + [w.pid for w in workers if w.pid], stop, peak))
+        start = time.perf_counter()
+        sampler.start()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    else:
+        workers = [threading.Thread(target=_run_prompts, args=(batch, run_id)) for batch in batches]
+        sampler = threading.Thread(target=_sample_rss, args=(lambda: [me.pid], stop, peak))
+        start = time.perf_counter()
+        sampler.start()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+    print(json.dumps({"elapsed": elapsed, "peak_rss": peak[0]}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--in-flight", type=int, default=32, help="prefork processes / asyncio threads")
+    parser.add_argument("--latency", type=int, default=300, help="fake OpenAI latency per request in ms")
+    parser.add_argument("--db-latency", type=int, default=10, help="fake Supabase latency per request in ms")
+    parser.add_argument("--mode", choices=("prefork", "asyncio"), help=argparse.SUPPRESS)
+    parser.add_argument("--first-id", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        child(args)
+        return
+
+    with FakeOpenAI(latency_ms=args.latency) as fake_openai, FakeSupabase(latency_ms=args.db_latency) as fake_db:
+        for mode in ("prefork", "asyncio"):
+            # Fresh prompt ids per run, so stage idempotency keys left by an earlier run don't suppress work.
+            first_id = int(time.time() * 1000) % 10**9 * 1000
+            fake_db.insert("prompts", [{"id": first_id + i, "status": "pending_retrieval"} for i in range(args.prompts)])
+            env = dict(os.environ, TASK_EXECUTION_MODE=mode, RATE_LIMIT_ENABLED="false",
+                       OPENAI_API_KEY="test", OPENAI_BASE_URL=fake_openai.base_url,
+                       SUPABASE_URL=fake_db.url, SUPABASE_ANON_KEY=FAKE_KEY)
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_async_worker", "--mode", mode, "--prompts", str(args.prompts),
+                 "--in-flight", str(args.in_flight), "--first-id", str(first_id)],
+                env=env, capture_output=True, text=True, check=True,
+            )
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            failed = out.stderr.count("FAILED prompt")
+            print(f"{mode:>8}: {args.prompts / r['elapsed']:.1f} prompts/s, peak RSS {r['peak_rss'] / 2**20:.0f} MiB "
+                  f"({r['peak_rss'] / 2**20 / args.in_flight:.1f} MiB per in-flight prompt), {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Storage saved by the blob store: content-hash dedup plus compression of
+retrieval payloads and MCP source text, compared with keeping them inline.
+
+    python -m benchmarks.bench_blob_store --prompts 200 --pages 40
+    python -m benchmarks.bench_blob_store --store supabase --db-latency 20
+
+Each simulated prompt stores a retrieval payload (an LLM answer, often the same
+answer to a repeated question) and the extracted text of a few MCP sources
+picked from a pool of fixture pages, popular pages more often than others.
+--store local writes to a temporary BLOB_DIR; --store supabase uses the fake
+Supabase server. Needs a Redis at REDIS_ for the blob stats counters.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fake_supabase import FAKE_KEY, FakeSupabase
+from benchmarks.fixture_site import render_page
+
+STAT_COUNTERS = ("puts", "dedup_hits", "bytes_in", "bytes_new", "bytes_stored")
+
+
+def workload(prompts: int, pages: int, sources: int, seed: int) -> list[tuple[str, list[str]]]:
+    """(raw_data JSON, source page numbers) per prompt."""
+    rng = random.Random(seed)
+    weights = [1 / (n + 1) for n in range(pages)] # a few pages are cited far more than the rest
+    out = []
+    for i in range(prompts):
+        question = rng.randrange(max(1, prompts // 4))
+        answer = " ".join(f"Point {k} about question {question}: consider cost, time and risk." for k in range(40))
+        raw_data_json = json.dumps({"llm_response": answer})
+        out.append((raw_data_json, rng.choices(range(pages), weights=weights, k=sources)))
+    return out
+
+
+def run(args):
+    from app import blob_store # reads BLOB_* settings on import
+    from app.extractors import extract_text
+
+    page_text = {n: extract_text(render_page(n, paragraphs=40 + (n % 5) * 30)) for n in range(args.pages)}
+    prompts = workload(args.prompts, args.pages, args.sources, args.seed)
+
+    before = blob_store.get_blob_stats()
+    inline_bytes, refs = 0, []
+    start = time.perf_counter()
+    for raw_data_json, picked in prompts:
+        texts = [page_text[n] for n in picked]
+        inline_bytes += len(raw_data_json.encode("utf-8")) + sum(len(t.encode("utf-8")) for t in texts)
+        refs.append(blob_store.store_payload(raw_data_json))
+        refs.extend(s["ref"] for s in blob_store.store_sources([f"/page/{n}" for n in picked], texts))
+    put_s = time.perf_counter() - start
+
+    blob_store._known.clear() # read back cold, as another worker would
+    start = time.perf_counter()
+    fetched = blob_store.get_blobs(refs)
+    fetch_s = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = sum(len(blob.data) for blob in fetched.values())
+    decode_s = time.perf_counter() - start
+    assert len(fetched) == len(set(refs)), "some blobs were not found"
+
+    after = blob_store.get_blob_stats()
+    stats = {k: after.get(k, 0) - before.get(k, 0) for k in STAT_COUNTERS}
+    codec = "zstd" if blob_store.zstandard is not None else "zlib"
+    print(f"store={blob_store.BLOB_STORE} codec={codec} prompts={args.prompts} payloads={stats['puts']}")
+    print(f"  inline in results: {inline_bytes / 1024:.0f} KiB")
+    print(f"  unique content:    {stats['bytes_new'] / 1024:.0f} KiB ({stats['dedup_hits']} of {stats['puts']} payloads deduplicated)")
+    print(f"  stored:            {stats['bytes_stored'] / 1024:.0f} KiB "
+          f"(compression ratio {stats['bytes_new'] / max(1, stats['bytes_stored']):.1f}x)")
+    print(f"  saved:             {(1 - stats['bytes_stored'] / max(1, inline_bytes)) * 100:.1f}% of inline storage")
+    print(f"  put {put_s / stats['puts'] * 1000:.2f} ms/payload; fetch {len(fetched)} blobs {fetch_s * 1000:.0f} ms, "
+          f"decompress {decoded / 1024:.0f} KiB {decode_s * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=40, help="size of the fixture page pool")
+    parser.add_argument("--sources", type=int, default=3, help="MCP sources per prompt")
+    parser.add_argument("--store", choices=("local", "supabase"), default="local")
+    parser.add_argument("--db-latency", type=int, default=0, help="fake Supabase latency per request in ms")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.store == "local":
+        with tempfile.TemporaryDirectory() as blob_dir:
+            os.environ.update(BLOB_STORE="local", BLOB_DIR=blob_dir)
+            run(args)
+    else:
+        with FakeSupabase(latency_ms=args.db_latency) as fake_db:
+            os.environ.update(BLOB_STORE="supabase", SUPABASE_URL=fake_db.url, SUPABASE_ANON_KEY=FAKE_KEY)
+            run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Duplicate paragraph removal (app/dedup.py) on a synthetic MCP source set:
+original articles, exact mirrors, syndicated copies with small edits, and
+pages from the same sites sharing navigation and footer text.
+
+    python -m benchmarks.bench_dedup
+    python -m benchmarks.bench_dedup --articles 40 --scales 1,2,4,8
+    python -m benchmarks.bench_dedup --edit-fraction 0.5     # share of syndicated paragraphs with a changed word
+
+Prints paragraphs and exact/near duplicates removed, tokens before and after,
+time and throughput per scale (it should grow linearly with the input), and
+precision/recall of the removals against the corpus' ground truth.
+"""
+import argparse
+import random
+import time
+
+from app import dedup
+from app.summarizer import count_tokens
+
+WORDS = [f"w{i}" for i in range(5000)]
+SITES = 8
+
+
+def paragraph(rng: random.Random) -> list[str]:
+    return rng.choices(WORDS, k=rng.randint(25, 80))
+
+
+def corpus(articles: int, edit_fraction: float, seed: int) -> tuple[list[str], list[str], list[list[bool]]]:
+    """(urls, texts, per-source flags: is line i a copy of an earlier line)."""
+    rng = random.Random(seed)
+    boilerplate = {site: [" ".join(paragraph(rng)[:rng.randint(6, 15)]) for _ in range(4)] for site in range(SITES)}
+    urls, texts, truth = [], [], []
+    seen = set()
+
+    def add(url: str, site: int, lines: list[tuple[str, object]]):
+        """lines: (text, origin); a line whose origin was already seen is a true duplicate."""
+        header, footer = boilerplate[site][:2], boilerplate[site][2:]
+        labelled = [(line, ("site", site, i)) for i, line in enumerate(header)] + lines \
+            + [(line, ("site", site, i + 2)) for i, line in enumerate(footer)]
+        flags = []
+        for _, origin in labelled:
+            flags.append(origin in seen)
+            seen.add(origin)
+        urls.append(url)
+        texts.append("\n".join(line for line, _ in labelled))
+        truth.append(flags)
+
+    for a in range(articles):
+        body = [(paragraph(rng), (a, p)) for p in range(rng.randint(6, 14))]
+        site = rng.randrange(SITES)
+        add(f"https://site{site}.example/a/{a}", site, [(" ".join(words), origin) for words, origin in body])
+        kind = rng.random()
+        if kind < 0.25: # exact mirror on another site
+            mirror = rng.randrange(SITES)
+            add(f"https://mirror{mirror}.example/a/{a}", mirror, [(" ".join(words), origin) for words, origin in body])
+        elif kind < 0.6: # syndicated copy: one word changed in some paragraphs, some paragraphs cut
+            copy = rng.randrange(SITES)
+            lines = []
+            for words, origin in body:
+                if rng.random() < 0.15:
+                    continue
+                words = list(words)
+                if rng.random() < edit_fraction:
+                    words[rng.randrange(len(words))] = rng.choice(WORDS)
+                lines.append((" ".join(words), origin))
+            add(f"https://syndicated{copy}.example/a/{a}", copy, lines)
+    return urls, texts, truth
+
+
+def score(texts: list[str], output: list[str], truth: list[list[bool]]) -> tuple[int, int, int]:
+    """(true positives, false positives, false negatives) of the removals."""
+    tp = fp = fn = 0
+    for text, kept_text, flags in zip(texts, output, truth):
+        kept = set(kept_text.split("\n"))
+        for line, duplicate in zip(text.split("\n"), flags):
+            removed = line not in kept
+            tp += removed and duplicate
+            fp += removed and not duplicate
+            fn += duplicate and not removed
+    return tp, fp, fn
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--articles", type=int, default=20, help="original articles at scale 1")
+    parser.add_argument("--scales", default="1,2,4,8", help="comma-separated corpus size multipliers")
+    parser.add_argument("--edit-fraction", type=float, default=0.3, help="share of syndicated paragraphs with one word changed")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scale (best time reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if dedup.np is None:
+        print("numpy is not installed: only exact duplicates are removed")
+    print(f"{'scale':>5} {'sources':>8} {'paras':>7} {'exact':>6} {'near':>6} {'tokens in':>10} {'tokens out':>11} "
+          f"{'ms':>8} {'MB/s':>7} {'us/para':>8} {'precision':>10} {'recall':>7}")
+    for scale in (int(s) for s in args.scales.split(",")):
+        urls, texts, truth = corpus(args.articles * scale, args.edit_fraction, args.seed)
+        size = sum(len(t) for t in texts)
+        best = None
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            output, stats = dedup.dedup_sources(urls, texts)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        tokens_in = count_tokens("\n".join(texts))
+        tp, fp, fn = score(texts, output, truth)
+        print(f"{scale:>5} {len(texts):>8} {stats['paragraphs']:>7} {stats['exact_removed']:>6} {stats['near_removed']:>6} "
+              f"{tokens_in:>10} {tokens_in - stats['tokens_removed']:>11} {best * 1000:>8.1f} {size / best / 1e6:>7.2f} "
+              f"{best * 1e6 / max(stats['paragraphs'], 1):>8.1f} {tp / max(tp + fp, 1):>10.3f} {tp / max(tp + fn, 1):>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
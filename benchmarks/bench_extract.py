@@ -0,0 +1,73 @@
+"""
+Compare HTML text extraction backends on a corpus of saved pages.
+
+    python -m benchmarks.bench_extract --corpus path/to/saved_pages --repeat 3
+
+Every *.html / *.htm file under --corpus is used; without --corpus a synthetic
+corpus from benchmarks.fixture_site is generated. Reports throughput, peak
+Python heap (tracemalloc) and output characters per backend and mode.
+"""
+import argparse
+import pathlib
+import time
+import tracemalloc
+
+from app.extractors import AVAILABLE_EXTRACTORS, EXTRACTORS
+from benchmarks.fixture_site import render_page
+
+
+def load_corpus(path: str | None) -> list[bytes]:
+    if path is None:
+        return [render_page(i, paragraphs=50 + (i % 10) * 40) for i in range(50)]
+    files = sorted(p for p in pathlib.Path(path).rglob("*") if p.suffix.lower() in (".html", ".htm"))
+    return [f.read_bytes() for f in files]
+
+
+def run(engine: str, main_content: bool, corpus: list[bytes], repeat: int) -> dict:
+    extractor = EXTRACTORS[engine]
+    output_chars = sum(len(extractor(page, main_content)) for page in corpus)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in corpus:
+            extractor(page, main_content)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for page in corpus:
+        extractor(page, main_content)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pages = len(corpus) * repeat
+    input_mb = sum(len(p) for p in corpus) * repeat / 1e6
+    return {
+        "pages_per_s": pages / elapsed,
+        "mb_per_s": input_mb / elapsed,
+        "peak_mb": peak / 1e6,
+        "output_chars": output_chars,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="directory of saved .html pages")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not corpus:
+        raise SystemExit(f"No .html files found under {args.corpus}")
+    print(f"{len(corpus)} pages, {sum(len(p) for p in corpus) / 1e6:.2f} MB")
+    print(f"{'engine':<12}{'main':<6}{'pages/s':>10}{'MB/s':>8}{'peak MB':>9}{'chars':>11}")
+    for engine in EXTRACTORS:
+        if not AVAILABLE_EXTRACTORS.get(engine):
+            print(f"{engine:<12}(not installed)")
+            continue
+        for main_content in (False, True):
+            r = run(engine, main_content, corpus, args.repeat)
+            print(f"{engine:<12}{str(main_content):<6}{r['pages_per_s']:>10.1f}{r['mb_per_s']:>8.2f}{r['peak_mb']:>9.2f}{r['output_chars']:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Tail latency of light users while a heavy user floods the pipeline, with
+prompts sent straight to the broker (before: FIFO within each priority) and
+with fair-share dispatch (after, app/fair_share.py).
+
+    python -m benchmarks.bench_fair_share
+    python -m benchmarks.bench_fair_share --heavy-prompts 1000 --heavy-urls 10 --workers 16
+    python -m benchmarks.bench_fair_share --heavy-priority bulk     # the heavy user submits a batch
+    python -m benchmarks.bench_fair_share --heavy-weight 4          # FAIR_SHARE_WEIGHTS for the heavy user
+    python -m benchmarks.bench_fair_share --ui --workers 16 --user-concurrency 8  # all from the web UI, without sign-in
+
+A discrete-event simulation: workers, the broker and pipeline run times
+(--base-seconds plus --url-seconds per MCP URL) are simulated, and the
+scheduler is the real one, its Redis scripts run against REDIS_ under a
+throwaway key prefix. The heavy user submits all its prompts at once; each
+light user submits one prompt without URLs every --light-interval seconds on
+average. With --ui, everything comes from the web UI, which has no sign-in:
+the heavy user's prompts are a bulk batch and the light users' prompts are
+interactive, all without a user. Prints per-user latency percentiles and the
+heavy user's makespan.
+"""
+import argparse
+import heapq
+import random
+import uuid
+from collections import deque
+
+from app import fair_share
+from app.queues import PRIORITIES
+from app.utils import get_redis_client
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+
+    def pick(p: float) -> float:
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99), "max": samples[-1]}
+
+
+def workload(args) -> list[tuple[float, dict]]:
+    """
+    (submit time, pipeline) for the heavy user's burst and the light users'
+    steady trickle. "group" names the simulated user; "user" is what the
+    scheduler sees (None for --ui).
+    """
+    rng = random.Random(args.seed)
+    heavy = {"user": None, "priority": "bulk", "batch_id": "ui"} if args.ui else {"user": "heavy", "priority": args.heavy_priority}
+    arrivals = [(0.0, {**heavy, "group": "heavy", "urls": ["u"] * args.heavy_urls})
+                for _ in range(args.heavy_prompts)]
+    for light in range(args.light_users):
+        t = rng.uniform(0, args.light_interval)
+        while t < args.duration:
+            arrivals.append((t, {"user": None if args.ui else f"light{light}", "group": f"light{light}",
+                                 "urls": [], "priority": "interactive"}))
+            t += rng.expovariate(1 / args.light_interval)
+    arrivals.sort(key=lambda a: a[0])
+    for prompt_id, (_, item) in enumerate(arrivals):
+        item.update(prompt_id=prompt_id, prompt="p", agent_id=1, task_id=str(prompt_id))
+    return arrivals
+
+
+def use_prefix(prefix: str):
+    fair_share.PREFIX = prefix
+    fair_share.ACTIVE_KEY = prefix + "active"
+    fair_share.RUNNING_KEY = prefix + "running"
+    fair_share.USER_RUNNING_KEY = prefix + "user_running"
+    fair_share.OWNERS_KEY = prefix + "owners"
+    fair_share.DEFICIT_KEY = prefix + "deficit"
+
+
+def simulate(mode: str, args, arrivals: list[tuple[float, dict]]) -> dict[str, list[float]]:
+    """Latency (submit to finish, simulated seconds) of every pipeline, by simulated user."""
+    rng = random.Random(args.seed + 1)
+    broker = {priority: deque() for priority in sorted(PRIORITIES, key=PRIORITIES.get)}
+    events = [(t, i, "submit", item) for i, (t, item) in enumerate(arrivals)]
+    heapq.heapify(events)
+    seq = len(events)
+    free_workers = args.workers
+    submitted, latencies = {}, {}
+    r = get_redis_client()
+    finish = r.register_script(fair_share._FINISH_SCRIPT)
+
+    def to_broker(items):
+        for item in items:
+            broker[item["priority"]].append(item)
+
+    while events:
+        now, _, kind, item = heapq.heappop(events)
+        if kind == "submit":
+            submitted[item["prompt_id"]] = now
+            if mode == "fifo":
+                to_broker([item])
+            else:
+                fair_share.enqueue([item])
+                to_broker(fair_share.release())
+        else:
+            free_workers += 1
+            latencies.setdefault(item["group"], []).append(now - submitted[item["prompt_id"]])
+            if mode == "fair":
+                finish(keys=[fair_share.RUNNING_KEY, fair_share.USER_RUNNING_KEY, fair_share.OWNERS_KEY],
+                       args=[item["prompt_id"]])
+                to_broker(fair_share.release())
+        # Idle workers take the next message: lowest priority number first, FIFO within it.
+        while free_workers:
+            queue = next((q for q in broker.values() if q), None)
+            if queue is None:
+                break
+            started = queue.popleft()
+            free_workers -= 1
+            run_time = (args.base_seconds + args.url_seconds * len(started["urls"])) * rng.uniform(0.8, 1.2)
+            seq += 1
+            heapq.heappush(events, (now + run_time, seq, "finish", started))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=8, help="pipelines processed at once")
+    parser.add_argument("--heavy-prompts", type=int, default=400)
+    parser.add_argument("--heavy-urls", type=int, default=5, help="MCP URLs per heavy prompt")
+    parser.add_argument("--heavy-priority", choices=list(PRIORITIES), default="interactive")
+    parser.add_argument("--heavy-weight", type=float, default=1.0)
+    parser.add_argument("--ui", action="store_true",
+                        help="no sign-in: the heavy user is a bulk batch and the light users interactive prompts from the web UI")
+    parser.add_argument("--light-users", type=int, default=10)
+    parser.add_argument("--light-interval", type=float, default=20, help="mean seconds between a light user's prompts")
+    parser.add_argument("--duration", type=float, default=600, help="seconds light users keep submitting")
+    parser.add_argument("--base-seconds", type=float, default=2.0, help="pipeline run time without URLs")
+    parser.add_argument("--url-seconds", type=float, default=1.0, help="extra run time per MCP URL")
+    parser.add_argument("--max-in-flight", type=int, help="FAIR_SHARE_MAX_IN_FLIGHT (default: --workers)")
+    parser.add_argument("--user-concurrency", type=int, help="FAIR_SHARE_USER_CONCURRENCY (default: --workers)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fair_share.FAIR_SHARE_MAX_IN_FLIGHT = args.max_in_flight or args.workers
+    fair_share.FAIR_SHARE_USER_CONCURRENCY = args.user_concurrency or args.workers
+    fair_share.FAIR_SHARE_WEIGHTS = {fair_share.ANONYMOUS_BATCH_USER if args.ui else "heavy": args.heavy_weight}
+    prefix = f"tia:fair:bench-{uuid.uuid4().hex[:8]}:"
+    use_prefix(prefix)
+    arrivals = workload(args)
+    light_count = sum(1 for _, item in arrivals if item["group"] != "heavy")
+    heavy_priority = "bulk" if args.ui else args.heavy_priority
+    print(f"{args.workers} workers; heavy user: {args.heavy_prompts} {heavy_priority} prompts with {args.heavy_urls} URLs "
+          f"at t=0; {args.light_users} light users: {light_count} interactive prompts over {args.duration:g}s"
+          + (" (all from the web UI, without sign-in)" if args.ui else ""))
+    try:
+        for mode in ("fifo", "fair"):
+            latencies = simulate(mode, args, arrivals)
+            light = [x for user, samples in latencies.items() if user != "heavy" for x in samples]
+            heavy = latencies.get("heavy", [])
+            p, h = percentiles(light), percentiles(heavy)
+            print(f"{mode:>5}: light p50 {p['p50']:>7.1f}s  p95 {p['p95']:>7.1f}s  p99 {p['p99']:>7.1f}s  max {p['max']:>7.1f}s"
+                  f"   heavy p50 {h['p50']:>7.1f}s  makespan {h['max']:>7.1f}s")
+    finally:
+        r = get_redis_client()
+        keys = list(r.scan_iter(prefix + "*"))
+        if keys:
+            r.delete(*keys)
+
+
+if __name__ == "__main__":
+    main()
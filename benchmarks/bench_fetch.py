@@ -0,0 +1,52 @@
+"""
+Compare sequential requests.get fetching (the old mcp_task loop) with app.fetcher.fetch_urls.
+
+    python -m benchmarks.bench_fetch --urls 20 --delay 200
+"""
+import argparse
+import time
+
+import requests
+
+from app.fetcher import fetch_urls
+from benchmarks.fixture_site import FixtureSite
+
+
+def sequential(urls: list[str]) -> list[str]:
+    out = []
+    for url in urls:
+        try:
+            response = requests.get(url, timeout=10)
+            response.raise_for_status()
+            out.append(response.text)
+        except requests.exceptions.RequestException as e:
+            out.append(f"[Error fetching content from {url}: {str(e)}]")
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urls", type=int, default=20)
+    parser.add_argument("--delay", type=int, default=200, help="per-page server latency in ms")
+    args = parser.parse_args()
+
+    with FixtureSite() as site:
+        urls = [site.url(f"/page/{i}?delay={args.delay}") for i in range(args.urls)]
+        urls.append(site.url("/status/500"))
+
+        start = time.perf_counter()
+        sequential(urls)
+        seq_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = fetch_urls(urls)
+        conc_elapsed = time.perf_counter() - start
+
+        assert [r["url"] for r in results] == urls, "results out of input order"
+        errors = sum(1 for r in results if r["error"])
+        print(f"sequential: {seq_elapsed:.2f}s")
+        print(f"concurrent: {conc_elapsed:.2f}s ({errors} error result(s), speedup {seq_elapsed / conc_elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Peak memory of one mcp_task's downloads: whole-body fetching (the old
+response.content + extract_text path) vs. streaming with FETCH_MAX_BYTES and
+content-type sniffing (fetch_urls with a StreamingExtractor).
+
+    python -m benchmarks.bench_fetch_limits --large 4 --size-mb 100
+    python -m benchmarks.bench_fetch_limits --max-bytes 524288
+
+Each mode runs in a fresh subprocess so its peak RSS (ru_maxrss) is its own.
+The URL set mixes normal article pages, --large oversized pages and a few
+binary downloads (one served with a misleading text/html type).
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fixture_site import FixtureSite
+
+
+def buffered(urls: list[str], max_bytes: int) -> list[str]:
+    import requests
+    from app.extractors import extract_text
+
+    def fetch(url):
+        try:
+            response = requests.get(url, timeout=60)
+            response.raise_for_status()
+            return extract_text(response.content)
+        except Exception as e:
+            return f"[Error processing content from {url}: {e}]"
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        return list(pool.map(fetch, urls))
+
+
+def streaming(urls: list[str], max_bytes: int) -> list[str]:
+    from app.extractors import StreamingExtractor
+    from app.fetcher import fetch_urls
+    results = fetch_urls(urls, deadline=120, parser_factory=StreamingExtractor, max_bytes=max_bytes)
+    return [r["text"] or f"[{r['skipped'] or r['error']}]" for r in results]
+
+
+MODES = {"buffered": buffered, "streaming": streaming}
+
+
+def run_mode(mode: str, urls: list[str], max_bytes: int):
+    """Child process: fetch and extract every URL, print timings and peak RSS as JSON."""
+    start = time.perf_counter()
+    texts = MODES[mode](urls, max_bytes)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "elapsed_s": round(elapsed, 2),
+        "peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "chars": sum(len(t) for t in texts),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=10, help="normal article pages")
+    parser.add_argument("--large", type=int, default=3, help="oversized pages")
+    parser.add_argument("--size-mb", type=int, default=100, help="size of each oversized page")
+    parser.add_argument("--max-bytes", type=int, default=2 * 1024 * 1024, help="FETCH_MAX_BYTES for the streaming mode")
+    parser.add_argument("--run-mode", choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument("--urls-json", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        run_mode(args.run_mode, json.loads(args.urls_json), args.max_bytes)
+        return
+
+    with FixtureSite() as site:
+        urls = [site.url(f"/page/{n}?size=60") for n in range(args.pages)]
+        urls += [site.url(f"/large?size={args.size_mb * 1024 * 1024}&n={n}") for n in range(args.large)]
+        urls += [site.url("/binary/pdf"), site.url("/binary/pdf?type=text/html"), site.url("/binary/zip")]
+        print(f"{len(urls)} URLs: {args.pages} pages, {args.large} x {args.size_mb} MiB pages, 3 binary files")
+        for mode in MODES:
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_fetch_limits", "--run-mode", mode,
+                 "--urls-json", json.dumps(urls), "--max-bytes", str(args.max_bytes)],
+                capture_output=True, text=True, check=True,
+            ).stdout.strip().splitlines()[-1]
+            stats = json.loads(out)
+            print(f"  {mode:<10} {stats['elapsed_s']:>7.2f}s  peak RSS {stats['peak_rss_mib']:>8.1f} MiB  "
+                  f"{stats['chars']} chars extracted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Cold-start cost of each tier: import time, peak RSS and modules loaded by the
+web entry point (app/app.py) and the worker entry point (app.tasks, which
+`celery -A app.celery_app worker` loads).
+
+    python -m benchmarks.bench_imports
+    python -m benchmarks.bench_imports --repeat 10 --check     # exit status 1 if the web tier loads worker-only modules
+    python -m benchmarks.bench_imports --with-reflex            # import app.app itself, Reflex included
+
+Each import runs in a fresh interpreter. Without --with-reflex the web entry
+point is the app modules app/app.py imports, so the numbers don't depend on
+Reflex (which dominates its own import time).
+"""
+import argparse
+import ast
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules only the worker needs; the web tier must not load them.
+WORKER_ONLY = ("openai", "bs4", "lxml", "selectolax", "requests", "tiktoken", "app.tasks", "app.fetcher",
+               "app.extractors", "app.summarizer", "app.rate_limit", "app.llm_cache", "app.resilience", "app.dedup",
+               "app.vector_index", "celery.worker.autoscale")
+
+CHILD = """
+import json, resource, sys, time
+started = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "modules": sorted(sys.modules)}))
+"""
+
+
+def web_modules() -> list[str]:
+    """Package modules app/app.py imports (relative or app.*), in import order."""
+    path = os.path.join(os.path.dirname(__file__), "..", "app", "app.py")
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and (node.level == 1 or (node.module or "").startswith("app.")):
+            name = f"app.{node.module}" if node.level == 1 else node.module
+            if name not in modules:
+                modules.append(name)
+    return modules
+
+
+def measure(modules: list[str], repeat: int) -> dict:
+    env = dict(os.environ, LOG_LEVEL="ERROR", METRICS_ENABLED="false")
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", CHILD, *modules], capture_output=True, text=True, env=env, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    loaded = set(runs[-1]["modules"])
+    return {
+        "seconds": statistics.median(r["seconds"] for r in runs),
+        "rss_mib": statistics.median(r["rss_mib"] for r in runs),
+        "module_count": len(loaded),
+        "worker_only": [m for m in WORKER_ONLY if m in loaded],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per entry point (median reported)")
+    parser.add_argument("--with-reflex", action="store_true", help="import app.app itself for the web tier")
+    parser.add_argument("--check", action="store_true", help="fail if the web tier loads worker-only modules")
+    args = parser.parse_args()
+
+    entry_points = {
+        "web": ["app.app"] if args.with_reflex else web_modules(),
+        "worker": ["app.celery_app", "app.tasks"],
+    }
+    baseline = measure([], args.repeat)
+    print(f"interpreter alone: {baseline['seconds'] * 1000:.0f} ms, {baseline['rss_mib']:.1f} MiB, {baseline['module_count']} modules")
+    results = {}
+    for tier, modules in entry_points.items():
+        results[tier] = stats = measure(modules, args.repeat)
+        print(f"{tier:<7} import {stats['seconds'] * 1000:>6.0f} ms  peak RSS {stats['rss_mib']:>6.1f} MiB  "
+              f"{stats['module_count']:>5} modules  ({', '.join(modules)})")
+        if stats["worker_only"]:
+            print(f"        worker-only modules loaded: {', '.join(stats['worker_only'])}")
+
+    if args.check and results["web"]["worker_only"]:
+        raise SystemExit("The web tier imports worker-only modules")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+LLM call latency against a fake API that injects slow responses and outages,
+with plain rate-limited calls (before) and guarded calls with stage deadlines,
+hedging and the circuit breaker (after, app/resilience.py).
+
+    python -m benchmarks.bench_llm_tail
+    python -m benchmarks.bench_llm_tail --calls 600 --slow-fraction 0.03 --slow-latency 8000
+    python -m benchmarks.bench_llm_tail --fallback-latency 300     # hedge to a fallback model
+    python -m benchmarks.bench_llm_tail --scenario outage          # every request fails with a 503
+
+The "tail" scenario prints a latency histogram and p50/p95/p99 per mode,
+plus the extra upstream requests hedging cost. The "outage" scenario shows
+how long callers wait to learn the upstream is down, and how many requests
+still reach it. Threads stand in for worker processes. Needs a Redis at
+REDIS_ (rate limiter and breaker state; each run uses fresh model names).
+"""
+import argparse
+import threading
+import time
+import uuid
+
+from openai import OpenAI
+
+from app import rate_limit, resilience
+from app.instrumentation import reset_context, set_context
+from benchmarks.fake_openai import FakeOpenAI
+
+HISTOGRAM_MS = (250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pick(p: float) -> float:
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99), "max": samples[-1]}
+
+
+def run(mode: str, args, fake: FakeOpenAI, calls: int, warmup: int = 0) -> dict:
+    model = f"bench-{uuid.uuid4().hex[:8]}" # fresh limiter and breaker state per run
+    if args.fallback_latency is not None:
+        fallback = f"{model}-fallback"
+        resilience.FALLBACK_MODELS[model] = fallback
+        fake.model_latency_ms[fallback] = args.fallback_latency
+    call = resilience.guarded_chat_completion if mode == "guarded" else rate_limit.limited_chat_completion
+    client = OpenAI(base_url=fake.base_url, api_key="test", max_retries=0)
+    latencies, errors = [], {}
+    lock = threading.Lock()
+    counter = iter(range(warmup + calls))
+
+    def worker():
+        token = set_context(stage=args.stage)
+        try:
+            for i in counter:
+                messages = [{"role": "user", "content": f"call {i} " + "word " * 100}]
+                started = time.perf_counter()
+                try:
+                    call(client, model, messages, max_tokens=100)
+                    error = None
+                except Exception as e:
+                    error = type(e).__name__
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if i < warmup:
+                    continue
+                with lock:
+                    latencies.append(elapsed_ms)
+                    if error:
+                        errors[error] = errors.get(error, 0) + 1
+        finally:
+            reset_context(token)
+
+    requests_before = fake.request_count
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {"elapsed": time.perf_counter() - started, "latencies": latencies, "errors": errors,
+            "requests": fake.request_count - requests_before}
+
+
+def print_tail(results: dict[str, dict], calls: int, warmup: int):
+    header = "".join(f"{f'<={ms / 1000:g}s':>9}" for ms in HISTOGRAM_MS) + f"{'more':>9}"
+    print(f"{'':>9}{header}")
+    for mode, r in results.items():
+        counts = [sum(1 for x in r["latencies"] if lower < x <= upper)
+                  for lower, upper in zip((0,) + HISTOGRAM_MS, HISTOGRAM_MS)]
+        counts.append(sum(1 for x in r["latencies"] if x > HISTOGRAM_MS[-1]))
+        print(f"{mode:>9}" + "".join(f"{c:>9}" for c in counts))
+    print()
+    for mode, r in results.items():
+        p = percentiles(r["latencies"])
+        extra = r["requests"] / (calls + warmup) - 1
+        print(f"{mode:>9}: p50 {p['p50']:>7.0f} ms  p95 {p['p95']:>7.0f} ms  p99 {p['p99']:>7.0f} ms  max {p['max']:>7.0f} ms  "
+              f"{r['requests']} upstream requests (+{extra:.1%})  errors {r['errors'] or 0}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=["tail", "outage"], default="tail")
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--warmup", type=int, default=60, help="calls first, left out of the numbers (fills the hedge latency window)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=int, default=200, help="fake API latency per request in ms")
+    parser.add_argument("--slow-fraction", type=float, default=0.03, help="share of requests that are slow")
+    parser.add_argument("--slow-latency", type=int, default=6000, help="latency of a slow request in ms")
+    parser.add_argument("--fallback-latency", type=int, help="configure a fallback model with this latency in ms")
+    parser.add_argument("--stage", default="summary", help="stage whose deadline applies")
+    parser.add_argument("--deadline", type=float, default=20, help="stage deadline in seconds for the guarded calls")
+    parser.add_argument("--backoff", type=float, default=0.2, help="rate limiter backoff base in seconds (both modes)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    resilience.STAGE_DEADLINES[args.stage] = args.deadline
+    rate_limit.RATE_LIMIT_BACKOFF_BASE = args.backoff
+    results = {}
+    if args.scenario == "tail":
+        for mode in ("plain", "guarded"):
+            with FakeOpenAI(latency_ms=args.latency, slow_fraction=args.slow_fraction, slow_latency_ms=args.slow_latency,
+                            seed=args.seed) as fake:
+                results[mode] = run(mode, args, fake, args.calls, args.warmup)
+        print(f"{args.calls} calls, {args.concurrency} at a time: {args.latency} ms latency, "
+              f"{args.slow_fraction:.0%} of requests take {args.slow_latency} ms")
+        print_tail(results, args.calls, args.warmup)
+        return
+
+    for mode in ("plain", "guarded"):
+        with FakeOpenAI(latency_ms=args.latency, fail_fraction=1.0, seed=args.seed) as fake:
+            results[mode] = run(mode, args, fake, args.calls)
+    print(f"outage: {args.calls} calls, {args.concurrency} at a time, every request answers 503 after {args.latency} ms")
+    for mode, r in results.items():
+        p = percentiles(r["latencies"])
+        print(f"{mode:>9}: time to fail p50 {p['p50']:>7.0f} ms  p99 {p['p99']:>7.0f} ms  "
+              f"{r['requests']} requests reached the upstream  {r['elapsed']:.1f}s total  errors {r['errors']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+End-to-end load test of the prompt pipeline through a real Celery worker.
+
+    python -m benchmarks.bench_pipeline --prompts 200 --concurrency 16 --llm-latency 300
+    python -m benchmarks.bench_pipeline --output baseline.json
+    python -m benchmarks.bench_pipeline --baseline baseline.json     # exit status 1 on a regression
+
+Prompts are submitted the way State.handle_submit does it: insert a 'prompts'
+row, then start_pipeline(). --concurrency prompts are kept in flight (closed
+loop). A worker subprocess (--mode prefork|asyncio) runs the real tasks
+against local stand-ins:
+  - benchmarks.fake_openai: latency, plus optional 429 throttling via
+    --llm-rpm / --llm-max-concurrency
+  - benchmarks.fake_supabase: the default; alternatively a local PostgREST
+    (--supabase-url / --supabase-key) with the schema and migrations applied
+  - benchmarks.fixture_site: pages for MCP source URLs
+
+Reported:
+  - throughput
+  - end-to-end and per-stage p50/p95/p99 latency
+  - mean queue wait per queue
+  - database round trips and LLM calls/tokens per prompt, from the worker
+    metrics (app/instrumentation.py)
+  - worker peak RSS
+
+Each run uses fresh prompt ids, prompt texts and page URLs, so caches and
+idempotency keys from earlier runs don't make it faster. The first --warmup
+prompts are excluded from the numbers. Needs a Redis at REDIS_; use a
+scratch database, since the run leaves keys behind.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import psutil
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fake_supabase import FAKE_KEY, FakeSupabase
+from benchmarks.fixture_site import FixtureSite
+
+QUESTIONS = [
+    "Should we migrate our monolith to microservices this year?",
+    "Is it better to lease or buy delivery vans for a small bakery?",
+    "Which database should a two-person startup pick for analytics?",
+    "Should I accept a remote job offer with a 10% pay cut?",
+    "What are the pros and cons of learning Python vs. JavaScript for web development?",
+    "Is solar worth installing on a house we plan to sell in five years?",
+    "Should our team adopt trunk-based development?",
+    "Which is the better first hire: a designer or a second engineer?",
+]
+STAGES = ("retrieval", "summary", "mcp")
+# Report fields checked against --baseline, and which direction is better.
+METRICS_COMPARED = {
+    "throughput": "higher",
+    "latency_ms.p95": "lower",
+    "db_requests_per_prompt": "lower",
+    "peak_rss_mib": "lower",
+}
+
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def pick(p: float) -> float:
+        return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))], 1)
+
+    return {"count": len(samples), "p50": pick(50), "p95": pick(95), "p99": pick(99), "max": round(samples[-1], 1)}
+
+
+def workload(args, run_id: str, site: FixtureSite) -> list[tuple[str, list[str]]]:
+    """(prompt text, MCP source URLs) per prompt, the same for every run with the same --seed."""
+    rng = random.Random(args.seed)
+    prompts = []
+    for i in range(args.warmup + args.prompts):
+        urls = []
+        if rng.random() < args.mcp_share:
+            pages = rng.sample(range(args.pages), min(args.urls, args.pages))
+            urls = [site.url(f"/page/{n}?delay={args.page_delay}&run={run_id}") for n in pages]
+        prompts.append((f"{rng.choice(QUESTIONS)} (load test {run_id} #{i})", urls))
+    return prompts
+
+
+def metric_totals() -> dict[str, float]:
+    from app.instrumentation import METRICS_KEY
+    from app.utils import get_redis_client
+    return {k.decode("utf-8"): float(v) for k, v in get_redis_client().hgetall(METRICS_KEY).items()}
+
+
+def metric_delta(before: dict, after: dict, name: str, **labels) -> float:
+    """Increase of every series of `name` whose labels include `labels`."""
+    wanted = [f'{k}="{v}"' for k, v in labels.items()]
+    return sum(value - before.get(series, 0.0) for series, value in after.items()
+               if series.split("{", 1)[0] == name and all(w in series for w in wanted))
+
+
+def start_worker(args, env: dict, log_file) -> subprocess.Popen:
+    from app.queues import QUEUES
+    cmd = [sys.executable, "-m", "celery", "-A", "app.celery_app", "worker", "--loglevel=warning",
+           f"--hostname=loadtest-{uuid.uuid4().hex[:6]}@%h", f"--concurrency={args.worker_concurrency}",
+           "-Q", ",".join(QUEUES), "--without-gossip", "--without-mingle"]
+    if args.mode == "asyncio":
+        cmd.append("--pool=threads")
+    return subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def wait_for_worker(worker: subprocess.Popen, timeout: float = 60):
+    from app.celery_app import celery_app
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if worker.poll() is not None:
+            raise SystemExit(f"Worker exited with status {worker.returncode} during startup")
+        if celery_app.control.ping(timeout=0.5):
+            return
+    raise SystemExit(f"Worker did not answer a ping within {timeout}s")
+
+
+def sample_rss(pid: int, stop: threading.Event, peak: list):
+    while not stop.is_set():
+        try:
+            root = psutil.Process(pid)
+            total = sum(p.memory_info().rss for p in [root] + root.children(recursive=True))
+            peak[0] = max(peak[0], total)
+        except psutil.NoSuchProcess:
+            pass
+        time.sleep(0.2)
+
+
+def submit_and_wait(prompt_text: str, urls: list[str], timeout: float) -> dict:
+    """One prompt as State.handle_submit submits it, then wait for the pipeline's final task."""
+    from app.pipeline import DEFAULT_AGENT_ID, start_pipeline
+    from app.utils import get_supabase_client
+    started = time.perf_counter()
+    response = get_supabase_client().table("prompts").insert({
+        "prompt_text": prompt_text, "status": "pending_retrieval", "created_at": datetime.now().isoformat(),
+    }).execute()
+    prompt_id = response.data[0]["id"]
+    result = start_pipeline(prompt_id, prompt_text, DEFAULT_AGENT_ID, urls)
+    # Poll instead of result.get(): the Redis result consumer isn't safe to share between threads.
+    deadline = time.monotonic() + timeout
+    while not result.ready():
+        if time.monotonic() > deadline:
+            return {"prompt_id": prompt_id, "status": "timeout", "latency_ms": None, "stage_timings_ms": {}}
+        time.sleep(0.02)
+    out = result.result if isinstance(result.result, dict) else {"prompt_status": f"failed: {result.result!r}"}
+    return {
+        "prompt_id": prompt_id,
+        "status": out.get("prompt_status"),
+        "mcp_status": out.get("mcp_status"),
+        "latency_ms": (time.perf_counter() - started) * 1000,
+        "stage_timings_ms": out.get("stage_timings_ms") or {},
+    }
+
+
+def run_load(args, prompts: list[tuple[str, list[str]]]) -> tuple[list[dict], float]:
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        if args.warmup:
+            list(pool.map(lambda p: submit_and_wait(*p, args.timeout), prompts[:args.warmup]))
+        start = time.perf_counter()
+        outcomes = list(pool.map(lambda p: submit_and_wait(*p, args.timeout), prompts[args.warmup:]))
+    return outcomes, time.perf_counter() - start
+
+
+def summarize(args, outcomes: list[dict], elapsed: float, before: dict, after: dict, peak_rss: int, fake_openai) -> dict:
+    ok = [o for o in outcomes if o["status"] == "completed" and o.get("mcp_status") in (None, "mcp_complete")]
+    n = len(outcomes)
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "tolerance")},
+        "prompts": n,
+        "failed": n - len(ok),
+        "elapsed_s": round(elapsed, 2),
+        "throughput": round(len(ok) / elapsed, 2),
+        "latency_ms": percentiles([o["latency_ms"] for o in ok]),
+        "stages_ms": {stage: percentiles([o["stage_timings_ms"][stage] for o in ok if stage in o["stage_timings_ms"]])
+                      for stage in STAGES},
+        "queue_wait_ms": {},
+        "db_requests_per_prompt": round(metric_delta(before, after, "tia_span_duration_seconds_count", kind="db") / max(1, n), 2),
+        "llm_calls_per_prompt": round(metric_delta(before, after, "tia_span_duration_seconds_count", kind="llm") / max(1, n), 2),
+        "llm_tokens_per_prompt": round(metric_delta(before, after, "tia_llm_tokens_total") / max(1, n), 1),
+        "llm_throttled": fake_openai.throttled_count,
+        "peak_rss_mib": round(peak_rss / 2**20, 1),
+    }
+    for stage in STAGES:
+        count = metric_delta(before, after, "tia_queue_wait_seconds_count", queue=stage)
+        if count:
+            report["queue_wait_ms"][stage] = round(metric_delta(before, after, "tia_queue_wait_seconds_sum", queue=stage) / count * 1000, 1)
+    return report
+
+
+def print_report(report: dict):
+    lat = report["latency_ms"]
+    print(f"{report['prompts']} prompts in {report['elapsed_s']}s: {report['throughput']} prompts/s, {report['failed']} failed")
+    if lat["count"]:
+        print(f"  end to end     p50 {lat['p50']:>8} ms  p95 {lat['p95']:>8} ms  p99 {lat['p99']:>8} ms")
+    for stage, p in report["stages_ms"].items():
+        if p["count"]:
+            wait = report["queue_wait_ms"].get(stage)
+            print(f"  {stage:<14} p50 {p['p50']:>8} ms  p95 {p['p95']:>8} ms  p99 {p['p99']:>8} ms"
+                  + (f"  (queue wait {wait} ms)" if wait is not None else ""))
+    print(f"  per prompt: {report['db_requests_per_prompt']} database requests, {report['llm_calls_per_prompt']} LLM calls, "
+          f"{report['llm_tokens_per_prompt']} tokens; {report['llm_throttled']} LLM requests throttled")
+    print(f"  worker peak RSS {report['peak_rss_mib']} MiB")
+
+
+def _lookup(report: dict, path: str):
+    value = report
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Metrics that got worse than the baseline by more than `tolerance` (relative)."""
+    if baseline.get("config") != report["config"]:
+        print("Warning: baseline was recorded with different settings; the comparison may not be meaningful.")
+    regressions = []
+    for path, better in METRICS_COMPARED.items():
+        current, previous = _lookup(report, path), _lookup(baseline, path)
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = change < -tolerance if better == "higher" else change > tolerance
+        print(f"  {path:<24} {previous:>10} -> {current:<10} ({change:+.1%}){'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(path)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=10, help="prompts run first and left out of the numbers")
+    parser.add_argument("--concurrency", type=int, default=16, help="prompts in flight")
+    parser.add_argument("--mode", choices=("prefork", "asyncio"), default="prefork", help="worker TASK_EXECUTION_MODE")
+    parser.add_argument("--worker-concurrency", type=int, default=8, help="worker processes (prefork) or threads (asyncio)")
+    parser.add_argument("--llm-latency", type=int, default=300, help="fake OpenAI latency per request in ms")
+    parser.add_argument("--llm-rpm", type=int, help="fake OpenAI requests per minute before 429s")
+    parser.add_argument("--llm-max-concurrency", type=int, help="fake OpenAI requests in flight before 429s")
+    parser.add_argument("--db-latency", type=int, default=10, help="fake Supabase latency per request in ms")
+    parser.add_argument("--supabase-url", help="use this (local) PostgREST/Supabase instead of the fake")
+    parser.add_argument("--supabase-key", help="key for --supabase-url")
+    parser.add_argument("--mcp-share", type=float, default=0.5, help="fraction of prompts with source URLs")
+    parser.add_argument("--urls", type=int, default=3, help="source URLs per MCP prompt")
+    parser.add_argument("--pages", type=int, default=20, help="fixture pages the URLs are drawn from")
+    parser.add_argument("--page-delay", type=int, default=100, help="fixture page latency in ms")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for one prompt")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report as JSON")
+    parser.add_argument("--baseline", help="compare with a report written by --output")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    run_id = uuid.uuid4().hex[:8]
+    with FakeOpenAI(latency_ms=args.llm_latency, rate_limit_requests=args.llm_rpm,
+                    max_concurrency=args.llm_max_concurrency) as fake_openai, \
+            FakeSupabase(latency_ms=args.db_latency) as fake_db, FixtureSite() as site:
+        # Fresh prompt ids (the fake numbers rows from 1), so no stage result from an earlier run is reused.
+        fake_db.next_id["prompts"] = int(time.time() * 1000) % 10**9 * 1000
+        env = dict(os.environ, OPENAI_API_KEY="test", OPENAI_BASE_URL=fake_openai.base_url, TASK_EXECUTION_MODE=args.mode,
+                   SUPABASE_URL=args.supabase_url or fake_db.url, SUPABASE_ANON_KEY=args.supabase_key or FAKE_KEY,
+                   WORKER_METRICS_PORT="0")
+        os.environ.update(env) # for the app modules imported below, in this process
+        prompts = workload(args, run_id, site)
+
+        with tempfile.NamedTemporaryFile("w+", prefix="loadtest-worker-", suffix=".log", delete=False) as log_file:
+            worker = start_worker(args, env, log_file)
+            try:
+                wait_for_worker(worker)
+                stop, peak = threading.Event(), [0]
+                sampler = threading.Thread(target=sample_rss, args=(worker.pid, stop, peak), daemon=True)
+                sampler.start()
+                before = metric_totals()
+                outcomes, elapsed = run_load(args, prompts)
+                time.sleep(0.5) # the last tasks' metrics are flushed right after they return
+                after = metric_totals()
+                stop.set()
+            finally:
+                worker.terminate()
+                worker.wait(timeout=60)
+
+        report = summarize(args, outcomes, elapsed, before, after, peak[0], fake_openai)
+        print_report(report)
+        if report["failed"]:
+            print(f"  worker log: {log_file.name}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(f"Regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Many workers calling a throttling fake API, with and without app.rate_limit.
+
+    python -m benchmarks.bench_rate_limit --workers 24 --calls 10 --rpm 240 --max-concurrency 6
+
+Worker threads stand in for Celery worker processes; they coordinate only
+through Redis, as separate processes would. Needs a Redis at REDIS_.
+"""
+import argparse
+import threading
+import time
+import uuid
+
+from openai import OpenAI
+
+from app import rate_limit
+from benchmarks.fake_openai import FakeOpenAI
+
+
+def run(mode: str, args) -> dict:
+    model = f"bench-{uuid.uuid4().hex[:8]}" # fresh buckets and AIMD state per run
+    rate_limit.MODEL_LIMITS[model] = (args.rpm, args.tpm)
+    results = {"ok": 0, "failed": 0}
+    lock = threading.Lock()
+
+    with FakeOpenAI(latency_ms=args.latency, rate_limit_requests=args.rpm, rate_limit_tokens=args.tpm,
+                    max_concurrency=args.max_concurrency) as fake:
+        client = OpenAI(base_url=fake.base_url, api_key="test")
+
+        def worker(i: int):
+            for j in range(args.calls):
+                messages = [{"role": "user", "content": f"worker {i} call {j} " + "word " * 200}]
+                try:
+                    if mode == "limited":
+                        rate_limit.limited_chat_completion(client, model, messages, max_tokens=100)
+                    else:
+                        client.chat.completions.create(model=model, messages=messages, max_tokens=100)
+                    outcome = "ok"
+                except Exception:
+                    outcome = "failed"
+                with lock:
+                    results[outcome] += 1
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        results.update(throttled=fake.throttled_count, peak_in_flight=fake.peak_in_flight, elapsed=elapsed)
+
+    stats = rate_limit.get_rate_limit_stats()
+    results["concurrency_limit"] = stats.get(f"{model}:concurrency_limit")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=24)
+    parser.add_argument("--calls", type=int, default=10, help="calls per worker")
+    parser.add_argument("--latency", type=int, default=200, help="fake API latency per request in ms")
+    parser.add_argument("--rpm", type=int, default=240, help="fake API (and limiter) requests per minute")
+    parser.add_argument("--tpm", type=int, default=200000, help="fake API (and limiter) tokens per minute")
+    parser.add_argument("--max-concurrency", type=int, default=6, help="fake API 429s above this many in flight")
+    args = parser.parse_args()
+
+    for mode in ("unlimited", "limited"):
+        r = run(mode, args)
+        print(f"{mode:>9}: {r['ok']} ok, {r['failed']} failed, {r['throttled']} 429s from the API, "
+              f"peak in flight {r['peak_in_flight']}, {r['ok'] / r['elapsed']:.1f} ok calls/s"
+              + (f", final AIMD limit {r['concurrency_limit']}" if r["concurrency_limit"] else ""))
+
+
+if __name__ == "__main__":
+    main()
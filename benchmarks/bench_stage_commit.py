@@ -0,0 +1,166 @@
+"""
+Supabase round trips per stage with the commit_stage() RPC vs separate REST calls,
+and a check of the database function itself against a local Postgres.
+
+    python -m benchmarks.bench_stage_commit --db-latency 20
+    python -m benchmarks.bench_stage_commit --postgres postgresql://postgres@localhost/scratch
+
+The first form runs retrieval, summary and a standalone MCP stage against the
+fake Supabase server (which emulates commit_stage()) with STAGE_COMMIT_RPC on
+and off, counting requests. Needs a Redis at REDIS_.
+
+The second applies supabase/migrations/*.sql to a scratch Postgres
+database (creating prompts/results if missing) and checks the compare-and-set
+and single-writer behaviour, including two connections racing the same
+transition. Needs psycopg. Rows it creates are deleted afterwards.
+"""
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fake_supabase import FAKE_KEY, FakeSupabase
+
+MIGRATIONS = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "..", "supabase", "migrations", "*.sql")))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS public.prompts (
+    id BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    prompt_text TEXT,
+    status TEXT,
+    created_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT now() NOT NULL
+);
+CREATE TABLE IF NOT EXISTS public.results (
+    id BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    prompt_id BIGINT NOT NULL,
+    raw_data JSONB,
+    processed_options JSONB,
+    summary TEXT,
+    mcp_data TEXT,
+    created_at TIMESTAMPTZ DEFAULT now() NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT now() NOT NULL
+);
+DO $$
+DECLARE r TEXT;
+BEGIN
+    FOREACH r IN ARRAY ARRAY['anon', 'authenticated', 'service_role'] LOOP
+        IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = r) THEN
+            EXECUTE format('CREATE ROLE %I NOLOGIN', r);
+        END IF;
+    END LOOP;
+END $$;
+"""
+
+
+def round_trips(args):
+    with FakeOpenAI(latency_ms=args.latency) as fake_openai, FakeSupabase(latency_ms=args.db_latency) as fake_db:
+        os.environ.update(OPENAI_API_KEY="test", OPENAI_BASE_URL=fake_openai.base_url, RATE_LIMIT_ENABLED="false",
+                          SUPABASE_URL=fake_db.url, SUPABASE_ANON_KEY=FAKE_KEY)
+        from app import utils # reads the settings above on import
+        from app.tasks import information_retrieval_task, mcp_task, process_and_summarize_task
+
+        for rpc in (False, True):
+            utils.STAGE_COMMIT_RPC = rpc
+            counts = {"retrieval": 0, "summary": 0, "mcp": 0}
+            elapsed = {"retrieval": 0.0, "summary": 0.0, "mcp": 0.0}
+            for i in range(args.prompts):
+                prompt_id = int(time.time() * 1000) % 10**9 * 1000 + i
+                fake_db.insert("prompts", [{"id": prompt_id, "status": "pending_retrieval"}])
+                for stage, run in (
+                    ("retrieval", lambda: information_retrieval_task.apply(args=(prompt_id, f"question {prompt_id}")).get()),
+                    ("summary", lambda: process_and_summarize_task.apply(args=(prompt_id, 1)).get()),
+                    ("mcp", lambda: mcp_task.apply(args=(prompt_id, [])).get()),
+                ):
+                    before, start = fake_db.request_count, time.perf_counter()
+                    output = run()
+                    assert not output.get("error"), output
+                    counts[stage] += fake_db.request_count - before
+                    elapsed[stage] += time.perf_counter() - start
+            label = "commit_stage RPC" if rpc else "separate REST calls"
+            print(f"{label:>19}: " + ", ".join(
+                f"{stage} {counts[stage] / args.prompts:.1f} requests / {elapsed[stage] / args.prompts * 1000:.0f} ms"
+                for stage in counts))
+
+
+def check_postgres(dsn: str):
+    try:
+        import psycopg
+    except ImportError:
+        raise SystemExit("The --postgres check needs psycopg: pip install 'psycopg[binary]'")
+
+    def commit(conn, prompt_id, status=None, from_statuses=None, result=None, new_result=False, result_id=None) -> dict:
+        row = conn.execute("SELECT public.commit_stage(%s, %s, %s, %s::jsonb, %s, %s)",
+                           (prompt_id, status, from_statuses, json.dumps(result) if result is not None else None,
+                            new_result, result_id)).fetchone()
+        return row[0]
+
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        conn.execute(SCHEMA)
+        for migration in MIGRATIONS:
+            with open(migration) as f:
+                conn.execute(f.read())
+        prompt_id = conn.execute("INSERT INTO public.prompts (prompt_text, status) VALUES ('check', 'processing_retrieval') RETURNING id").fetchone()[0]
+        try:
+            out = commit(conn, prompt_id, "completed", ["processing_summary"], {"summary": "too early"})
+            assert out["applied"] is False and out["reason"] == "status_conflict", out
+            assert conn.execute("SELECT count(*) FROM public.results WHERE prompt_id = %s", (prompt_id,)).fetchone()[0] == 0
+            print("refused transition writes nothing: ok")
+
+            # Two workers race the same transition: exactly one wins, one results row is created.
+            outcomes = []
+
+            def racer():
+                with psycopg.connect(dsn, autocommit=True) as c:
+                    outcomes.append(commit(c, prompt_id, "retrieval_complete", ["processing_retrieval"],
+                                           {"raw_data": json.dumps({"llm_response": "x"})}, new_result=True))
+            threads = [threading.Thread(target=racer) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert sum(o["applied"] for o in outcomes) == 1, outcomes
+            rows = conn.execute("SELECT id, raw_data FROM public.results WHERE prompt_id = %s", (prompt_id,)).fetchall()
+            assert len(rows) == 1, rows
+            result_id = rows[0][0]
+            status, current = conn.execute("SELECT status, current_result_id FROM public.prompts WHERE id = %s", (prompt_id,)).fetchone()
+            assert (status, current) == ("retrieval_complete", result_id), (status, current)
+            print("concurrent compare-and-set, one winner and one results row: ok")
+
+            commit(conn, prompt_id, "processing_summary", ["retrieval_complete"])
+            out = commit(conn, prompt_id, "completed", ["processing_summary"], {"summary": "done", "processed_options": "[]"})
+            assert out["applied"] and out["result_id"] == result_id, out
+            out = commit(conn, prompt_id, None, None, {"mcp_data": "quotes"})
+            assert out["applied"] and out["status"] == "completed", out
+            row = conn.execute("SELECT raw_data, summary, processed_options, mcp_data FROM public.results WHERE id = %s", (result_id,)).fetchone()
+            assert row[1:] == ("done", "[]", "quotes") and row[0] is not None, row
+            print("partial column updates on the current results row: ok")
+
+            out = commit(conn, prompt_id, "mcp_error", ["processing_mcp"])
+            assert out["applied"] is False and out["status"] == "completed", out
+            out = commit(conn, -1, "completed")
+            assert out["applied"] is False and out["reason"] == "prompt_not_found", out
+            print("error status can't overwrite a finished prompt; unknown prompt refused: ok")
+        finally:
+            conn.execute("DELETE FROM public.results WHERE prompt_id = %s", (prompt_id,))
+            conn.execute("DELETE FROM public.prompts WHERE id = %s", (prompt_id,))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=20)
+    parser.add_argument("--latency", type=int, default=0, help="fake OpenAI latency per request in ms")
+    parser.add_argument("--db-latency", type=int, default=20, help="fake Supabase latency per request in ms")
+    parser.add_argument("--postgres", metavar="DSN", help="check the database function against this scratch database instead")
+    args = parser.parse_args()
+    if args.postgres:
+        check_postgres(args.postgres)
+    else:
+        round_trips(args)
+
+
+if __name__ == "__main__":
+    main()
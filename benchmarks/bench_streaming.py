@@ -0,0 +1,62 @@
+"""
+Time-to-first-text of streamed vs. non-streamed completions against the fake API.
+
+    python -m benchmarks.bench_streaming --latency 200 --stream-delay 30
+
+The fake API takes the same time to generate either way (--latency, then
+--stream-delay per word), so a non-streamed reply shows its first text only
+when the whole reply is done. Streamed first text is timed as a reader sees it,
+through the Redis token stream. Needs a Redis at REDIS_.
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from openai import OpenAI
+
+from app.streaming import STREAM_PREFIX, streamed_chat_completion, subscribe_tokens
+from app.utils import get_redis_client
+from benchmarks.fake_openai import FakeOpenAI
+
+PROMPT_ID = -1 # stream key used only by this benchmark
+
+
+async def first_token_after(start: float) -> float:
+    async for _stage, text, _done in subscribe_tokens(PROMPT_ID, timeout=30):
+        if text:
+            return time.perf_counter() - start
+    return float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=int, default=200, help="fake API time before the first byte, ms")
+    parser.add_argument("--stream-delay", type=int, default=30, help="delay between streamed words, ms")
+    args = parser.parse_args()
+
+    messages = [{"role": "user", "content": "word " * 400}]
+    with FakeOpenAI(latency_ms=args.latency, stream_delay_ms=args.stream_delay) as fake:
+        client = OpenAI(base_url=fake.base_url, api_key="test")
+
+        start = time.perf_counter()
+        client.chat.completions.create(model="gpt-3.5-turbo", messages=messages, max_tokens=700)
+        blocking = time.perf_counter() - start
+
+        get_redis_client().delete(f"{STREAM_PREFIX}{PROMPT_ID}") # text left by an earlier run
+        start = time.perf_counter()
+        worker = threading.Thread(target=streamed_chat_completion,
+                                  args=(client, PROMPT_ID, "summary", "gpt-3.5-turbo", messages),
+                                  kwargs={"use_cache": False, "max_tokens": 700})
+        worker.start()
+        ttft = asyncio.run(first_token_after(start))
+        worker.join()
+        total = time.perf_counter() - start
+
+    print(f"non-streamed: first text after {blocking * 1000:.0f} ms, complete after {blocking * 1000:.0f} ms")
+    print(f"streamed:     first text after {ttft * 1000:.0f} ms, complete after {total * 1000:.0f} ms "
+          f"(first text {blocking / ttft:.1f}x sooner)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Exercise app.summarizer.summarize_sources against the local fake chat-completions server.
+
+    python -m benchmarks.bench_summarize --pages 40 --latency 300 --budget 60000
+"""
+import argparse
+import time
+
+from openai import OpenAI
+
+from app import summarizer
+from app.extractors import extract_text
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fixture_site import render_page
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=40, help="number of fixture pages in combined_text")
+    parser.add_argument("--latency", type=int, default=300, help="fake API latency per request in ms")
+    parser.add_argument("--budget", type=int, default=summarizer.SUMMARY_JOB_TOKEN_BUDGET)
+    parser.add_argument("--concurrency", type=int, default=summarizer.SUMMARY_CONCURRENCY)
+    args = parser.parse_args()
+
+    summarizer.SUMMARY_CONCURRENCY = args.concurrency
+    combined_text = "\n\n--- Next Source ---\n\n".join(
+        extract_text(render_page(i, paragraphs=120)) for i in range(args.pages)
+    )
+
+    with FakeOpenAI(latency_ms=args.latency) as fake:
+        client = OpenAI(base_url=fake.base_url, api_key="test")
+        start = time.perf_counter()
+        summary, stats = summarizer.summarize_sources(client, combined_text, token_budget=args.budget)
+        elapsed = time.perf_counter() - start
+
+    print(f"input: {len(combined_text)} chars, ~{summarizer.count_tokens(combined_text)} tokens")
+    print(f"elapsed: {elapsed:.2f}s, peak concurrent requests: {fake.peak_in_flight}")
+    print(f"stats: {stats}")
+    print(f"summary: {summary[:200]}")
+
+
+if __name__ == "__main__":
+    main()
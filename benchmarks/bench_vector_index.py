@@ -0,0 +1,140 @@
+"""
+The retrieval vector index (app/vector_index.py): lookup latency and recall of
+the approximate search (how often its best match is the exact search's) at
+growing index sizes, and the reuse rate of a prompt stream with repeated and
+reworded questions from several users.
+
+    python -m benchmarks.bench_vector_index
+    python -m benchmarks.bench_vector_index --sizes 1000,10000,100000 --queries 200
+    python -m benchmarks.bench_vector_index --users 1 --prompts 2000
+    VECTOR_INDEX_EMBEDDER=openai python -m benchmarks.bench_vector_index --reuse similar
+
+The index lives in a temporary directory and uses the configured embedder
+(VECTOR_INDEX_EMBEDDER, "hashing" by default, so no network is needed).
+Lookup outcomes are also counted in Redis (REDIS_), as in the workers.
+"""
+import argparse
+import random
+import tempfile
+import time
+
+from app import vector_index
+
+SUBJECTS = ["laptop", "phone", "camera", "bike", "tent", "router", "monitor", "headphones", "printer", "stroller",
+            "mattress", "blender", "backpack", "drone", "e-reader", "smartwatch", "keyboard", "projector"]
+ASPECTS = ["students", "travel", "a small budget", "gaming", "photography", "families", "remote work", "beginners",
+           "seniors", "outdoor use", "a home office", "long battery life"]
+TEMPLATES = [
+    "What is the best {s} for {a}?",
+    "Which {s} should I buy for {a}",
+    "Compare {s} options for {a} and list pros and cons",
+    "Recommend a {s} for {a}",
+]
+FILLERS = ["", " please", " in 2026", " quickly"]
+
+
+def prompt(rng: random.Random, topic: tuple[int, int]) -> str:
+    """A question about topic in one of a few phrasings, with small variations in case and filler words."""
+    text = rng.choice(TEMPLATES).format(s=SUBJECTS[topic[0]], a=ASPECTS[topic[1]]) + rng.choice(FILLERS)
+    return text.lower() if rng.random() < 0.3 else text
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+def scale(args):
+    rng = random.Random(args.seed)
+    words = [f"w{i}" for i in range(20000)]
+    print(f"{'rows':>8} {'insert/s':>9} {'exact p50':>10} {'exact p99':>10} {'ann p50':>9} {'ann p99':>9} {'recall@1':>9}")
+    with tempfile.TemporaryDirectory() as path:
+        index = vector_index.VectorIndex(path)
+        documents = lambda n: [" ".join(rng.choices(words, k=rng.randint(10, 60))) for _ in range(n)]
+        for size in (int(s) for s in args.sizes.split(",")):
+            texts = documents(size - len(index.rows))
+            started = time.perf_counter()
+            for i in range(0, len(texts), 1000):
+                index.add([{"kind": "raw_data", "text": t, "context": t[:200]} for t in texts[i:i + 1000]])
+            insert_rate = len(texts) / max(time.perf_counter() - started, 1e-9)
+            # Queries are stored documents with a quarter of their words replaced.
+            queries = []
+            for row in rng.sample(range(len(index.rows)), min(args.queries, len(index.rows))):
+                doc = index._context(index.rows[row]).split()
+                for j in rng.sample(range(len(doc)), len(doc) // 4):
+                    doc[j] = rng.choice(words)
+                queries.append(" ".join(doc))
+            timings = {"exact": [], "ann": []}
+            agree = 0
+            for q in queries:
+                results = {}
+                for mode in ("exact", "ann"):
+                    started = time.perf_counter()
+                    results[mode] = index.search(q, k=1, exact=mode == "exact")
+                    timings[mode].append((time.perf_counter() - started) * 1000)
+                agree += results["exact"][0]["key"] == results["ann"][0]["key"]
+            print(f"{len(index.rows):>8} {insert_rate:>9.0f} {percentile(timings['exact'], 50):>8.2f}ms "
+                  f"{percentile(timings['exact'], 99):>8.2f}ms {percentile(timings['ann'], 50):>7.2f}ms "
+                  f"{percentile(timings['ann'], 99):>7.2f}ms {agree / len(queries):>9.3f}")
+
+
+def reuse(args):
+    """Replays a prompt stream through lookup_context / index_retrieval, as information_retrieval_task does."""
+    rng = random.Random(args.seed)
+    topics = [(s, a) for s in range(len(SUBJECTS)) for a in range(len(ASPECTS))]
+    popular = rng.sample(topics, args.topics)
+    weights = [1 / (rank + 1) for rank in range(len(popular))] # a few questions are asked much more often
+    vector_index.VECTOR_INDEX_REUSE = args.reuse
+    vector_index.VECTOR_INDEX_REUSE_THRESHOLD = args.reuse_threshold
+    counts = {"reused": 0, "augmented": 0, "miss": 0, "wrong_topic": 0, "other_user": 0}
+    latencies = []
+    with tempfile.TemporaryDirectory() as path:
+        vector_index.VECTOR_INDEX_DIR = path
+        vector_index._index = None
+        for prompt_id in range(args.prompts):
+            topic = rng.choices(popular, weights)[0]
+            user = f"user{rng.randrange(args.users)}"
+            text = prompt(rng, topic)
+            started = time.perf_counter()
+            found = vector_index.lookup_context(text, user)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if "reuse" in found:
+                counts["reused"] += 1
+                counts["wrong_topic"] += found["reuse"]["context"] != f"answer about {topic} for {user}"
+                counts["other_user"] += found["reuse"]["user_id"] != user
+                continue
+            counts["augmented" if found else "miss"] += 1
+            counts["other_user"] += any(hit["user_id"] != user for hit in found.get("augment", []))
+            vector_index.index_retrieval(prompt_id, text, f"answer about {topic} for {user}", user)
+        rows = len(vector_index.get_index().rows)
+    mode = args.reuse + (f" (threshold {args.reuse_threshold})" if vector_index.similar_reuse() else "")
+    print(f"{args.prompts} prompts over {args.topics} topics from {args.users} users, reuse {mode}: "
+          f"{counts['reused'] / args.prompts:.1%} reused ({counts['wrong_topic']} with a wrong answer), "
+          f"{counts['augmented'] / args.prompts:.1%} augmented, {counts['miss'] / args.prompts:.1%} missed, "
+          f"{counts['other_user']} lookups returned another user's entries")
+    print(f"LLM calls saved: {counts['reused']}, index rows: {rows}, "
+          f"lookup p50 {percentile(latencies, 50):.2f} ms, p99 {percentile(latencies, 99):.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,50000", help="comma-separated index sizes (rows)")
+    parser.add_argument("--queries", type=int, default=100, help="lookups per size")
+    parser.add_argument("--prompts", type=int, default=1000, help="prompts in the reuse stream")
+    parser.add_argument("--topics", type=int, default=60, help="distinct questions in the reuse stream")
+    parser.add_argument("--users", type=int, default=5, help="users sending the reuse stream")
+    parser.add_argument("--reuse", choices=["exact", "similar", "off"], default=vector_index.VECTOR_INDEX_REUSE,
+                        help="VECTOR_INDEX_REUSE; 'similar' only applies with a semantic embedder")
+    parser.add_argument("--reuse-threshold", type=float, default=vector_index.VECTOR_INDEX_REUSE_THRESHOLD)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not vector_index.index_enabled():
+        raise SystemExit("The vector index needs numpy (and VECTOR_INDEX_ENABLED=true)")
+    scale(args)
+    print()
+    reuse(args)
+
+
+if __name__ == "__main__":
+    main()
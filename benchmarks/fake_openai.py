@@ -0,0 +1,210 @@
+"""
+Local stand-in for the OpenAI chat-completions API.
+
+    with FakeOpenAI(latency_ms=300) as fake:
+        client = OpenAI(base_url=fake.base_url, api_key="test")
+
+Responses are deterministic: the completion echoes the size of the last user
+message and its first words, and 'usage' is estimated at ~4 characters per
+token. Requests with "stream": true get server-sent events, one word per
+chunk, stream_delay_ms apart; other requests wait as long (stream_delay_ms per
+word) and get the whole reply at once, like a model that generates the same
+text without streaming it. The server records request count and peak
+concurrency so benchmarks can check concurrency budgets.
+
+Throttling like the real API can be injected: with rate_limit_requests /
+rate_limit_tokens per rate_limit_window seconds, or max_concurrency
+requests in flight, excess requests get a 429 with a Retry-After header.
+
+So can a degraded upstream: a slow_fraction of requests take slow_latency_ms
+instead of the model's latency (model_latency_ms overrides latency_ms per
+model), and a fail_fraction answer 503 (after their latency). Both can be
+changed while the server runs.
+"""
+import collections
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client hung up, e.g. a cancelled hedge or a timed-out request
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        fake = self.server.fake
+
+        retry_after = fake.throttle(body)
+        if retry_after is not None:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                            headers={"Retry-After": f"{retry_after:.3f}"})
+            return
+        with fake.lock:
+            fake.request_count += 1
+            fake.peak_in_flight = max(fake.peak_in_flight, fake.in_flight)
+            fake.requests.append(body)
+            latency_ms, fail = fake.pick_latency(body.get("model"))
+        try:
+            time.sleep(latency_ms / 1000)
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+                return
+            if fail:
+                self._send_json(503, {"error": {"message": "The server is overloaded", "type": "server_error"}})
+                return
+            if body.get("stream"):
+                self._send_stream(fake, body)
+            else:
+                completion = fake.completion(body)
+                # Generation takes as long as when streamed; only the delivery differs.
+                time.sleep(len(completion["choices"][0]["message"]["content"].split(" ")) * fake.stream_delay_ms / 1000)
+                self._send_json(200, completion)
+        finally:
+            with fake.lock:
+                fake.in_flight -= 1
+
+    def _send_stream(self, fake, body: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        completion = fake.completion(body)
+        words = completion["choices"][0]["message"]["content"].split(" ")
+        base = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"], "model": completion["model"]}
+        for i, word in enumerate(words):
+            delta = {"role": "assistant", "content": word} if i == 0 else {"content": " " + word}
+            self._send_event({**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+            time.sleep(fake.stream_delay_ms / 1000)
+        self._send_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._send_event({**base, "choices": [], "usage": completion["usage"]})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _send_event(self, payload: dict):
+        self.wfile.write(b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n")
+        self.wfile.flush()
+
+    def _send_json(self, status: int, payload: dict, headers: dict | None = None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOpenAI:
+    def __init__(self, latency_ms: int = 0, stream_delay_ms: int = 0, host: str = "127.0.0.1", port: int = 0,
+                 handler=FakeOpenAIHandler, rate_limit_requests: int | None = None, rate_limit_tokens: int | None = None,
+                 rate_limit_window: float = 60.0, max_concurrency: int | None = None, slow_fraction: float = 0.0,
+                 slow_latency_ms: int = 0, fail_fraction: float = 0.0, model_latency_ms: dict | None = None, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.slow_fraction = slow_fraction
+        self.slow_latency_ms = slow_latency_ms
+        self.fail_fraction = fail_fraction
+        self.model_latency_ms = model_latency_ms or {}
+        self.random = random.Random(seed)
+        self.stream_delay_ms = stream_delay_ms
+        self.rate_limit_requests = rate_limit_requests
+        self.rate_limit_tokens = rate_limit_tokens
+        self.rate_limit_window = rate_limit_window
+        self.max_concurrency = max_concurrency
+        self.window = collections.deque() # (time, tokens) of admitted requests
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = []
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def pick_latency(self, model: str | None) -> tuple[float, bool]:
+        """(latency in ms, whether to fail) for one request; call with the lock held."""
+        latency_ms = self.model_latency_ms.get(model, self.latency_ms)
+        if self.slow_fraction and self.random.random() < self.slow_fraction:
+            latency_ms = self.slow_latency_ms
+        return latency_ms, bool(self.fail_fraction) and self.random.random() < self.fail_fraction
+
+    def throttle(self, body: dict) -> float | None:
+        """Admit the request (counting it in flight) or return seconds to Retry-After."""
+        tokens = sum(_estimate_tokens(m.get("content", "")) for m in body.get("messages", [])) + (body.get("max_tokens") or 0)
+        now = time.monotonic()
+        with self.lock:
+            while self.window and self.window[0][0] <= now - self.rate_limit_window:
+                self.window.popleft()
+            retry_after = None
+            if self.max_concurrency is not None and self.in_flight >= self.max_concurrency:
+                retry_after = max(0.05, self.latency_ms / 1000)
+            elif self.rate_limit_requests is not None and len(self.window) >= self.rate_limit_requests:
+                retry_after = self.window[0][0] + self.rate_limit_window - now
+            elif self.rate_limit_tokens is not None and sum(t for _, t in self.window) + tokens > self.rate_limit_tokens:
+                retry_after = self.window[0][0] + self.rate_limit_window - now if self.window else self.rate_limit_window
+            if retry_after is not None:
+                self.throttled_count += 1
+                return retry_after
+            self.window.append((now, tokens))
+            self.in_flight += 1
+            return None
+
+    def completion_text(self, body: dict) -> str:
+        messages = body.get("messages", [])
+        last = messages[-1]["content"] if messages else ""
+        preview = " ".join(last.split()[:12])
+        return f"Summary of {len(last)} characters. Key Quotes: \"{preview}\""
+
+    def completion(self, body: dict) -> dict:
+        text = self.completion_text(body)
+        prompt_tokens = sum(_estimate_tokens(m.get("content", "")) for m in body.get("messages", []))
+        completion_tokens = min(_estimate_tokens(text), body.get("max_tokens") or 10**9)
+        return {
+            "id": f"chatcmpl-fake-{self.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,128 @@
+"""
+Local HTTP fixture site for exercising mcp_task's URL fetching without the internet.
+
+    with FixtureSite() as site:
+        urls = [site.url(f"/page/{i}?delay=200") for i in range(20)]
+
+Routes:
+    /page/<n>?delay=<ms>&size=<paragraphs>   HTML article page (ETag/Last-Modified, honours
+                                             If-None-Match with 304 Not Modified)
+    /status/<code>                           empty response with the given status
+    /large?size=<bytes>&type=<content type>  HTML page of about `size` bytes, streamed in chunks
+    /binary/<pdf|png|zip>?type=<content type> small file of that format (type defaults to the real one)
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+BINARY_FILES = {
+    "pdf": (b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj << /Type /Catalog >> endobj\n" + bytes(range(256)) * 64, "application/pdf"),
+    "png": (b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 64, "image/png"),
+    "zip": (b"PK\x03\x04" + bytes(range(256)) * 64, "application/zip"),
+}
+
+
+def render_page(n: int, paragraphs: int = 20) -> bytes:
+    body = "".join(
+        f"<p>Paragraph {i} of fixture page {n}. It discusses topic {n % 7} in some detail.</p>"
+        for i in range(paragraphs)
+    )
+    html = (
+        f"<html><head><title>Page {n}</title><style>p {{ color: black; }}</style>"
+        f"<script>var page = {n};</script></head>"
+        f"<body><nav><a href='/'>Home</a> | <a href='/about'>About</a></nav>"
+        f"<article><h1>Fixture page {n}</h1>{body}</article>"
+        f"<footer>Copyright fixture site</footer></body></html>"
+    )
+    return html.encode("utf-8")
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, so connection reuse is observable
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client hung up, e.g. after reading a capped body
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        self.server.request_count += 1
+        time.sleep(int(query.get("delay", "0")) / 1000)
+
+        segments = parts.path.strip("/").split("/")
+        if segments[0] == "status" and len(segments) > 1:
+            self._send(int(segments[1]), b"", "text/plain")
+        elif segments[0] == "page" and len(segments) > 1:
+            etag = f'"page-{segments[1]}-{query.get("size", "20")}"'
+            validators = {"ETag": etag, "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, b"", "text/html; charset=utf-8", validators)
+            else:
+                self._send(200, render_page(int(segments[1]), int(query.get("size", "20"))), "text/html; charset=utf-8", validators)
+        elif segments[0] == "large":
+            self._send_large(int(query.get("size", str(10 * 1024 * 1024))), query.get("type", "text/html; charset=utf-8"))
+        elif segments[0] == "binary" and len(segments) > 1 and segments[1] in BINARY_FILES:
+            body, content_type = BINARY_FILES[segments[1]]
+            self._send(200, body, query.get("type", content_type))
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def _send_large(self, size: int, content_type: str):
+        paragraph = b"<p>" + b"A long page that keeps going well past any sensible size. " * 16 + b"</p>"
+        head, tail = b"<html><body><article>", b"</article></body></html>"
+        count = max(0, (size - len(head) - len(tail)) // len(paragraph))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(head) + count * len(paragraph) + len(tail)))
+        self.end_headers()
+        try:
+            self.wfile.write(head)
+            chunk = paragraph * 64
+            for _ in range(count // 64):
+                self.wfile.write(chunk)
+            self.wfile.write(paragraph * (count % 64) + tail)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client stopped reading
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict | None = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+class FixtureSite:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, handler=FixtureHandler):
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.server.request_count = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path: str) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    @property
+    def request_count(self) -> int:
+        return self.server.request_count
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
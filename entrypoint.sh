@@ -27,7 +27,21 @@ case "$1" in
             export PATH="$PATH:/home/swebot/.local/bin"
         fi
         
-        exec celery -A app.celery_app worker -l info
+        # Queues this worker consumes (all by default); concurrency and prefetch
+        # come from the per-queue settings in app/queues.py.
+        WORKER_QUEUES="${WORKER_QUEUES:-retrieval,summary,mcp}"
+        export WORKER_QUEUES
+
+        if [ "$TASK_EXECUTION_MODE" = "asyncio" ]; then
+            # Stage bodies run as coroutines on one event loop per process; the
+            # pool threads only wait on them, so concurrency can be high.
+            exec celery -A app.celery_app worker -l info -Q "$WORKER_QUEUES" --pool=threads --concurrency="${ASYNC_WORKER_CONCURRENCY:-256}"
+        fi
+        if [ -n "$WORKER_AUTOSCALE" ]; then
+            # "max,min" processes, scaled on queue depth and age (app.autoscaler.QueueDepthAutoscaler).
+            exec celery -A app.celery_app worker -l info -Q "$WORKER_QUEUES" --autoscale="$WORKER_AUTOSCALE"
+        fi
+        exec celery -A app.celery_app worker -l info -Q "$WORKER_QUEUES"
         ;;
     *)
         # If no argument or an unknown argument is given, execute the passed command.
@@ -0,0 +1,95 @@
+-- Stage commits in one round trip (see commit_stage() in app/utils.py).
+--
+-- A stage used to write its output and advance the prompt with several separate
+-- PostgREST calls: update status, insert/update 'results', update status again,
+-- and (for MCP) look up the latest results row first. commit_stage() does all of
+-- it in one transaction, and only if the prompt is still in one of the statuses
+-- the stage expects, so a late or duplicate worker can't move a prompt backwards.
+
+ALTER TABLE public.prompts ADD COLUMN IF NOT EXISTS current_result_id BIGINT;
+
+-- Backfill: point existing prompts at their latest results row.
+UPDATE public.prompts p
+SET current_result_id = r.id
+FROM (
+    SELECT DISTINCT ON (prompt_id) prompt_id, id
+    FROM public.results
+    ORDER BY prompt_id, created_at DESC
+) r
+WHERE r.prompt_id = p.id AND p.current_result_id IS NULL;
+
+-- p_to_status        status to move the prompt to (NULL: leave it unchanged)
+-- p_from_statuses    statuses the prompt must currently have (NULL: any)
+-- p_result           results columns to write: raw_data, processed_options, summary, mcp_data
+--                    (only the keys present are written)
+-- p_new_result       insert a new results row instead of updating the current one
+-- p_result_id        results row to update (default: the prompt's current_result_id)
+--
+-- Returns {applied, status, previous_status, result_id}; when the status check
+-- fails nothing is written and applied is false.
+CREATE OR REPLACE FUNCTION public.commit_stage(
+    p_prompt_id BIGINT,
+    p_to_status TEXT DEFAULT NULL,
+    p_from_statuses TEXT[] DEFAULT NULL,
+    p_result JSONB DEFAULT NULL,
+    p_new_result BOOLEAN DEFAULT FALSE,
+    p_result_id BIGINT DEFAULT NULL
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_status TEXT;
+    v_result_id BIGINT;
+BEGIN
+    SELECT status, current_result_id INTO v_status, v_result_id
+    FROM public.prompts
+    WHERE id = p_prompt_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('applied', FALSE, 'status', NULL, 'previous_status', NULL, 'result_id', NULL,
+                                  'reason', 'prompt_not_found');
+    END IF;
+
+    IF p_from_statuses IS NOT NULL AND NOT COALESCE(v_status = ANY(p_from_statuses), FALSE) THEN
+        RETURN jsonb_build_object('applied', FALSE, 'status', v_status, 'previous_status', v_status, 'result_id', v_result_id,
+                                  'reason', 'status_conflict');
+    END IF;
+
+    v_result_id := COALESCE(p_result_id, v_result_id);
+
+    IF p_result IS NOT NULL THEN
+        IF p_new_result THEN
+            INSERT INTO public.results (prompt_id, raw_data, processed_options, summary, mcp_data)
+            VALUES (p_prompt_id, p_result->'raw_data', p_result->'processed_options', p_result->>'summary', p_result->>'mcp_data')
+            RETURNING id INTO v_result_id;
+        ELSE
+            IF v_result_id IS NULL THEN
+                -- Prompts created before current_result_id existed: use their latest row.
+                SELECT id INTO v_result_id FROM public.results
+                WHERE prompt_id = p_prompt_id ORDER BY created_at DESC LIMIT 1;
+            END IF;
+            IF v_result_id IS NULL THEN
+                RAISE EXCEPTION 'No results row for prompt_id % to update', p_prompt_id USING ERRCODE = 'no_data_found';
+            END IF;
+            UPDATE public.results SET
+                raw_data = CASE WHEN p_result ? 'raw_data' THEN p_result->'raw_data' ELSE raw_data END,
+                processed_options = CASE WHEN p_result ? 'processed_options' THEN p_result->'processed_options' ELSE processed_options END,
+                summary = CASE WHEN p_result ? 'summary' THEN p_result->>'summary' ELSE summary END,
+                mcp_data = CASE WHEN p_result ? 'mcp_data' THEN p_result->>'mcp_data' ELSE mcp_data END
+            WHERE id = v_result_id;
+        END IF;
+    END IF;
+
+    UPDATE public.prompts SET
+        status = COALESCE(p_to_status, status),
+        current_result_id = v_result_id
+    WHERE id = p_prompt_id;
+
+    RETURN jsonb_build_object('applied', TRUE, 'status', COALESCE(p_to_status, v_status), 'previous_status', v_status,
+                              'result_id', v_result_id);
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.commit_stage(BIGINT, TEXT, TEXT[], JSONB, BOOLEAN, BIGINT) TO anon, authenticated, service_role;
@@ -0,0 +1,92 @@
+-- Content-addressed blob storage (see app/blob_store.py).
+--
+-- Large payloads (retrieval raw_data, extracted MCP source text) are stored once
+-- per distinct content in 'blobs', keyed by the SHA-256 of the uncompressed bytes,
+-- and compressed above BLOB_COMPRESS_MIN_BYTES. 'results' rows reference them:
+-- raw_data_ref instead of an inline raw_data, and source_refs listing each
+-- source URL's text. Rows written before this keep their inline raw_data.
+
+CREATE TABLE IF NOT EXISTS public.blobs (
+    hash TEXT PRIMARY KEY,            -- 'sha256:<hex>' of the uncompressed body
+    codec TEXT NOT NULL,              -- 'zstd', 'zlib' or 'none'
+    size INTEGER NOT NULL,            -- uncompressed bytes
+    stored_size INTEGER NOT NULL,     -- bytes after compression
+    data TEXT NOT NULL,               -- base64 of the stored bytes
+    created_at TIMESTAMPTZ DEFAULT now() NOT NULL
+);
+
+ALTER TABLE public.results ADD COLUMN IF NOT EXISTS raw_data_ref TEXT;
+ALTER TABLE public.results ADD COLUMN IF NOT EXISTS source_refs JSONB; -- [{"url", "ref", "chars"}, ...]
+
+GRANT SELECT, INSERT ON public.blobs TO anon, authenticated, service_role;
+
+-- commit_stage() from 20261017000000_commit_stage.sql, now also writing raw_data_ref and source_refs.
+CREATE OR REPLACE FUNCTION public.commit_stage(
+    p_prompt_id BIGINT,
+    p_to_status TEXT DEFAULT NULL,
+    p_from_statuses TEXT[] DEFAULT NULL,
+    p_result JSONB DEFAULT NULL,
+    p_new_result BOOLEAN DEFAULT FALSE,
+    p_result_id BIGINT DEFAULT NULL
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_status TEXT;
+    v_result_id BIGINT;
+BEGIN
+    SELECT status, current_result_id INTO v_status, v_result_id
+    FROM public.prompts
+    WHERE id = p_prompt_id
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('applied', FALSE, 'status', NULL, 'previous_status', NULL, 'result_id', NULL,
+                                  'reason', 'prompt_not_found');
+    END IF;
+
+    IF p_from_statuses IS NOT NULL AND NOT COALESCE(v_status = ANY(p_from_statuses), FALSE) THEN
+        RETURN jsonb_build_object('applied', FALSE, 'status', v_status, 'previous_status', v_status, 'result_id', v_result_id,
+                                  'reason', 'status_conflict');
+    END IF;
+
+    v_result_id := COALESCE(p_result_id, v_result_id);
+
+    IF p_result IS NOT NULL THEN
+        IF p_new_result THEN
+            INSERT INTO public.results (prompt_id, raw_data, raw_data_ref, processed_options, summary, mcp_data, source_refs)
+            VALUES (p_prompt_id, p_result->'raw_data', p_result->>'raw_data_ref', p_result->'processed_options',
+                    p_result->>'summary', p_result->>'mcp_data', p_result->'source_refs')
+            RETURNING id INTO v_result_id;
+        ELSE
+            IF v_result_id IS NULL THEN
+                -- Prompts created before current_result_id existed: use their latest row.
+                SELECT id INTO v_result_id FROM public.results
+                WHERE prompt_id = p_prompt_id ORDER BY created_at DESC LIMIT 1;
+            END IF;
+            IF v_result_id IS NULL THEN
+                RAISE EXCEPTION 'No results row for prompt_id % to update', p_prompt_id USING ERRCODE = 'no_data_found';
+            END IF;
+            UPDATE public.results SET
+                raw_data = CASE WHEN p_result ? 'raw_data' THEN p_result->'raw_data' ELSE raw_data END,
+                raw_data_ref = CASE WHEN p_result ? 'raw_data_ref' THEN p_result->>'raw_data_ref' ELSE raw_data_ref END,
+                processed_options = CASE WHEN p_result ? 'processed_options' THEN p_result->'processed_options' ELSE processed_options END,
+                summary = CASE WHEN p_result ? 'summary' THEN p_result->>'summary' ELSE summary END,
+                mcp_data = CASE WHEN p_result ? 'mcp_data' THEN p_result->>'mcp_data' ELSE mcp_data END,
+                source_refs = CASE WHEN p_result ? 'source_refs' THEN p_result->'source_refs' ELSE source_refs END
+            WHERE id = v_result_id;
+        END IF;
+    END IF;
+
+    UPDATE public.prompts SET
+        status = COALESCE(p_to_status, status),
+        current_result_id = v_result_id
+    WHERE id = p_prompt_id;
+
+    RETURN jsonb_build_object('applied', TRUE, 'status', COALESCE(p_to_status, v_status), 'previous_status', v_status,
+                              'result_id', v_result_id);
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.commit_stage(BIGINT, TEXT, TEXT[], JSONB, BOOLEAN, BIGINT) TO anon, authenticated, service_role;